@@ -51,6 +51,7 @@ INSTALLED_APPS = [
 AUTH_USER_MODEL = 'market.User'
 
 MIDDLEWARE = [
+    'market.profiling.ProfilingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'market.middleware.ReferralTrackingMiddleware',
     'django.middleware.security.SecurityMiddleware',
@@ -62,6 +63,39 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Кэш: Redis при заданном REDIS_URL (общий для всех процессов), иначе память процесса
+REDIS_URL = os.environ.get('REDIS_URL')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Дедупликация повторных кликов (market.click_dedup): окно, ожидаемые клики за окно, доля ложных повторов
+CLICK_DEDUP_WINDOW_SECONDS = int(os.environ.get('CLICK_DEDUP_WINDOW_SECONDS', '1800'))
+CLICK_DEDUP_CAPACITY = int(os.environ.get('CLICK_DEDUP_CAPACITY', '1000000'))
+CLICK_DEDUP_ERROR_RATE = float(os.environ.get('CLICK_DEDUP_ERROR_RATE', '0.001'))
+
+# Шардов на строку дня UTM-кампании (market.campaigns): клики одной кампании не ждут одну блокировку
+CAMPAIGN_STAT_SHARDS = int(os.environ.get('CAMPAIGN_STAT_SHARDS', '16'))
+
+# Адреса обратных прокси (через запятую), которым доверяется X-Forwarded-For (market.throttling.client_ip).
+# Запросы ReferralTrackingMiddleware к API передают IP посетителя в X-Forwarded-For -
+# адрес сервера приложения тоже должен быть в списке. Пусто - используется REMOTE_ADDR.
+TRUSTED_PROXIES = [addr.strip() for addr in os.environ.get('TRUSTED_PROXIES', '').split(',') if addr.strip()]
+
+# Выборочное профилирование запросов (market.profiling), метрики: /api/admin/metrics/
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'False').lower() == 'true'
+PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', '0.01'))
+
 ROOT_URLCONF = 'core.urls'
 
 TEMPLATES = [
@@ -151,6 +185,12 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    # Token bucket публичных реферальных эндпоинтов (market.throttling.ReferralThrottle)
+    'DEFAULT_THROTTLE_RATES': {
+        'referral_ip': os.environ.get('REFERRAL_THROTTLE_IP', '120/min'),
+        'referral_anonymous': os.environ.get('REFERRAL_THROTTLE_ANONYMOUS', '30/min'),
+        'referral_code': os.environ.get('REFERRAL_THROTTLE_CODE', '3000/min'),
+    },
 }
 
 # JWT Settings
@@ -0,0 +1,402 @@
+"""
+Ad-hoc аналитика реферальной программы по колоночным выгрузкам.
+
+Нужные запросу колонки ReferralVisit, ReferralAttribution и ReferralReward
+читаются курсором (values_list().iterator()) в массивы NumPy: время - секунды
+эпохи, id - int64, строковые метки - коды словаря, anonymous_id - 64-битный хэш.
+Фильтры, группировка и меры считаются векторно над массивами. Выгрузки
+кэшируются в процессе на EXTRACT_TTL секунд, поэтому серия вопросов по одному
+периоду читает БД один раз.
+
+Запрос: dimensions (DIMENSIONS), measures (MEASURES), filters {измерение: значение
+или список}, grain (GRAINS - добавляет измерение period), период [start, end)
+(по умолчанию последние DEFAULT_DAYS дней). Время - в локальной зоне проекта.
+"""
+import hashlib
+import itertools
+import math
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+from django.db.models import IntegerField
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import ReferralAttribution, ReferralReward, ReferralVisit
+
+DEFAULT_DAYS = 30
+CHUNK_SIZE = 20000
+EXTRACT_TTL = 300
+EXTRACT_CACHE_SIZE = 4
+DIRECT_SPAN = 1 << 22  # Диапазон значений, который группируется через bincount без сортировки
+
+DIMENSIONS = (
+    'product', 'referral_link', 'referrer', 'utm_source', 'utm_medium', 'utm_campaign',
+    'device_type', 'os', 'browser', 'weekday', 'hour',
+)
+LABEL_DIMENSIONS = ('utm_source', 'utm_medium', 'utm_campaign', 'device_type', 'os', 'browser')
+TIME_DIMENSIONS = ('weekday', 'hour')
+GRAINS = ('hour', 'day', 'week', 'month')
+PERIOD_UNITS = {'hour': 'h', 'day': 'D', 'week': 'D', 'month': 'M'}
+# Мера -> (выгрузка, колонка весов или None для количества)
+MEASURES = {
+    'visits': ('visits', None),
+    'visitors': ('visits', 'visitor'),
+    'attributions': ('attributions', None),
+    'conversions': ('rewards', None),
+    'revenue': ('rewards', 'order_amount'),
+    'rewards': ('rewards', 'reward_amount'),
+    'conversion_rate': (None, None),  # conversions / visits, %
+}
+
+
+# Выгрузка -> (queryset, поле времени, {колонка: (выражение, тип)})
+# Типы: time - секунды эпохи, id - int64 (NULL -> 0), label - код словаря, hash - хэш строки, amount - float64
+SOURCES = {
+    'visits': (
+        lambda: ReferralVisit.objects.all(), 'visited_at', {
+            'ts': ('visited_at', 'time'),
+            'product': (Coalesce('product_id', 'referral_link__product_id', output_field=IntegerField()), 'id'),
+            'referral_link': ('referral_link_id', 'id'),
+            'referrer': ('referral_link__user_id', 'id'),
+            'utm_source': ('utm_source', 'label'),
+            'utm_medium': ('utm_medium', 'label'),
+            'utm_campaign': ('utm_campaign', 'label'),
+            'device_type': ('agent__device_type', 'label'),
+            'os': ('agent__os', 'label'),
+            'browser': ('agent__browser', 'label'),
+            'visitor': ('anonymous_id', 'hash'),
+        },
+    ),
+    'attributions': (
+        lambda: ReferralAttribution.objects.all(), 'created_at', {
+            'ts': ('created_at', 'time'),
+            'product': ('product_id', 'id'),
+            'referral_link': ('referral_link_id', 'id'),
+            'referrer': ('referral_link__user_id', 'id'),
+            'utm_source': ('last_visit__utm_source', 'label'),
+            'utm_medium': ('last_visit__utm_medium', 'label'),
+            'utm_campaign': ('last_visit__utm_campaign', 'label'),
+            'device_type': ('last_visit__agent__device_type', 'label'),
+            'os': ('last_visit__agent__os', 'label'),
+            'browser': ('last_visit__agent__browser', 'label'),
+        },
+    ),
+    'rewards': (
+        lambda: ReferralReward.objects.exclude(status='REVERSED'), 'created_at', {
+            'ts': ('created_at', 'time'),
+            'product': ('product_id', 'id'),
+            'referral_link': ('referral_link_id', 'id'),
+            'referrer': ('attributed_user_id', 'id'),
+            'utm_source': ('attributed_visit__utm_source', 'label'),
+            'utm_medium': ('attributed_visit__utm_medium', 'label'),
+            'utm_campaign': ('attributed_visit__utm_campaign', 'label'),
+            'device_type': ('attributed_visit__agent__device_type', 'label'),
+            'os': ('attributed_visit__agent__os', 'label'),
+            'browser': ('attributed_visit__agent__browser', 'label'),
+            'order_amount': ('order_amount', 'amount'),
+            'reward_amount': ('reward_amount', 'amount'),
+        },
+    ),
+}
+
+
+def _visitor_hash(value):
+    # hash() строк зависит от процесса - нужен устойчивый между воркерами
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big', signed=True)
+
+
+class Extract:
+    """Колонки одной выгрузки: массивы равной длины и словари меток"""
+
+    def __init__(self, columns, vocabularies=None):
+        self.columns = columns
+        self.vocabularies = vocabularies or {}
+        self._local = None
+        self._codes = {}
+
+    def __len__(self):
+        return len(self.columns['ts'])
+
+    def local_seconds(self):
+        """Время в локальной зоне проекта: смещение считается по уникальным часам, не по строкам"""
+        if self._local is None:
+            ts = self.columns['ts']
+            inverse, hours = _factorize(ts // 3600)
+            tz = timezone.get_current_timezone()
+            offsets = np.fromiter(
+                (datetime.fromtimestamp(int(hour) * 3600, tz).utcoffset().total_seconds() for hour in hours),
+                dtype=np.int64, count=len(hours),
+            )
+            self._local = ts + offsets[inverse]
+        return self._local
+
+    def codes(self, name):
+        """(плотные коды колонки, число различных значений); считается один раз на выгрузку"""
+        if name not in self._codes:
+            codes, levels = _factorize(self.columns[name])
+            self._codes[name] = (codes, len(levels))
+        return self._codes[name]
+
+    def dimension(self, name):
+        if name == 'weekday':
+            # 1970-01-01 - четверг; 1 - понедельник, 7 - воскресенье
+            return (self.local_seconds() // 86400 + 3) % 7 + 1
+        if name == 'hour':
+            return self.local_seconds() % 86400 // 3600
+        return self.columns[name]
+
+    def period(self, grain):
+        """Начало периода grain для каждой строки в единицах PERIOD_UNITS[grain] от начала эпохи"""
+        local = self.local_seconds()
+        if grain == 'hour':
+            return local // 3600
+        days = local // 86400
+        if grain == 'week':
+            return days - (days + 3) % 7
+        if grain == 'month':
+            return days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+        return days
+
+
+def _convert(kind, values, vocabulary):
+    count = len(values)
+    if kind == 'time':
+        return np.fromiter((value.timestamp() for value in values), dtype=np.float64, count=count).astype(np.int64)
+    if kind == 'id':
+        return np.fromiter((value or 0 for value in values), dtype=np.int64, count=count)
+    if kind == 'label':
+        return np.fromiter((vocabulary.setdefault(value, len(vocabulary)) for value in values), dtype=np.int32, count=count)
+    if kind == 'hash':
+        return np.fromiter((_visitor_hash(value) for value in values), dtype=np.int64, count=count)
+    return np.fromiter((float(value or 0) for value in values), dtype=np.float64, count=count)
+
+
+def load_extract(source, columns, start=None, end=None, chunk_size=CHUNK_SIZE):
+    """Читает колонки выгрузки source за [start, end) курсором, пачками по chunk_size строк"""
+    queryset_factory, time_field, available = SOURCES[source]
+    columns = ['ts', *sorted(set(columns) - {'ts'})]
+    queryset = queryset_factory()
+    if start is not None:
+        queryset = queryset.filter(**{f'{time_field}__gte': start})
+    if end is not None:
+        queryset = queryset.filter(**{f'{time_field}__lt': end})
+    expressions = {}
+    names = []
+    for column in columns:
+        expression, _ = available[column]
+        if isinstance(expression, str):
+            names.append(expression)
+        else:
+            expressions[f'_{column}'] = expression
+            names.append(f'_{column}')
+    rows = queryset.annotate(**expressions).order_by().values_list(*names).iterator(chunk_size=chunk_size)
+
+    vocabularies = {column: {} for column in columns if available[column][1] == 'label'}
+    parts = {column: [] for column in columns}
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        for column, values in zip(columns, zip(*chunk)):
+            parts[column].append(_convert(available[column][1], values, vocabularies.get(column)))
+    arrays = {}
+    for column in columns:
+        kind = available[column][1]
+        empty = np.empty(0, dtype={'label': np.int32, 'amount': np.float64}.get(kind, np.int64))
+        arrays[column] = np.concatenate(parts[column]) if parts[column] else empty
+    return Extract(arrays, {column: list(vocabulary) for column, vocabulary in vocabularies.items()})
+
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def get_extract(source, columns, start, end):
+    """Выгрузка из кэша процесса (подходит любая с теми же границами и нужными колонками) или из БД"""
+    columns = set(columns) | {'ts'}
+    now = time.monotonic()
+    with _cache_lock:
+        for key, (loaded_at, extract) in list(_cache.items()):
+            if now - loaded_at > EXTRACT_TTL:
+                del _cache[key]
+            elif key[:3] == (source, start, end) and columns <= key[3]:
+                _cache.move_to_end(key)
+                return extract
+    extract = load_extract(source, columns, start, end)
+    with _cache_lock:
+        _cache[(source, start, end, frozenset(columns))] = (now, extract)
+        while len(_cache) > EXTRACT_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return extract
+
+
+def clear_extracts():
+    with _cache_lock:
+        _cache.clear()
+
+
+def _factorize(values):
+    """
+    (плотный код каждой строки, значения по возрастанию). При небольшом диапазоне
+    значений - через bincount за линейное время, иначе сортировкой (np.unique).
+    """
+    if not len(values):
+        return np.zeros(0, dtype=np.int64), values[:0]
+    low = values.min()
+    span = int(values.max()) - int(low)
+    if span < DIRECT_SPAN:
+        shifted = values - low
+        present = np.bincount(shifted, minlength=span + 1) > 0
+        return (np.cumsum(present) - 1)[shifted], np.flatnonzero(present) + low
+    levels, inverse = np.unique(values, return_inverse=True)
+    return inverse.reshape(-1), levels
+
+
+def _group(keys, size):
+    """Номер группы для каждой строки и значения измерений каждой группы"""
+    if not keys:
+        return np.zeros(size, dtype=np.int64), [()]
+    dense, levels = zip(*(_factorize(column) for column in keys))
+    shape = tuple(max(1, len(level)) for level in levels)
+    if math.prod(shape) < 2 ** 62:
+        inverse, groups = _factorize(np.ravel_multi_index(dense, shape))
+        coords = np.unravel_index(groups, shape)
+    else:
+        groups, inverse = np.unique(np.stack(dense, axis=1), axis=0, return_inverse=True)
+        inverse, coords = inverse.reshape(-1), groups.T
+    labels = [
+        tuple(level[coord[g]] for level, coord in zip(levels, coords))
+        for g in range(len(groups))
+    ]
+    return inverse, labels
+
+
+def _distinct_per_group(inverse, codes, cardinality, groups):
+    """Число различных кодов (0..cardinality-1) в каждой группе: уникальные пары (группа, код) одним ключом int64"""
+    pairs = inverse.astype(np.int64) * cardinality + codes
+    if len(pairs) and int(pairs.max()) < DIRECT_SPAN:
+        pairs = np.flatnonzero(np.bincount(pairs))
+    elif len(pairs):
+        # Сортировка без обратного отображения дешевле np.unique(return_inverse=True)
+        pairs = np.sort(pairs)
+        first = np.ones(len(pairs), dtype=bool)
+        first[1:] = pairs[1:] != pairs[:-1]
+        pairs = pairs[first]
+    return np.bincount(pairs // max(1, cardinality), minlength=groups)
+
+
+def _filter_codes(extract, dimension, values):
+    if dimension in LABEL_DIMENSIONS:
+        vocabulary = {label: code for code, label in enumerate(extract.vocabularies.get(dimension, []))}
+        return [vocabulary[value] for value in values if value in vocabulary]
+    return [0 if value is None else int(value) for value in values]
+
+
+def _decode(extract, dimension, value, grain):
+    if dimension == 'period':
+        return str(np.datetime64(int(value), PERIOD_UNITS[grain]))
+    if dimension in LABEL_DIMENSIONS:
+        return extract.vocabularies[dimension][value]
+    value = int(value)
+    if dimension in TIME_DIMENSIONS:
+        return value
+    return value or None
+
+
+def _aggregate(extract, dimensions, grain, filters, measures):
+    """{значения измерений: {мера: значение}} по одной выгрузке"""
+    mask = None
+    for dimension, values in filters.items():
+        matches = np.isin(extract.dimension(dimension), _filter_codes(extract, dimension, values))
+        mask = matches if mask is None else mask & matches
+
+    def select(column):
+        return column if mask is None else column[mask]
+
+    keys = [select(extract.period(grain))] if grain else []
+    keys += [select(extract.dimension(dimension)) for dimension in dimensions]
+    inverse, labels = _group(keys, len(extract) if mask is None else int(mask.sum()))
+    names = (['period'] if grain else []) + list(dimensions)
+
+    results = {}
+    for measure in measures:
+        weights = MEASURES[measure][1]
+        if weights == 'visitor':
+            codes, cardinality = extract.codes('visitor')
+            values = _distinct_per_group(inverse, select(codes), cardinality, len(labels))
+        elif weights is None:
+            values = np.bincount(inverse, minlength=len(labels))
+        else:
+            values = np.bincount(inverse, weights=select(extract.columns[weights]), minlength=len(labels))
+        for label, value in zip(labels, values):
+            key = tuple(_decode(extract, name, part, grain) for name, part in zip(names, label))
+            results.setdefault(key, {})[measure] = round(float(value), 2) if weights not in (None, 'visitor') else int(value)
+    return results
+
+
+def validate_query(dimensions, measures, filters, grain):
+    unknown = [name for name in [*dimensions, *filters] if name not in DIMENSIONS]
+    if unknown:
+        raise ValueError(f'Unknown dimensions: {", ".join(unknown)}')
+    if not measures:
+        raise ValueError('At least one measure is required')
+    unknown = [name for name in measures if name not in MEASURES]
+    if unknown:
+        raise ValueError(f'Unknown measures: {", ".join(unknown)}')
+    if grain is not None and grain not in GRAINS:
+        raise ValueError(f'grain must be one of: {", ".join(GRAINS)}')
+
+
+def default_start():
+    """Начало периода по умолчанию: локальная полночь DEFAULT_DAYS дней назад (устойчивый ключ кэша)"""
+    today = timezone.localdate() - timedelta(days=DEFAULT_DAYS)
+    return timezone.make_aware(datetime.combine(today, datetime.min.time()))
+
+
+def run_query(dimensions=(), measures=('visits',), filters=None, grain=None, start=None, end=None, extracts=None):
+    """
+    Выполняет запрос; возвращает строки {измерение: значение, ..., мера: значение}, отсортированные по измерениям.
+    extracts - готовые выгрузки {источник: Extract} (для бенчмарка), иначе читаются из БД.
+    """
+    dimensions = list(dimensions)
+    filters = {
+        dimension: values if isinstance(values, (list, tuple)) else [values]
+        for dimension, values in (filters or {}).items()
+    }
+    validate_query(dimensions, measures, filters, grain)
+    if start is None and extracts is None:
+        start = default_start()
+
+    wanted = set(measures)
+    if 'conversion_rate' in wanted:
+        wanted |= {'visits', 'conversions'}
+    by_source = {}
+    for measure in wanted:
+        source = MEASURES[measure][0]
+        if source:
+            by_source.setdefault(source, []).append(measure)
+
+    rows = {}
+    for source, source_measures in by_source.items():
+        columns = set(dimensions) | set(filters)
+        columns -= set(TIME_DIMENSIONS)
+        columns |= {MEASURES[measure][1] for measure in source_measures if MEASURES[measure][1]}
+        extract = extracts[source] if extracts is not None else get_extract(source, columns, start, end)
+        for key, values in _aggregate(extract, dimensions, grain, filters, source_measures).items():
+            rows.setdefault(key, {}).update(values)
+
+    names = (['period'] if grain else []) + dimensions
+    result = []
+    for key in sorted(rows, key=lambda key: tuple((part is None, part) for part in key)):
+        values = rows[key]
+        if 'conversion_rate' in measures:
+            visits = values.get('visits', 0)
+            values['conversion_rate'] = round(values.get('conversions', 0) / visits * 100, 2) if visits else 0
+        row = dict(zip(names, key))
+        row.update({measure: values.get(measure, 0) for measure in measures})
+        result.append(row)
+    return result
@@ -0,0 +1,84 @@
+from datetime import timedelta
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from rest_framework import permissions, status
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.response import Response
+
+from .analytics import run_query
+from .campaigns import UTM_FIELDS, campaign_report
+from .exports import parse_date_range
+
+CAMPAIGN_REPORT_DAYS = 30
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def admin_analytics_query(request):
+    """
+    Ad-hoc запрос к реферальной аналитике (админы и ops):
+    {"dimensions": [...], "measures": [...], "filters": {...}, "grain": "day", "date_from": "YYYY-MM-DD", "date_to": "YYYY-MM-DD"}
+    """
+    if request.user.role not in ['superadmin', 'ops']:
+        return Response({'error': 'Access denied'}, status=status.HTTP_403_FORBIDDEN)
+
+    data = request.data
+    filters = data.get('filters') or {}
+    if not isinstance(filters, dict):
+        return Response({'error': 'filters must be an object'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        start, end = parse_date_range(data.get('date_from'), data.get('date_to'))
+        rows = run_query(
+            dimensions=data.get('dimensions') or [],
+            measures=data.get('measures') or ['visits'],
+            filters=filters,
+            grain=data.get('grain'),
+            start=start,
+            end=end,
+        )
+    except (TypeError, ValueError) as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response({'rows': rows, 'count': len(rows)}, status=status.HTTP_200_OK)
+
+
+def _parse_day(value, default):
+    if not value:
+        return default
+    day = parse_date(value)
+    if day is None:
+        raise ValueError(f'Invalid date: {value}')
+    return day
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def campaign_performance(request):
+    """
+    Эффективность UTM-кампаний по дневным агрегатам (админы и ops):
+    ?dimensions=utm_source,utm_campaign&grain=week&date_from=YYYY-MM-DD&date_to=YYYY-MM-DD&utm_source=...
+    По умолчанию - по utm_campaign за последние 30 дней.
+    """
+    if request.user.role not in ['superadmin', 'ops']:
+        return Response({'error': 'Access denied'}, status=status.HTTP_403_FORBIDDEN)
+
+    params = request.query_params
+    dimensions = [name for name in params.get('dimensions', 'utm_campaign').split(',') if name]
+    filters = {field: params.getlist(field) for field in UTM_FIELDS if field in params}
+    try:
+        end_day = _parse_day(params.get('date_to'), timezone.localdate())
+        start_day = _parse_day(params.get('date_from'), end_day - timedelta(days=CAMPAIGN_REPORT_DAYS - 1))
+        if start_day > end_day:
+            raise ValueError('date_from must not be later than date_to')
+        rows = campaign_report(dimensions, start_day, end_day, grain=params.get('grain') or None, filters=filters)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response({
+        'date_from': start_day.isoformat(),
+        'date_to': end_day.isoformat(),
+        'rows': rows,
+        'count': len(rows),
+    }, status=status.HTTP_200_OK)
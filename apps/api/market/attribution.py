@@ -0,0 +1,258 @@
+"""
+Атрибуция покупок к реферальным ссылкам.
+
+Каждое записанное посещение создает или обновляет атрибуцию (anonymous_id,
+товар): последний клик побеждает, срок действия - attribution_window_days
+активной ReferralProgram от времени посещения. Окно кэшируется и сбрасывается
+при сохранении программы.
+
+Живые атрибуции хранятся в кэше Django (Redis в продакшене) ключами
+(anonymous_id, товар) и (пользователь, товар) с TTL, равным оставшемуся сроку:
+поиск при оформлении заказа - один get_many, истекшие записи исчезают сами.
+ReferralAttribution в БД - журнал для аудита, он пишется отложенно: записи
+копятся в очереди Redis и сохраняются пачкой INSERT ... ON CONFLICT DO UPDATE
+(когда очередь набирает FLUSH_BATCH_SIZE записей и командой flush_attributions).
+Без Redis кэш локален для процесса, поэтому запись в БД идет сразу. При
+промахе кэша (вытеснение, перезапуск Redis, другой процесс) поиск обращается
+к БД и прогревает кэш найденной атрибуцией.
+
+Посетитель, склеенный с пользователем или кликнувший под ним, запоминается за
+пользователем на срок окна (ключ владельца anonymous_id). Новые клики посетителя
+без входа получают этого пользователя - запись переписывает и ключ
+(пользователь, товар), он не остается на прежней атрибуции. Склейка не
+сбрасывает общую очередь: persist() так же проставляет владельца записям без
+пользователя, которые еще лежали в очереди.
+"""
+import hashlib
+import json
+import logging
+from collections import namedtuple
+from datetime import timedelta
+
+from django.apps import apps
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .redis_client import RedisError, get_client
+
+logger = logging.getLogger(__name__)
+
+WINDOW_CACHE_KEY = 'referral_program:attribution_window_days'
+WINDOW_CACHE_TTL = 300
+PENDING_QUEUE_KEY = 'attribution:pending'
+FLUSH_BATCH_SIZE = 500
+
+AttributionRecord = namedtuple(
+    'AttributionRecord',
+    ['anonymous_id', 'product_id', 'user_id', 'referral_link_id', 'last_visit_id', 'expires_at'],
+)
+
+
+def attribution_window_days():
+    """Окно атрибуции активной программы в днях; 0 - программы нет, атрибуция не ведется"""
+    days = cache.get(WINDOW_CACHE_KEY)
+    if days is None:
+        ReferralProgram = apps.get_model('market', 'ReferralProgram')
+        days = (
+            ReferralProgram.objects.filter(is_active=True).order_by('id')
+            .values_list('attribution_window_days', flat=True).first()
+        ) or 0
+        cache.set(WINDOW_CACHE_KEY, days, WINDOW_CACHE_TTL)
+    return days
+
+
+def invalidate_attribution_window():
+    cache.delete(WINDOW_CACHE_KEY)
+
+
+def _anonymous_key(anonymous_id, product_id):
+    return f'attribution:anon:{hashlib.sha1(anonymous_id.encode()).hexdigest()}:{product_id}'
+
+
+def _user_key(user_id, product_id):
+    return f'attribution:user:{user_id}:{product_id}'
+
+
+def _owner_key(anonymous_id):
+    return f'attribution:owner:{hashlib.sha1(anonymous_id.encode()).hexdigest()}'
+
+
+def _remember_owners(owners):
+    """Запоминает владельцев anonymous_id ({anonymous_id: id пользователя}) на срок окна атрибуции"""
+    if not owners:
+        return
+    days = attribution_window_days()
+    if days:
+        timeout = int(timedelta(days=days).total_seconds())
+        cache.set_many({_owner_key(anonymous_id): user_id for anonymous_id, user_id in owners.items()}, timeout)
+
+
+def assign_visitor(anonymous_id, user_id):
+    """Запоминает пользователя, с которым склеен посетитель"""
+    _remember_owners({anonymous_id: user_id})
+
+
+def _with_owners(records):
+    """Проставляет записям без пользователя владельца склеенного anonymous_id"""
+    anonymous = {record.anonymous_id for record in records if record.user_id is None}
+    if not anonymous:
+        return records
+    keys = {_owner_key(anonymous_id): anonymous_id for anonymous_id in anonymous}
+    owners = {keys[key]: user_id for key, user_id in cache.get_many(list(keys)).items()}
+    if not owners:
+        return records
+    return [
+        record._replace(user_id=owners[record.anonymous_id])
+        if record.user_id is None and record.anonymous_id in owners else record
+        for record in records
+    ]
+
+
+def remember(records):
+    """Кладет атрибуции в кэш с TTL до истечения; посетители записей с пользователем запоминаются за ним"""
+    now = timezone.now()
+    _remember_owners({record.anonymous_id: record.user_id for record in records if record.user_id is not None})
+    for record in records:
+        timeout = int((record.expires_at - now).total_seconds())
+        if timeout <= 0:
+            continue
+        entries = {_anonymous_key(record.anonymous_id, record.product_id): tuple(record)}
+        if record.user_id is not None:
+            entries[_user_key(record.user_id, record.product_id)] = tuple(record)
+        cache.set_many(entries, timeout)
+
+
+def persist(records):
+    """
+    Сохраняет атрибуции в БД одним upsert на пачку (последняя запись по ключу побеждает).
+    Пользователь переписывается, только если известен (в том числе по склейке посетителя).
+    """
+    ReferralAttribution = apps.get_model('market', 'ReferralAttribution')
+    records = _with_owners(records)
+    # ON CONFLICT не обновляет одну строку дважды за запрос
+    latest = {(record.anonymous_id, record.product_id): record for record in records}
+    groups = {True: [], False: []}
+    for record in latest.values():
+        groups[record.user_id is not None].append(ReferralAttribution(
+            anonymous_id=record.anonymous_id, product_id=record.product_id, user_id=record.user_id,
+            referral_link_id=record.referral_link_id, last_visit_id=record.last_visit_id,
+            expires_at=record.expires_at,
+        ))
+    update_fields = ['referral_link', 'last_visit', 'expires_at']
+    for with_user, attributions in groups.items():
+        if attributions:
+            ReferralAttribution.objects.bulk_create(
+                attributions, update_conflicts=True, unique_fields=['anonymous_id', 'product'],
+                update_fields=update_fields + ['user'] if with_user else update_fields,
+            )
+    return len(latest)
+
+
+def _dumps(record):
+    return json.dumps([*record[:5], record.expires_at.isoformat()])
+
+
+def _loads(raw):
+    values = json.loads(raw)
+    return AttributionRecord(*values[:5], parse_datetime(values[5]))
+
+
+def _enqueue(client, records):
+    """Ставит атрибуции в очередь записи в БД; при заполнении пачки сохраняет ее сразу"""
+    length = client.rpush(PENDING_QUEUE_KEY, *[_dumps(record) for record in records])
+    if length >= FLUSH_BATCH_SIZE:
+        try:
+            flush_pending(client, max_batches=1)
+        except Exception:
+            # Записи уже в очереди (неудачная пачка возвращается в нее) - клик не должен падать,
+            # очередь дозапишет следующая пачка или flush_attributions
+            logger.exception('Attribution queue flush failed')
+
+
+def flush_pending(client=None, batch_size=FLUSH_BATCH_SIZE, max_batches=None):
+    """Переносит очередь атрибуций из Redis в БД пачками; возвращает число записей"""
+    client = client or get_client()
+    if client is None:
+        return 0
+    flushed = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        pipe = client.pipeline(transaction=True)
+        pipe.lrange(PENDING_QUEUE_KEY, 0, batch_size - 1)
+        pipe.ltrim(PENDING_QUEUE_KEY, batch_size, -1)
+        raw, _ = pipe.execute()
+        if not raw:
+            break
+        records = [_loads(item) for item in raw]
+        try:
+            persist(records)
+        except Exception:
+            # Возвращаем пачку в начало очереди, чтобы не потерять записи
+            client.lpush(PENDING_QUEUE_KEY, *reversed(raw))
+            raise
+        flushed += len(records)
+        batches += 1
+    return flushed
+
+
+def record_attributions(entries):
+    """
+    Атрибуции по новым посещениям: entries - (посещение, id товара, id пользователя или None).
+    Посещения без товара пропускаются. Возвращает записанные AttributionRecord.
+    """
+    days = attribution_window_days()
+    if not days:
+        return []
+    records = [
+        AttributionRecord(
+            visit.anonymous_id, product_id, user_id, visit.referral_link_id, visit.pk,
+            visit.visited_at + timedelta(days=days),
+        )
+        for visit, product_id, user_id in entries
+        if product_id
+    ]
+    if not records:
+        return records
+    # Клик посетителя, известного как пользователь, обновляет и атрибуцию пользователя
+    records = _with_owners(records)
+    remember(records)
+    client = get_client()
+    if client is not None:
+        try:
+            _enqueue(client, records)
+            return records
+        except RedisError as e:
+            logger.warning(f'Redis attribution queue unavailable, writing through: {e}')
+    persist(records)
+    return records
+
+
+def find_attribution(anonymous_id, user_id, product_id):
+    """
+    Живая атрибуция товара для пользователя (приоритетнее) или анонимного посетителя.
+    Возвращает несохраненный ReferralAttribution (связи загружаются по id) или None.
+    """
+    ReferralAttribution = apps.get_model('market', 'ReferralAttribution')
+    keys = []
+    if user_id is not None:
+        keys.append(_user_key(user_id, product_id))
+    if anonymous_id:
+        keys.append(_anonymous_key(anonymous_id, product_id))
+    found = cache.get_many(keys)
+    now = timezone.now()
+    for key in keys:
+        if key in found:
+            record = AttributionRecord(*found[key])
+            if record.expires_at > now:
+                return ReferralAttribution(**record._asdict())
+    live = ReferralAttribution.objects.filter(product_id=product_id, expires_at__gt=now)
+    attribution = live.filter(user_id=user_id).first() if user_id is not None else None
+    if attribution is None and anonymous_id:
+        attribution = live.filter(anonymous_id=anonymous_id).first()
+    if attribution is not None:
+        remember([AttributionRecord(
+            attribution.anonymous_id, attribution.product_id, attribution.user_id,
+            attribution.referral_link_id, attribution.last_visit_id, attribution.expires_at,
+        )])
+    return attribution
@@ -0,0 +1,224 @@
+"""
+Бенчмарк ключевых эндпоинтов API внутри процесса (через тестовый клиент DRF).
+
+Каждый сценарий выполняется warmup + iterations раз; по замерам считаются
+пропускная способность, перцентили задержки и количество SQL-запросов.
+Аутентификация через force_authenticate, чтобы в замер не попадала проверка JWT;
+ограничение частоты реферальных эндпоинтов на время замера отключается.
+Сценарий с ответами не 2xx помечается failed и без замеров: задержка ошибки
+не сравнима с задержкой рабочего ответа.
+
+Аналитический движок (market/analytics.py) замеряется отдельно: типовые ad-hoc
+запросы над синтетическими колоночными выгрузками заданного размера в памяти.
+"""
+import itertools
+import math
+import subprocess
+import time
+from collections import Counter
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIClient
+
+from .analytics import Extract, run_query
+
+SCENARIOS = (
+    'product_list', 'featured', 'order_create', 'track_referral_visit', 'referral_analytics', 'admin_dashboard',
+)
+
+
+ANALYTICS_QUERIES = {
+    'totals': {'measures': ['visits', 'visitors', 'conversions', 'revenue']},
+    'campaign_by_weekday': {
+        'dimensions': ['utm_campaign', 'weekday'], 'measures': ['visits', 'conversions', 'conversion_rate'],
+    },
+    'daily_by_source': {'dimensions': ['utm_source'], 'grain': 'day', 'measures': ['visits', 'visitors']},
+    'top_product_by_hour': {
+        'dimensions': ['hour'], 'filters': {'product': [1, 2, 3]}, 'measures': ['visits', 'conversions', 'rewards'],
+    },
+    'by_referrer': {'dimensions': ['referrer'], 'measures': ['visits', 'conversions', 'rewards']},
+}
+ANALYTICS_CAMPAIGNS = [None, 'spring_sale', 'black_friday', 'new_arrivals', 'blogger_collab', 'retargeting']
+ANALYTICS_SOURCES = [None, 'telegram', 'instagram', 'facebook', 'google']
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(sorted_values, pct):
+    """Перцентиль методом ближайшего ранга"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def build_scenarios(dataset):
+    """
+    Сценарии: имя -> (пользователь или None, метод, URL, функция тела запроса).
+    Тело строится по номеру итерации, чтобы запросы различались, но были воспроизводимы.
+    """
+    users = dataset['users']
+    products = dataset['products']
+    links = dataset['links']
+
+    def order_payload(i):
+        product = products[i % len(products)]
+        return {
+            'customer_name': f'Benchmark {i}',
+            'customer_phone': '+998901234567',
+            'customer_address': 'Tashkent',
+            'total_amount': str(product.price_uzs),
+            'items': [{'product_id': product.id, 'quantity': 1, 'price': str(product.price_uzs)}],
+        }
+
+    def visit_payload(i):
+        link = links[i % len(links)]
+        return {'referral_code': link.code, 'product_id': link.product_id, 'user_agent': 'benchmark'}
+
+    return {
+        'product_list': (None, 'get', '/api/products/', None),
+        'featured': (None, 'get', '/api/products/featured/', None),
+        'order_create': (users[0], 'post', '/api/orders/', order_payload),
+        'track_referral_visit': (None, 'post', '/api/track-visit/', visit_payload),
+        'referral_analytics': (dataset['admin'], 'get', '/api/referral-analytics/', None),
+        'admin_dashboard': (dataset['admin'], 'get', '/api/admin/dashboard/', None),
+    }
+
+
+def failed_scenarios(results):
+    return [name for name, result in results.items() if result.get('failed')]
+
+
+def run_scenario(user, method, url, payload, iterations=50, warmup=5):
+    client = APIClient()
+    if user is not None:
+        client.force_authenticate(user)
+    call = getattr(client, method)
+    counter = itertools.count()
+
+    def request():
+        i = next(counter)
+        if payload is None:
+            return call(url)
+        return call(url, payload(i), format='json')
+
+    for _ in range(warmup):
+        request()
+
+    latencies = []
+    queries = []
+    statuses = Counter()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        with CaptureQueriesContext(connection) as captured:
+            request_started = time.perf_counter()
+            response = request()
+            latencies.append(time.perf_counter() - request_started)
+        queries.append(len(captured.captured_queries))
+        statuses[response.status_code] += 1
+    elapsed = time.perf_counter() - started
+
+    result = {
+        'url': url,
+        'method': method.upper(),
+        'iterations': iterations,
+        'status_codes': {str(code): count for code, count in sorted(statuses.items())},
+    }
+    if any(not 200 <= code < 300 for code in statuses):
+        result['failed'] = True
+        return result
+    latencies.sort()
+    return {
+        **result,
+        'throughput_rps': round(iterations / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies) * 1000, 3),
+            'p50': round(percentile(latencies, 50) * 1000, 3),
+            'p95': round(percentile(latencies, 95) * 1000, 3),
+            'p99': round(percentile(latencies, 99) * 1000, 3),
+            'max': round(latencies[-1] * 1000, 3),
+        },
+        'queries': {
+            'mean': round(sum(queries) / len(queries), 2),
+            'max': max(queries),
+        },
+    }
+
+
+def run_benchmark(dataset, scenarios=None, iterations=50, warmup=5):
+    available = build_scenarios(dataset)
+    names = scenarios or SCENARIOS
+    rest_framework = dict(settings.REST_FRAMEWORK)
+    rest_framework['DEFAULT_THROTTLE_RATES'] = {
+        scope: None for scope in rest_framework.get('DEFAULT_THROTTLE_RATES', {})
+    }
+    results = {}
+    with override_settings(REST_FRAMEWORK=rest_framework):
+        for name in names:
+            user, method, url, payload = available[name]
+            results[name] = run_scenario(user, method, url, payload, iterations=iterations, warmup=warmup)
+    return results
+
+
+def synthetic_extracts(visits, seed=0, days=30, links=50000, products=200000, conversion_rate=0.02):
+    """
+    Колоночные выгрузки посещений и вознаграждений без БД: популярность ссылок и
+    товаров по Ципфу, как в market/synthetic.py.
+    """
+    rng = np.random.default_rng(seed)
+    now = int(time.time())
+    link = np.minimum(rng.zipf(1.3, visits), links).astype(np.int64)
+    columns = {
+        'ts': now - rng.integers(0, days * 86400, visits),
+        'referral_link': link,
+        'referrer': link % (links // 5) + 1,
+        'product': (link * 7919) % products + 1,
+        'utm_source': rng.integers(0, len(ANALYTICS_SOURCES), visits).astype(np.int32),
+        'utm_medium': np.zeros(visits, dtype=np.int32),
+        'utm_campaign': rng.integers(0, len(ANALYTICS_CAMPAIGNS), visits).astype(np.int32),
+        'visitor': rng.integers(0, max(1, visits // 3), visits),
+    }
+    vocabularies = {'utm_source': ANALYTICS_SOURCES, 'utm_medium': [None], 'utm_campaign': ANALYTICS_CAMPAIGNS}
+    converted = rng.random(visits) < conversion_rate
+    order_amount = rng.integers(50, 5000, int(converted.sum())) * 1000.0
+    rewards = {name: values[converted] for name, values in columns.items() if name != 'visitor'}
+    rewards['order_amount'] = order_amount
+    rewards['reward_amount'] = order_amount * 0.05
+    return {'visits': Extract(columns, vocabularies), 'rewards': Extract(rewards, vocabularies)}
+
+
+def run_analytics_benchmark(extracts, queries=None, iterations=5, warmup=1):
+    """Задержка типовых запросов над готовыми выгрузками (без чтения из БД)"""
+    results = {}
+    for name in queries or ANALYTICS_QUERIES:
+        query = ANALYTICS_QUERIES[name]
+        for _ in range(warmup):
+            run_query(extracts=extracts, **query)
+        latencies = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            rows = run_query(extracts=extracts, **query)
+            latencies.append(time.perf_counter() - started)
+        latencies.sort()
+        results[name] = {
+            'query': query,
+            'rows': len(rows),
+            'iterations': iterations,
+            'latency_ms': {
+                'mean': round(sum(latencies) / len(latencies) * 1000, 3),
+                'p50': round(percentile(latencies, 50) * 1000, 3),
+                'max': round(latencies[-1] * 1000, 3),
+            },
+        }
+    return results
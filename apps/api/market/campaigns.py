@@ -0,0 +1,227 @@
+"""
+Эффективность UTM-кампаний по дневным агрегатам CampaignDailyStat.
+
+Каждое записанное посещение добавляет клик и посетителя (HyperLogLog-скетч)
+в строку (локальный день, пять UTM-меток). Вознаграждение - конверсия с суммой
+заказа и комиссией - учитывается в кампании посещения, к которому атрибутирована
+покупка (ReferralReward.attributed_visit), в день создания вознаграждения и
+вычитается при отмене (REVERSED). Отчет читает только дневные строки за период:
+счетчики суммируются, скетчи сливаются, ReferralVisit не сканируется.
+rebuild_day() пересчитывает день по посещениям и вознаграждениям.
+
+Чтобы клики одной кампании (и весь трафик без меток) не блокировали одну
+строку, строка дня и меток разбита на CAMPAIGN_STAT_SHARDS шардов: клик идет
+в шард по регистру скетча посетителя, вознаграждение - по своему id. Отчет
+суммирует шарды так же, как дни. rebuild_day() пишет день в шард 0.
+Модели загружаются лениво: модуль импортируется из models.py.
+"""
+from collections import defaultdict
+from datetime import datetime, time as dt_time, timedelta
+from decimal import Decimal
+
+from django.apps import apps
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, OuterRef, Subquery
+from django.utils import timezone
+
+from . import hll
+
+UTM_FIELDS = ('utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content')
+GRAINS = ('day', 'week', 'month')
+COUNTERS = ('clicks', 'conversions', 'revenue', 'commission')
+DEFAULT_SHARDS = 16
+
+
+def stat_shards():
+    return getattr(settings, 'CAMPAIGN_STAT_SHARDS', DEFAULT_SHARDS)
+
+
+def _key(values):
+    """UTM-метки -> ключ строки (NULL хранится пустой строкой)"""
+    return tuple(value or '' for value in values)
+
+
+def _apply(day, key, shard, visitor=None, **increments):
+    """Прибавляет счетчики к строке (day, key, shard) и поднимает регистр скетча посетителей"""
+    CampaignDailyStat = apps.get_model('market', 'CampaignDailyStat')
+    lookup = dict(zip(UTM_FIELDS, key), day=day, shard=shard)
+    with transaction.atomic():
+        stat = CampaignDailyStat.objects.select_for_update().filter(**lookup).only('pk', 'visitors').first()
+        if stat is None:
+            registers = hll.empty()
+            if visitor is not None:
+                registers[visitor[0]] = visitor[1]
+            try:
+                with transaction.atomic():
+                    CampaignDailyStat.objects.create(visitors=hll.dumps(registers), **lookup, **increments)
+                return
+            except IntegrityError:
+                # Строку успел создать параллельный запрос
+                stat = CampaignDailyStat.objects.select_for_update().only('pk', 'visitors').get(**lookup)
+
+        updates = {field: F(field) + value for field, value in increments.items()}
+        if visitor is not None:
+            registers = hll.loads(stat.visitors)
+            index, rank = visitor
+            if registers[index] < rank:
+                registers[index] = rank
+                updates['visitors'] = hll.dumps(registers)
+        CampaignDailyStat.objects.filter(pk=stat.pk).update(updated_at=timezone.now(), **updates)
+
+
+def record_click(visit):
+    """Учитывает посещение в дневной строке его кампании"""
+    visitor = hll.position(visit.anonymous_id)
+    # Шард по регистру: повторы посетителя попадают в строку, где его регистр уже поднят
+    _apply(
+        timezone.localdate(visit.visited_at), _key(getattr(visit, field) for field in UTM_FIELDS),
+        visitor[0] % stat_shards(), visitor=visitor, clicks=1,
+    )
+
+
+def _reward_key(reward):
+    """Метки посещения вознаграждения; без посещения (или если оно удалено) - строка без меток"""
+    values = None
+    if reward.attributed_visit_id is not None:
+        ReferralVisit = apps.get_model('market', 'ReferralVisit')
+        values = ReferralVisit.objects.filter(pk=reward.attributed_visit_id).values_list(*UTM_FIELDS).first()
+    return _key(values or (None,) * len(UTM_FIELDS))
+
+
+def record_reward_change(reward, sign):
+    """
+    Учитывает создание вознаграждения (sign=1) или его отмену/восстановление (-1/+1);
+    sign - ReferralReward.counted_change()
+    """
+    if not sign:
+        return
+    _apply(
+        timezone.localdate(reward.created_at), _reward_key(reward), reward.pk % stat_shards(),
+        conversions=sign, revenue=sign * Decimal(reward.order_amount), commission=sign * Decimal(reward.reward_amount),
+    )
+
+
+def backfill_attributed_visits(batch_size=1000):
+    """
+    Заполняет attributed_visit у вознаграждений, созданных без него: последнее посещение
+    атрибуции покупателя заказа по ссылке и товару. Возвращает количество заполненных.
+    """
+    ReferralAttribution = apps.get_model('market', 'ReferralAttribution')
+    ReferralReward = apps.get_model('market', 'ReferralReward')
+    last_visit = ReferralAttribution.objects.filter(
+        referral_link=OuterRef('referral_link'), product=OuterRef('product'), user=OuterRef('order__user'),
+    ).order_by('-expires_at').values('last_visit_id')[:1]
+    found = (
+        ReferralReward.objects.filter(attributed_visit__isnull=True)
+        .annotate(visit_id=Subquery(last_visit)).filter(visit_id__isnull=False)
+        .order_by('pk').values_list('pk', 'visit_id')
+    )
+    updated = 0
+    batch = []
+    for pk, visit_id in found.iterator(chunk_size=batch_size):
+        batch.append(ReferralReward(pk=pk, attributed_visit_id=visit_id))
+        if len(batch) >= batch_size:
+            updated += ReferralReward.objects.bulk_update(batch, ['attributed_visit'])
+            batch = []
+    if batch:
+        updated += ReferralReward.objects.bulk_update(batch, ['attributed_visit'])
+    return updated
+
+
+def _day_bounds(day):
+    start = timezone.make_aware(datetime.combine(day, dt_time.min))
+    return start, timezone.make_aware(datetime.combine(day + timedelta(days=1), dt_time.min))
+
+
+def rebuild_day(day):
+    """Пересчитывает строки дня по посещениям и вознаграждениям. Возвращает количество строк."""
+    CampaignDailyStat = apps.get_model('market', 'CampaignDailyStat')
+    ReferralVisit = apps.get_model('market', 'ReferralVisit')
+    ReferralReward = apps.get_model('market', 'ReferralReward')
+    start, end = _day_bounds(day)
+    stats = defaultdict(lambda: {'clicks': 0, 'conversions': 0, 'revenue': Decimal(0), 'commission': Decimal(0),
+                                 'registers': hll.empty()})
+
+    visits = ReferralVisit.objects.filter(visited_at__gte=start, visited_at__lt=end).values_list('anonymous_id', *UTM_FIELDS)
+    for anonymous_id, *utm in visits.iterator(chunk_size=5000):
+        stat = stats[_key(utm)]
+        stat['clicks'] += 1
+        index, rank = hll.position(anonymous_id)
+        if stat['registers'][index] < rank:
+            stat['registers'][index] = rank
+
+    rewards = (
+        ReferralReward.objects.filter(created_at__gte=start, created_at__lt=end).exclude(status='REVERSED')
+        .values_list('order_amount', 'reward_amount', *(f'attributed_visit__{field}' for field in UTM_FIELDS))
+    )
+    for order_amount, reward_amount, *utm in rewards.iterator(chunk_size=5000):
+        stat = stats[_key(utm)]
+        stat['conversions'] += 1
+        stat['revenue'] += order_amount
+        stat['commission'] += reward_amount
+
+    with transaction.atomic():
+        CampaignDailyStat.objects.filter(day=day).delete()
+        CampaignDailyStat.objects.bulk_create([
+            CampaignDailyStat(
+                day=day, visitors=hll.dumps(stat.pop('registers')), **dict(zip(UTM_FIELDS, key)), **stat,
+            )
+            for key, stat in stats.items()
+        ], batch_size=500)
+    return len(stats)
+
+
+def _period(day, grain):
+    if grain == 'week':
+        return day - timedelta(days=day.weekday())
+    if grain == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def campaign_report(dimensions, start_day, end_day, grain=None, filters=None):
+    """
+    Показатели по UTM-измерениям dimensions (и периодам grain) за дни [start_day, end_day].
+    filters - {UTM-поле: значение или список}; пустая строка - метка не задана.
+    """
+    unknown = [name for name in [*dimensions, *(filters or {})] if name not in UTM_FIELDS]
+    if unknown:
+        raise ValueError(f'Unknown dimensions: {", ".join(unknown)}')
+    if grain is not None and grain not in GRAINS:
+        raise ValueError(f'grain must be one of: {", ".join(GRAINS)}')
+
+    CampaignDailyStat = apps.get_model('market', 'CampaignDailyStat')
+    stats = CampaignDailyStat.objects.filter(day__gte=start_day, day__lte=end_day)
+    for field, values in (filters or {}).items():
+        stats = stats.filter(**{f'{field}__in': values if isinstance(values, (list, tuple)) else [values]})
+
+    groups = {}
+    for row in stats.values_list('day', *dimensions, *COUNTERS, 'visitors').iterator(chunk_size=2000):
+        day, labels = row[0], row[1:1 + len(dimensions)]
+        counters, visitors = row[1 + len(dimensions):-1], row[-1]
+        key = ((_period(day, grain),) if grain else ()) + labels
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = [0, 0, Decimal(0), Decimal(0), hll.empty()]
+        for i, value in enumerate(counters):
+            group[i] += value
+        group[4] = hll.merge(group[4], hll.loads(visitors))
+
+    names = (['period'] if grain else []) + list(dimensions)
+    report = []
+    for key in sorted(groups):
+        clicks, conversions, revenue, commission, registers = groups[key]
+        row = dict(zip(names, key))
+        if grain:
+            row['period'] = row['period'].isoformat()
+        row.update({
+            'clicks': clicks,
+            'unique_visitors': hll.estimate(registers),
+            'conversions': conversions,
+            'conversion_rate': round(conversions / clicks * 100, 2) if clicks else 0,
+            'revenue': float(revenue),
+            'commission': float(commission),
+        })
+        report.append(row)
+    return report
@@ -0,0 +1,321 @@
+"""
+Пакетный импорт и выгрузка каталога продавца (CSV/JSONL + zip с изображениями).
+
+Импорт читает файл потоково, проверяет каждую строку CatalogRowSerializer и
+сохраняет товары пачками через bulk_create(update_conflicts=True):
+строки с артикулом (sku) обновляют товар продавца с тем же артикулом,
+строки без артикула - товар продавца с тем же slug (существующие товары
+блокируются и проверяются на владельца, slug другого продавца - ошибка строки,
+новые вставляются без перезаписи при конфликте). Пустые ячейки CSV,
+null и отсутствующие ключи JSONL не перезаписывают существующие значения,
+поэтому для обновления остатков достаточно sku и stock; title и price_uzs
+обязательны только для новых товаров.
+Изображения из zip сохраняются в хранилище параллельно и заменяют фото
+товара; без архива колонка images игнорируется. Ошибки возвращаются построчно, валидные строки сохраняются.
+"""
+import codecs
+import csv
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import BadZipFile, ZipFile
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import Prefetch
+
+from .exports import EXPORT_CHUNK_SIZE
+from .models import Category, Product, ProductImage
+from .serializers import CatalogRowSerializer
+from .slugs import MAX_ATTEMPTS, allocate_slugs, unique_slug
+
+CATALOG_COLUMNS = [
+    'sku', 'slug', 'title', 'description', 'price_uzs', 'stock', 'is_active',
+    'category', 'referral_commission', 'referral_enabled', 'images',
+]
+# Поля товара, которые можно задать из файла
+PRODUCT_FIELDS = [
+    'title', 'description', 'price_uzs', 'stock', 'is_active', 'category',
+    'referral_commission', 'referral_enabled',
+]
+# Поля, без которых товар нельзя создать
+NEW_PRODUCT_FIELDS = ['title', 'price_uzs']
+IMAGE_SEPARATOR = '|'
+IMPORT_BATCH_SIZE = 500
+IMAGE_WORKERS = 8
+MAX_REPORTED_ERRORS = 1000
+
+
+class CatalogImportError(Exception):
+    """Файл целиком не может быть обработан (формат, архив)"""
+
+
+def _split_images(row):
+    if isinstance(row.get('images'), str):
+        row['images'] = [name for name in row['images'].split(IMAGE_SEPARATOR) if name]
+    return row
+
+
+def read_rows(fileobj, input_format):
+    """Генерирует (номер строки, словарь) из CSV или JSONL, не загружая файл целиком"""
+    text = codecs.getreader('utf-8-sig')(fileobj)
+    if input_format == 'csv':
+        for line_no, row in enumerate(csv.DictReader(text), start=2):
+            # Пустая ячейка - значение не передано
+            yield line_no, _split_images({key: value for key, value in row.items() if key and value not in ('', None)})
+    elif input_format == 'jsonl':
+        for line_no, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_no, e
+                continue
+            if not isinstance(row, dict):
+                yield line_no, ValueError('Строка должна быть JSON-объектом')
+                continue
+            yield line_no, _split_images({key: value for key, value in row.items() if value is not None})
+    else:
+        raise CatalogImportError(f'Unsupported format: {input_format}')
+
+
+class CatalogImport:
+    """Один импорт файла продавца; результат в report()"""
+
+    def __init__(self, vendor, images_zip=None, batch_size=IMPORT_BATCH_SIZE):
+        self.vendor = vendor
+        self.batch_size = batch_size
+        self.created = 0
+        self.updated = 0
+        self.images = 0
+        self.errors = []
+        self.error_count = 0
+        self.categories = {}
+        for category_id, slug, name in Category.objects.values_list('id', 'slug', 'name'):
+            self.categories[slug] = category_id
+            self.categories.setdefault(name.lower(), category_id)
+        self.archive = None
+        if images_zip is not None:
+            try:
+                self.archive = ZipFile(images_zip)
+            except BadZipFile:
+                raise CatalogImportError('images must be a zip archive')
+            self.archive_names = {os.path.basename(name): name for name in self.archive.namelist() if not name.endswith('/')}
+
+    def error(self, line_no, row, errors):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            key = row.get('sku') or row.get('slug') if isinstance(row, dict) else None
+            self.errors.append({'line': line_no, 'key': key, 'errors': errors})
+
+    def run(self, rows):
+        batch = []
+        for line_no, row in rows:
+            cleaned = self.validate(line_no, row)
+            if cleaned is None:
+                continue
+            batch.append((line_no, cleaned))
+            if len(batch) >= self.batch_size:
+                self.flush(batch)
+                batch = []
+        if batch:
+            self.flush(batch)
+        return self.report()
+
+    def report(self):
+        return {
+            'created': self.created,
+            'updated': self.updated,
+            'images': self.images,
+            'error_count': self.error_count,
+            'errors': self.errors,
+        }
+
+    def validate(self, line_no, row):
+        if isinstance(row, Exception):
+            self.error(line_no, {}, {'non_field_errors': [str(row)]})
+            return None
+        serializer = CatalogRowSerializer(data=row)
+        if not serializer.is_valid():
+            self.error(line_no, row, serializer.errors)
+            return None
+        cleaned = dict(serializer.validated_data)
+        if 'category' in cleaned:
+            category_id = self.categories.get(cleaned['category']) or self.categories.get(cleaned['category'].lower())
+            if category_id is None:
+                self.error(line_no, row, {'category': ['Неизвестная категория']})
+                return None
+            cleaned['category'] = category_id
+        if self.archive is None:
+            # Без архива колонка images игнорируется: фото товара не меняются
+            cleaned.pop('images', None)
+        missing = [name for name in cleaned.get('images', []) if name not in self.archive_names]
+        if missing:
+            self.error(line_no, row, {'images': [f'Нет в архиве: {", ".join(missing)}']})
+            return None
+        return cleaned
+
+    def _product(self, row):
+        # Строке существующего товара без цены нужно значение для NOT NULL в INSERT;
+        # при конфликте обновляются только переданные поля, так что цена не меняется
+        product = Product(vendor=self.vendor, sku=row.get('sku'), slug=row['slug'], price_uzs=0)
+        for field in PRODUCT_FIELDS:
+            if field in row:
+                setattr(product, 'category_id' if field == 'category' else field, row[field])
+        return product
+
+    def flush(self, batch):
+        # Последняя строка с тем же ключом побеждает (ON CONFLICT не обновляет строку дважды)
+        by_key = {}
+        for line_no, row in batch:
+            key = ('sku', row['sku']) if row.get('sku') else ('slug', row['slug'])
+            if key in by_key:
+                self.error(by_key[key][0], by_key[key][1], {'non_field_errors': [f'Повторяется в строке {line_no}']})
+            by_key[key] = (line_no, row)
+
+        groups = {}
+        for (kind, key), (line_no, row) in by_key.items():
+            provided = tuple(field for field in PRODUCT_FIELDS if field in row)
+            groups.setdefault((kind, provided), []).append((line_no, row))
+
+        for (kind, provided), rows in groups.items():
+            self.upsert(kind, provided, rows)
+
+    def _existing(self, kind, rows):
+        """Ключ -> slug уже существующих товаров"""
+        if kind == 'sku':
+            existing = Product.objects.filter(vendor=self.vendor, sku__in=[row['sku'] for _, row in rows])
+            return dict(existing.values_list('sku', 'slug'))
+        existing = Product.objects.filter(slug__in=[row['slug'] for _, row in rows])
+        return {slug: slug for slug in existing.values_list('slug', flat=True)}
+
+    def upsert(self, kind, provided, rows):
+        update_fields = list(provided) + ['updated_at']
+        unique_fields = ['vendor', 'sku'] if kind == 'sku' else ['slug']
+        existing = self._existing(kind, rows)
+
+        accepted = []
+        for line_no, row in rows:
+            missing_fields = [field for field in NEW_PRODUCT_FIELDS if row[kind] not in existing and field not in row]
+            if missing_fields:
+                self.error(line_no, row, {field: ['Обязательное поле для нового товара'] for field in missing_fields})
+            else:
+                accepted.append((line_no, row))
+        rows = accepted
+        if not rows:
+            return
+
+        # Новым товарам без slug выделяются slug из названий (один запрос на название)
+        generated = set()
+        missing = []
+        for line_no, row in rows:
+            if not row.get('slug'):
+                if row[kind] in existing:
+                    row['slug'] = existing[row[kind]]
+                else:
+                    missing.append(row)
+                    generated.add(line_no)
+        for row, slug in zip(missing, allocate_slugs([row['title'] for row in missing])):
+            row['slug'] = slug
+
+        def upsert_rows(chunk):
+            return list(zip(chunk, Product.objects.bulk_create(
+                [self._product(row) for _, row in chunk],
+                update_conflicts=True, unique_fields=unique_fields, update_fields=update_fields,
+            )))
+
+        def save(chunk):
+            """Сохраняет строки; возвращает ([(строка, товар)], строки со slug другого продавца)"""
+            with transaction.atomic():
+                if kind == 'sku':
+                    return upsert_rows(chunk), []
+                # ON CONFLICT (slug) DO UPDATE не проверяет продавца: существующие товары
+                # блокируются и проверяются, новые вставляются без обработки конфликта -
+                # slug, занятый параллельно другим продавцом, дает IntegrityError, а не перезапись
+                owners = dict(
+                    Product.objects.select_for_update().filter(slug__in=[row['slug'] for _, row in chunk])
+                    .values_list('slug', 'vendor_id')
+                )
+                owned = [item for item in chunk if owners.get(item[1]['slug']) == self.vendor.pk]
+                new = [item for item in chunk if item[1]['slug'] not in owners]
+                foreign = [item for item in chunk if owners.get(item[1]['slug']) not in (None, self.vendor.pk)]
+                saved = upsert_rows(owned) if owned else []
+                if new:
+                    saved += zip(new, Product.objects.bulk_create([self._product(row) for _, row in new]))
+                return saved, foreign
+
+        def report_foreign(foreign):
+            for line_no, row in foreign:
+                self.error(line_no, row, {'slug': ['slug занят товаром другого продавца']})
+
+        try:
+            saved, foreign = save(rows)
+            report_foreign(foreign)
+        except IntegrityError:
+            # Конфликт по другому ограничению (например, slug) - сохраняем построчно, чтобы найти виновника
+            saved = []
+            for line_no, row in rows:
+                for attempt in range(MAX_ATTEMPTS):
+                    try:
+                        row_saved, foreign = save([(line_no, row)])
+                        saved += row_saved
+                        report_foreign(foreign)
+                        break
+                    except IntegrityError as e:
+                        if line_no not in generated or attempt == MAX_ATTEMPTS - 1:
+                            self.error(line_no, row, {'non_field_errors': [f'Конфликт уникальности: {e}']})
+                            break
+                        # Выделенный slug успели занять - берем следующий свободный
+                        row['slug'] = unique_slug(row['title'])
+
+        for (_, row), _ in saved:
+            if row[kind] in existing:
+                self.updated += 1
+            else:
+                self.created += 1
+        self.attach_images([(product, row['images']) for (_, row), product in saved if row.get('images')])
+
+    def attach_images(self, items):
+        """Сохраняет файлы параллельно и заменяет фото товаров"""
+        if not items:
+            return
+        field = ProductImage._meta.get_field('image')
+
+        def store(name):
+            data = self.archive.read(self.archive_names[name])
+            return default_storage.save(field.generate_filename(None, name), ContentFile(data))
+
+        uploads = [(product, position, name) for product, names in items for position, name in enumerate(names)]
+        with ThreadPoolExecutor(max_workers=IMAGE_WORKERS) as pool:
+            stored = list(pool.map(store, [name for _, _, name in uploads]))
+
+        with transaction.atomic():
+            ProductImage.objects.filter(product_id__in=[product.pk for product, _ in items]).delete()
+            ProductImage.objects.bulk_create([
+                ProductImage(product_id=product.pk, image=path, alt=product.title, sort_order=position)
+                for (product, position, _), path in zip(uploads, stored)
+            ])
+        self.images += len(stored)
+
+
+def import_catalog(vendor, fileobj, input_format, images_zip=None, batch_size=IMPORT_BATCH_SIZE):
+    """Импортирует каталог продавца; возвращает отчет (создано/обновлено/ошибки по строкам)"""
+    job = CatalogImport(vendor, images_zip=images_zip, batch_size=batch_size)
+    return job.run(read_rows(fileobj, input_format))
+
+
+def catalog_rows(vendor):
+    """Строки выгрузки каталога продавца в порядке CATALOG_COLUMNS (формат совместим с импортом)"""
+    products = (
+        Product.objects.filter(vendor=vendor).select_related('category').order_by('id')
+        .prefetch_related(Prefetch('photos', queryset=ProductImage.objects.order_by('sort_order', 'id')))
+    )
+    for product in products.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield [
+            product.sku, product.slug, product.title, product.description, product.price_uzs,
+            product.stock, product.is_active, product.category.slug if product.category else None,
+            product.referral_commission, product.referral_enabled,
+            IMAGE_SEPARATOR.join(os.path.basename(photo.image.name) for photo in product.photos.all()),
+        ]
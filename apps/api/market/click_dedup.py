@@ -0,0 +1,169 @@
+"""
+Дедупликация повторных кликов при приеме посещений.
+
+Повторный переход того же посетителя (anonymous_id) по той же ссылке в пределах
+окна CLICK_DEDUP_WINDOW_SECONDS не создает ReferralVisit, а только увеличивает
+ReferralLink.repeat_clicks. Клики запоминаются в фильтре Блума на каждое окно
+(ключ содержит номер окна, фильтр прошлого окна просто выбрасывается):
+в Redis - битовая карта с атомарной проверкой-и-добавлением Lua-скриптом,
+без Redis - в памяти процесса.
+
+Размер фильтра рассчитывается по ожидаемому числу кликов за окно
+(CLICK_DEDUP_CAPACITY) и допустимой доле ложных срабатываний
+(CLICK_DEDUP_ERROR_RATE) - это доля новых кликов, ошибочно принятых за повтор.
+"""
+import hashlib
+import logging
+import math
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+
+from .profiling import METRIC_PREFIX
+from .redis_client import RedisError, get_client
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WINDOW_SECONDS = 1800
+DEFAULT_CAPACITY = 1_000_000
+DEFAULT_ERROR_RATE = 0.001
+REDIS_RETRY_SECONDS = 30
+
+# KEYS[1] - битовая карта окна, ARGV[1] - TTL, далее номера битов.
+# Возвращает 1, если все биты уже были установлены (повтор).
+CHECK_AND_ADD_SCRIPT = """
+local seen = 1
+for i = 2, #ARGV do
+    if redis.call('SETBIT', KEYS[1], ARGV[i], 1) == 0 then
+        seen = 0
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return seen
+"""
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def filter_size(capacity, error_rate):
+    """(бит в фильтре, число хэш-функций) для capacity элементов при доле ложных срабатываний error_rate"""
+    bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    return bits, max(1, round(bits / capacity * math.log(2)))
+
+
+def bit_positions(item, bits, hashes):
+    # Двойное хэширование: h1 + i * h2 из одного 128-битного blake2b
+    digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'big')
+    h2 = int.from_bytes(digest[8:], 'big') | 1
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+
+class BloomFilter:
+    def __init__(self, bits, hashes):
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray((bits + 7) // 8)
+
+    def check_and_add(self, item):
+        """True, если элемент (вероятно) уже был добавлен"""
+        seen = True
+        for position in bit_positions(item, self.bits, self.hashes):
+            byte, mask = position >> 3, 1 << (position & 7)
+            if not self.data[byte] & mask:
+                seen = False
+                self.data[byte] |= mask
+        return seen
+
+
+class LocalWindows:
+    """Фильтр текущего окна в памяти процесса"""
+
+    def __init__(self, bits, hashes):
+        self.bits = bits
+        self.hashes = hashes
+        self._window = None
+        self._filter = None
+        self._lock = threading.Lock()
+
+    def check_and_add(self, window, item):
+        with self._lock:
+            if window != self._window:
+                self._window = window
+                self._filter = BloomFilter(self.bits, self.hashes)
+            return self._filter.check_and_add(item)
+
+
+class RedisWindows:
+    """Битовые карты окон в Redis; при ошибке Redis временно переключается на LocalWindows"""
+
+    def __init__(self, client, bits, hashes, window_seconds, fallback):
+        self.client = client
+        self.script = self.client.register_script(CHECK_AND_ADD_SCRIPT)
+        self.bits = bits
+        self.hashes = hashes
+        self.ttl = window_seconds * 2
+        self.fallback = fallback
+        self.retry_at = 0.0
+
+    def check_and_add(self, window, item):
+        now = time.monotonic()
+        if now >= self.retry_at:
+            try:
+                return bool(self.script(
+                    keys=[f'click_dedup:{window}'],
+                    args=[self.ttl, *bit_positions(item, self.bits, self.hashes)],
+                ))
+            except RedisError as e:
+                logger.warning(f'Redis click dedup unavailable, using in-process filter: {e}')
+                self.retry_at = now + REDIS_RETRY_SECONDS
+        return self.fallback.check_and_add(window, item)
+
+
+_windows = None
+_windows_lock = threading.Lock()
+
+
+def window_seconds():
+    return getattr(settings, 'CLICK_DEDUP_WINDOW_SECONDS', DEFAULT_WINDOW_SECONDS)
+
+
+def get_windows():
+    global _windows
+    with _windows_lock:
+        if _windows is None:
+            bits, hashes = filter_size(
+                getattr(settings, 'CLICK_DEDUP_CAPACITY', DEFAULT_CAPACITY),
+                getattr(settings, 'CLICK_DEDUP_ERROR_RATE', DEFAULT_ERROR_RATE),
+            )
+            local = LocalWindows(bits, hashes)
+            client = get_client()
+            _windows = RedisWindows(client, bits, hashes, window_seconds(), local) if client is not None else local
+        return _windows
+
+
+def is_repeat_click(anonymous_id, link_id, now=None):
+    """Запоминает клик; True, если этот посетитель уже переходил по ссылке в текущем окне"""
+    if window_seconds() <= 0 or not anonymous_id:
+        return False
+    window = int((now if now is not None else time.time()) // window_seconds())
+    repeat = get_windows().check_and_add(window, f'{link_id}:{anonymous_id}')
+    with _stats_lock:
+        _stats['repeat' if repeat else 'new'] += 1
+    return repeat
+
+
+def render():
+    """Счетчики дедупликации текущего процесса в формате Prometheus"""
+    metric = f'{METRIC_PREFIX}_referral_clicks_total'
+    lines = [
+        f'# HELP {metric} Referral clicks by dedup result (repeat clicks skip the visit insert)',
+        f'# TYPE {metric} counter',
+    ]
+    with _stats_lock:
+        for result, count in sorted(_stats.items()):
+            lines.append(f'{metric}{{result="{result}"}} {count}')
+    return '\n'.join(lines) + '\n'
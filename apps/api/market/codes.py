@@ -0,0 +1,147 @@
+"""
+Короткие уникальные коды: Order.public_id, User.referral_code, ReferralLink.code.
+
+Код - это номер из последовательности, переставленный обратимой сетью Фейстеля
+(ключ хранится в CodeSequence) и записанный 9 символами base32 Крокфорда.
+Перестановка биективна, поэтому разные номера дают разные коды без проверочных
+запросов exists(); соседние номера не угадываются по коду.
+
+Номера выдаются блоками по BLOCK_SIZE на процесс: на PostgreSQL - nextval()
+нативной последовательности (не откатывается вместе с транзакцией), на других
+СУБД - атомарный сдвиг CodeSequence.next_value. Длина 9 символов не пересекается
+со старыми 8-символьными кодами из uuid4.
+"""
+import hashlib
+import os
+import secrets
+import threading
+
+from django.apps import apps
+from django.db import connection, transaction
+from django.db.models import F
+
+CODE_NAMES = ('user', 'order', 'referral_link')
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+CODE_LENGTH = 9
+HALF_BITS = 22  # 44 бита помещаются в 9 символов base32 (45 бит)
+HALF_MASK = (1 << HALF_BITS) - 1
+MAX_VALUE = 1 << (2 * HALF_BITS)
+ROUNDS = 4
+BLOCK_SIZE = 100  # Совпадает с INCREMENT BY последовательностей в миграции
+
+_lock = threading.Lock()
+_keys = {}
+_blocks = {}
+
+
+def sequence_name(name):
+    return f'market_code_{name}'
+
+
+def _round(key, round_no, half):
+    digest = hashlib.blake2b(bytes([round_no]) + half.to_bytes(3, 'big'), key=key, digest_size=4).digest()
+    return int.from_bytes(digest, 'big') & HALF_MASK
+
+
+def permute(key, value):
+    left, right = value >> HALF_BITS, value & HALF_MASK
+    for round_no in range(ROUNDS):
+        left, right = right, left ^ _round(key, round_no, right)
+    return left << HALF_BITS | right
+
+
+def unpermute(key, value):
+    left, right = value >> HALF_BITS, value & HALF_MASK
+    for round_no in reversed(range(ROUNDS)):
+        left, right = right ^ _round(key, round_no, left), left
+    return left << HALF_BITS | right
+
+
+def encode(key, value):
+    if not 0 <= value < MAX_VALUE:
+        raise OverflowError(f'Code sequence value out of range: {value}')
+    value = permute(key, value)
+    chars = []
+    for _ in range(CODE_LENGTH):
+        value, rem = divmod(value, 32)
+        chars.append(ALPHABET[rem])
+    return ''.join(reversed(chars))
+
+
+def decode(key, code):
+    """Номер последовательности по коду (ValueError, если код не из этого алфавита)"""
+    if len(code) != CODE_LENGTH:
+        raise ValueError('Invalid code length')
+    value = 0
+    for char in code.upper():
+        value = value * 32 + ALPHABET.index(char)
+    if value >= MAX_VALUE:
+        raise ValueError('Invalid code')
+    return unpermute(key, value)
+
+
+def _sequence(name):
+    if name not in CODE_NAMES:
+        raise ValueError(f'Unknown code sequence: {name}')
+    CodeSequence = apps.get_model('market', 'CodeSequence')
+    sequence, _ = CodeSequence.objects.get_or_create(name=name, defaults={'key': secrets.token_hex(16)})
+    return sequence
+
+
+def _key(name):
+    key = _keys.get(name)
+    if key is None:
+        key = _keys[name] = bytes.fromhex(_sequence(name).key)
+    return key
+
+
+def _reserve_blocks(name, count):
+    """Начала count новых блоков по BLOCK_SIZE номеров"""
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT nextval(%s) FROM generate_series(1, %s)', [sequence_name(name), count])
+            return [row[0] for row in cursor.fetchall()]
+    CodeSequence = apps.get_model('market', 'CodeSequence')
+    sequence = CodeSequence.objects.filter(name=name)
+    with transaction.atomic():
+        if not sequence.update(next_value=F('next_value') + count * BLOCK_SIZE):
+            _sequence(name)
+            sequence.update(next_value=F('next_value') + count * BLOCK_SIZE)
+        end = sequence.values_list('next_value', flat=True).get()
+    return list(range(end - count * BLOCK_SIZE, end, BLOCK_SIZE))
+
+
+def _can_keep_block():
+    # Сдвиг счетчика внутри внешней транзакции может откатиться, и тот же блок
+    # получит другой процесс - такой остаток блока не сохраняем
+    return connection.vendor == 'postgresql' or not connection.in_atomic_block
+
+
+def reserve_values(name, count):
+    """count новых номеров последовательности (хвост последнего блока отбрасывается)"""
+    starts = _reserve_blocks(name, -(-count // BLOCK_SIZE)) if count > 0 else []
+    return [value for start in starts for value in range(start, start + BLOCK_SIZE)][:count]
+
+
+def reserve_codes(name, count):
+    """Пачка кодов для bulk_create"""
+    key = _key(name)
+    return [encode(key, value) for value in reserve_values(name, count)]
+
+
+def allocate_code(name):
+    """Следующий код из блока текущего процесса"""
+    key = _key(name)
+    with _lock:
+        pid, block = _blocks.get(name, (None, None))
+        # После fork блок родителя у дочернего процесса недействителен
+        if pid != os.getpid() or not block:
+            values = reserve_values(name, BLOCK_SIZE)
+            value = values.pop(0)
+            if _can_keep_block():
+                _blocks[name] = (os.getpid(), values)
+            else:
+                _blocks.pop(name, None)
+        else:
+            value = block.pop(0)
+    return encode(key, value)
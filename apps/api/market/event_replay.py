@@ -0,0 +1,330 @@
+"""
+Пересчет производных счетчиков по журналу ReferralEvent.
+
+Один проход по журналу в порядке (referrer_id, id), пачками по ключу, до id,
+последнего на момент запуска. По каждому рефереру восстанавливаются
+ReferralLink.total_clicks / total_conversions / total_rewards (вознаграждения
+без REVERSED) и все поля ReferralBalance по правилам ReferralBalance.update_balance().
+Переписываются только разошедшиеся строки; у рефереров без событий счетчики
+обнуляются. Рефереры разбиты на диапазоны id, диапазоны обрабатываются в
+процессах параллельно (на SQLite - в одном процессе).
+
+repeat_clicks в журнал не попадает и не пересчитывается. Product.total_referral_sales
+зависит от подтверждения заказов, поэтому в конце прохода его пересчитывает
+update_sales_counters() (market/ranking.py).
+
+Изменения счетчиков, сделанные во время прохода, могут быть перезаписаны -
+запускать в спокойное время.
+
+Журнал пишется с момента выкладки, поэтому история до нее дописывается один раз
+backfill_events(): посещения и вознаграждения с id меньше первого залогированного
+(события переходов и конверсий пишутся только при создании, id растут), атрибуции
+по посещениям до той же границы, выплаты без единого события. Завершение отмечается
+строкой RetentionCheckpoint(job=BACKFILL_JOB); без нее replay_events() не запускается -
+пересчет по неполному журналу обнулил бы исторические счетчики и балансы.
+"""
+import math
+import multiprocessing
+from collections import Counter, defaultdict
+from decimal import Decimal
+
+from django.db import connection, connections, transaction
+from django.db.models import Exists, Max, Min, OuterRef, Q
+from django.utils import timezone
+
+from .attribution import AttributionRecord
+from .models import (
+    ReferralAttribution, ReferralBalance, ReferralEvent, ReferralLink, ReferralPayout,
+    ReferralReward, ReferralVisit, RetentionCheckpoint, User,
+)
+from .ranking import update_sales_counters
+from .referral_events import (
+    attribution_event, click_event, conversion_event, log_events, payout_event, reward_state_event,
+)
+
+BATCH_SIZE = 1000
+BACKFILL_JOB = 'backfill_referral_events'
+SHARDS_PER_WORKER = 4  # Диапазонов больше, чем процессов, - нагрузка распределяется ровнее
+
+LINK_FIELDS = ['total_clicks', 'total_conversions', 'total_rewards']
+BALANCE_FIELDS = ['total_earned', 'locked_amount', 'available_amount', 'total_paid_out']
+ZERO_LINK = (0, 0, Decimal('0'))
+ZERO_BALANCE = (Decimal('0'),) * 4
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class ReferrerState:
+    """Состояние одного реферера при проигрывании его событий"""
+
+    def __init__(self):
+        self.clicks = Counter()
+        self.rewards = {}   # id вознаграждения -> [ссылка, сумма, статус, сумма на балансе]
+        self.payouts = {}   # id выплаты -> (статус, сумма)
+        self.orphans = 0    # Состояния вознаграждений без конверсии
+
+    def apply(self, kind, link_id, object_id, status, amount):
+        if kind == ReferralEvent.CLICK:
+            self.clicks[link_id] += 1
+        elif kind == ReferralEvent.CONVERSION:
+            self.rewards[object_id] = [link_id, amount, 'PENDING', amount]
+        elif kind == ReferralEvent.REWARD_STATE:
+            reward = self.rewards.get(object_id)
+            if reward is None:
+                self.orphans += 1
+            else:
+                reward[2:] = [status, amount]
+        elif kind == ReferralEvent.PAYOUT:
+            self.payouts[object_id] = (status, amount)
+
+    def links(self):
+        counters = {link_id: [clicks, 0, Decimal('0')] for link_id, clicks in self.clicks.items()}
+        for link_id, reward_amount, status, _ in self.rewards.values():
+            if status == 'REVERSED':
+                continue
+            link = counters.setdefault(link_id, [0, 0, Decimal('0')])
+            link[1] += 1
+            link[2] += reward_amount
+        return {link_id: tuple(values) for link_id, values in counters.items()}
+
+    def balance(self):
+        earned = locked = available = paid_out = Decimal('0')
+        for _, reward_amount, status, held in self.rewards.values():
+            earned += reward_amount
+            if status == 'PENDING':
+                locked += held
+            elif status == 'APPROVED':
+                available += held
+        for status, amount in self.payouts.values():
+            if status == 'COMPLETED':
+                paid_out += amount
+        return earned, locked, available, paid_out
+
+
+def _stream(lo, hi, upto, chunk_size):
+    """События рефереров [lo, hi) по порядку, пачками по ключу (referrer_id, id)"""
+    events = ReferralEvent.objects.filter(referrer_id__gte=lo, referrer_id__lt=hi, id__lte=upto)
+    after = None
+    while True:
+        page = events
+        if after is not None:
+            page = page.filter(Q(referrer_id__gt=after[0]) | Q(referrer_id=after[0], id__gt=after[1]))
+        rows = list(
+            page.order_by('referrer_id', 'id')
+            .values_list('referrer_id', 'id', 'kind', 'referral_link_id', 'object_id', 'status', 'amount')[:chunk_size]
+        )
+        if not rows:
+            return
+        yield from rows
+        after = rows[-1][:2]
+
+
+def _write(done, chunk_size):
+    """Сохраняет счетчики готовых рефереров; возвращает (исправлено ссылок, исправлено балансов)"""
+    expected = {}
+    for state in done.values():
+        expected.update(state.links())
+    changed = []
+    for link in ReferralLink.objects.filter(user_id__in=done).only('pk', *LINK_FIELDS):
+        values = expected.get(link.pk, ZERO_LINK)
+        if (link.total_clicks, link.total_conversions, link.total_rewards) != values:
+            link.total_clicks, link.total_conversions, link.total_rewards = values
+            changed.append(link)
+
+    current = {
+        row[0]: row[1:]
+        for row in ReferralBalance.objects.filter(user_id__in=done).values_list('user_id', *BALANCE_FIELDS)
+    }
+    missing = [user_id for user_id in done if user_id not in current]
+    existing_users = set(User.objects.filter(pk__in=missing).values_list('pk', flat=True)) if missing else set()
+    balances = []
+    for user_id, state in done.items():
+        values = state.balance()
+        if user_id in current:
+            if current[user_id] == values:
+                continue
+        elif user_id not in existing_users or values == ZERO_BALANCE:
+            continue
+        balances.append(ReferralBalance(user_id=user_id, **dict(zip(BALANCE_FIELDS, values))))
+
+    with transaction.atomic():
+        ReferralLink.objects.bulk_update(changed, LINK_FIELDS, batch_size=chunk_size)
+        ReferralBalance.objects.bulk_create(
+            balances, batch_size=chunk_size, update_conflicts=True,
+            unique_fields=['user'], update_fields=BALANCE_FIELDS + ['updated_at'],
+        )
+    return len(changed), len(balances)
+
+
+def _zero_without_events(lo, hi, upto):
+    """Обнуляет счетчики рефереров [lo, hi), у которых нет событий"""
+    has_events = Exists(ReferralEvent.objects.filter(referrer_id=OuterRef('user_id'), id__lte=upto))
+    links = (
+        ReferralLink.objects.filter(user_id__gte=lo, user_id__lt=hi)
+        .exclude(total_clicks=0, total_conversions=0, total_rewards=0)
+        .exclude(has_events)
+        .update(**dict(zip(LINK_FIELDS, ZERO_LINK)))
+    )
+    balances = (
+        ReferralBalance.objects.filter(user_id__gte=lo, user_id__lt=hi)
+        .exclude(total_earned=0, locked_amount=0, available_amount=0, total_paid_out=0)
+        .exclude(has_events)
+        .update(**dict(zip(BALANCE_FIELDS, ZERO_BALANCE)))
+    )
+    return links, balances
+
+
+def _replay_range(task):
+    lo, hi, upto, chunk_size = task
+    stats = Counter()
+    done = {}
+    referrer_id, state = None, None
+
+    def flush():
+        links, balances = _write(done, chunk_size)
+        stats['links'] += links
+        stats['balances'] += balances
+        done.clear()
+
+    for row in _stream(lo, hi, upto, chunk_size):
+        if row[0] != referrer_id:
+            if state is not None:
+                done[referrer_id] = state
+                stats['orphans'] += state.orphans
+                if len(done) >= chunk_size:
+                    flush()
+            referrer_id, state = row[0], ReferrerState()
+            stats['referrers'] += 1
+        state.apply(*row[2:])
+        stats['events'] += 1
+    if state is not None:
+        done[referrer_id] = state
+        stats['orphans'] += state.orphans
+    if done:
+        flush()
+    links, balances = _zero_without_events(lo, hi, upto)
+    stats['links'] += links
+    stats['balances'] += balances
+    return stats
+
+
+def _init_worker():
+    # Соединения родителя закрыты до fork; потомок откроет свои
+    connections.close_all()
+
+
+def replay_events(workers=1, shards=None, chunk_size=BATCH_SIZE, progress=None):
+    """
+    Пересчитывает счетчики ссылок, балансы и продажи товаров по журналу.
+    Возвращает Counter: events, referrers, links / balances / products (исправлено строк), orphans.
+    """
+    if not is_backfilled():
+        raise ValueError('Журнал не заполнен историей до выкладки: сначала backfill_events() (--backfill)')
+    report = progress or (lambda message: None)
+    if connection.vendor == 'sqlite':
+        workers = 1
+    upto = ReferralEvent.objects.aggregate(top=Max('id'))['top'] or 0
+    top = (User.objects.aggregate(top=Max('id'))['top'] or 0) + 1
+    shards = shards or workers * SHARDS_PER_WORKER
+    width = math.ceil(top / shards)
+    tasks = [(lo, min(lo + width, top), upto, chunk_size) for lo in range(0, top, width)]
+
+    totals = Counter()
+    if workers > 1:
+        connections.close_all()
+        with multiprocessing.get_context('fork').Pool(workers, initializer=_init_worker) as pool:
+            for done, stats in enumerate(pool.imap_unordered(_replay_range, tasks), start=1):
+                totals.update(stats)
+                report(f'Shards {done}/{len(tasks)}')
+    else:
+        for done, task in enumerate(tasks, start=1):
+            totals.update(_replay_range(task))
+            report(f'Shards {done}/{len(tasks)}')
+
+    totals['products'] = update_sales_counters(batch_size=chunk_size)
+    return totals
+
+
+def _first_logged(kind):
+    """Наименьший object_id событий вида kind (None - таких событий еще нет)"""
+    return ReferralEvent.objects.filter(kind=kind).aggregate(first=Min('object_id'))['first']
+
+
+def _below(queryset, field, cutoff):
+    return queryset if cutoff is None else queryset.filter(**{f'{field}__lt': cutoff})
+
+
+def _backfill_visits(cutoff):
+    visits = _below(ReferralVisit.objects.all(), 'pk', cutoff).order_by('pk').values_list(
+        'pk', 'referral_link_id', 'referral_link__user_id', 'product_id', 'visited_at',
+    )
+    for pk, link_id, referrer_id, product_id, visited_at in visits.iterator(chunk_size=BATCH_SIZE):
+        visit = ReferralVisit(pk=pk, referral_link_id=link_id, product_id=product_id, visited_at=visited_at)
+        yield click_event(visit, referrer_id)
+
+
+def _backfill_attributions(cutoff):
+    attributions = _below(ReferralAttribution.objects.all(), 'last_visit_id', cutoff).order_by('pk').values_list(
+        'anonymous_id', 'product_id', 'user_id', 'referral_link_id', 'last_visit_id', 'expires_at',
+        'referral_link__user_id', 'created_at',
+    )
+    for row in attributions.iterator(chunk_size=BATCH_SIZE):
+        yield attribution_event(AttributionRecord(*row[:6]), row[6], row[7])
+
+
+def _backfill_rewards(cutoff):
+    rewards = _below(ReferralReward.objects.all(), 'pk', cutoff).order_by('pk').only(
+        'pk', 'attributed_user_id', 'referral_link_id', 'product_id', 'reward_amount',
+        'status', 'locked_amount', 'available_amount', 'created_at',
+    )
+    for reward in rewards.iterator(chunk_size=BATCH_SIZE):
+        yield conversion_event(
+            reward.pk, reward.attributed_user_id, reward.referral_link_id, reward.product_id,
+            reward.reward_amount, reward.created_at,
+        )
+        yield reward_state_event(reward.pk, reward.attributed_user_id, *reward.event_state(), reward.created_at)
+
+
+def _backfill_payouts():
+    logged = ReferralEvent.objects.filter(kind=ReferralEvent.PAYOUT, object_id=OuterRef('pk'))
+    payouts = ReferralPayout.objects.exclude(Exists(logged)).order_by('pk').values_list('pk', 'user_id', 'status', 'amount', 'processed_at', 'created_at')
+    for pk, user_id, status, amount, processed_at, created_at in payouts.iterator(chunk_size=BATCH_SIZE):
+        yield payout_event(pk, user_id, status, amount, processed_at or created_at)
+
+
+def is_backfilled():
+    return RetentionCheckpoint.objects.filter(job=BACKFILL_JOB, finished_at__isnull=False).exists()
+
+
+def backfill_events(batch_size=BATCH_SIZE):
+    """
+    Дописывает в журнал посещения, атрибуции, вознаграждения и выплаты, созданные
+    до начала живой записи, и отмечает завершение. Повторно не запускается.
+    """
+    if is_backfilled():
+        raise ValueError('История уже дописана в журнал')
+    visit_cutoff = _first_logged(ReferralEvent.CLICK)
+    reward_cutoff = _first_logged(ReferralEvent.CONVERSION)
+    counts = defaultdict(int)
+    sources = {
+        'clicks': _backfill_visits(visit_cutoff),
+        'attributions': _backfill_attributions(visit_cutoff),
+        'rewards': _backfill_rewards(reward_cutoff),
+        'payouts': _backfill_payouts(),
+    }
+    for name, events in sources.items():
+        for chunk in _chunks(events, batch_size):
+            counts[name] += log_events(chunk, batch_size)
+    RetentionCheckpoint.objects.update_or_create(
+        job=BACKFILL_JOB, defaults={'processed': sum(counts.values()), 'finished_at': timezone.now()},
+    )
+    return dict(counts)
@@ -0,0 +1,44 @@
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from rest_framework import permissions, status
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.response import Response
+
+from .exports import EXPORTS, parse_date_range, stream_csv, stream_jsonl
+
+OUTPUT_FORMATS = {
+    'csv': (stream_csv, 'text/csv; charset=utf-8'),
+    'jsonl': (stream_jsonl, 'application/x-ndjson; charset=utf-8'),
+}
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def admin_export(request, dataset):
+    """
+    Потоковая выгрузка для админов: /admin/exports/<dataset>/?output=csv|jsonl&date_from=YYYY-MM-DD&date_to=YYYY-MM-DD
+    """
+    if request.user.role != 'superadmin':
+        return Response({'error': 'Access denied'}, status=status.HTTP_403_FORBIDDEN)
+
+    if dataset not in EXPORTS:
+        return Response({'error': 'Unknown export'}, status=status.HTTP_404_NOT_FOUND)
+
+    output = request.query_params.get('output', 'csv')
+    if output not in OUTPUT_FORMATS:
+        return Response({'error': 'output must be csv or jsonl'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        start, end = parse_date_range(
+            request.query_params.get('date_from'),
+            request.query_params.get('date_to'),
+        )
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    columns, rows = EXPORTS[dataset]
+    writer, content_type = OUTPUT_FORMATS[output]
+    response = StreamingHttpResponse(writer(columns, rows(start, end)), content_type=content_type)
+    filename = f"{dataset}_{timezone.localdate().isoformat()}.{output}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
@@ -0,0 +1,167 @@
+"""
+Потоковая выгрузка данных (CSV/JSONL) для бухгалтерии и администраторов.
+Строки читаются курсором через .iterator(chunk_size=...), поэтому память
+не зависит от количества выгружаемых записей.
+"""
+import csv
+import json
+from datetime import datetime, time, timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Prefetch
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .models import Order, OrderItem, ReferralPayout, ReferralReward, ReferralVisit
+
+EXPORT_CHUNK_SIZE = 2000
+# Сколько строк склеивать в один кусок ответа
+ROWS_PER_WRITE = 500
+
+ORDER_COLUMNS = [
+    'order_id', 'public_id', 'created_at', 'status', 'payment_status', 'payment_method',
+    'user_id', 'customer_name', 'customer_phone', 'customer_address', 'total_amount',
+    'item_id', 'product_id', 'product_title', 'quantity', 'price',
+]
+
+REWARD_COLUMNS = [
+    'id', 'created_at', 'status', 'referral_link_id', 'referral_code', 'attributed_user_id',
+    'attributed_username', 'order_id', 'order_public_id', 'product_id', 'product_title',
+    'order_amount', 'reward_percentage', 'reward_amount', 'locked_amount', 'available_amount',
+    'approved_at', 'reversed_at', 'fraud_score',
+]
+
+PAYOUT_COLUMNS = [
+    'id', 'created_at', 'status', 'user_id', 'username', 'amount', 'payment_method',
+    'payment_details', 'processed_at', 'processed_by_id', 'rejection_reason',
+]
+
+VISIT_COLUMNS = [
+    'id', 'visited_at', 'referral_link_id', 'referral_code', 'anonymous_id', 'user_id',
+    'ip_address', 'user_agent', 'page_url', 'product_id', 'utm_source', 'utm_medium',
+    'utm_campaign', 'utm_term', 'utm_content',
+]
+
+
+class Echo:
+    """Псевдо-буфер для csv.writer: возвращает записанную строку вместо хранения"""
+
+    def write(self, value):
+        return value
+
+
+def parse_date_range(date_from, date_to):
+    """
+    Превращает строки YYYY-MM-DD в полуинтервал [start, end) в локальной зоне.
+    Сравнение с границами, а не __date, позволяет использовать индексы по дате.
+    """
+    start = end = None
+    tz = timezone.get_current_timezone()
+    if date_from:
+        day = parse_date(date_from)
+        if day is None:
+            raise ValueError(f'Invalid date: {date_from}')
+        start = timezone.make_aware(datetime.combine(day, time.min), tz)
+    if date_to:
+        day = parse_date(date_to)
+        if day is None:
+            raise ValueError(f'Invalid date: {date_to}')
+        end = timezone.make_aware(datetime.combine(day + timedelta(days=1), time.min), tz)
+    return start, end
+
+
+def _filter_range(queryset, field, start, end):
+    if start:
+        queryset = queryset.filter(**{f'{field}__gte': start})
+    if end:
+        queryset = queryset.filter(**{f'{field}__lt': end})
+    return queryset
+
+
+def order_rows(start=None, end=None):
+    """Одна строка на позицию заказа (заказ без позиций - одна строка с пустыми полями позиции)"""
+    items = OrderItem.objects.select_related('product').only(
+        'id', 'order_id', 'product_id', 'product__title', 'quantity', 'price'
+    ).order_by('id')
+    orders = _filter_range(Order.objects.all(), 'created_at', start, end).order_by('id').prefetch_related(
+        Prefetch('items', queryset=items)
+    )
+    for order in orders.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        head = [
+            order.id, order.public_id, order.created_at, order.status, order.payment_status,
+            order.payment_method, order.user_id, order.customer_name, order.customer_phone,
+            order.customer_address, order.total_amount,
+        ]
+        order_items = order.items.all()
+        if not order_items:
+            yield head + [None] * 5
+            continue
+        for item in order_items:
+            yield head + [item.id, item.product_id, item.product.title, item.quantity, item.price]
+
+
+def reward_rows(start=None, end=None):
+    rewards = _filter_range(ReferralReward.objects.all(), 'created_at', start, end).order_by('id')
+    return rewards.values_list(
+        'id', 'created_at', 'status', 'referral_link_id', 'referral_link__code', 'attributed_user_id',
+        'attributed_user__username', 'order_id', 'order__public_id', 'product_id', 'product__title',
+        'order_amount', 'reward_percentage', 'reward_amount', 'locked_amount', 'available_amount',
+        'approved_at', 'reversed_at', 'fraud_score',
+    ).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+def payout_rows(start=None, end=None):
+    payouts = _filter_range(ReferralPayout.objects.all(), 'created_at', start, end).order_by('id')
+    return payouts.values_list(
+        'id', 'created_at', 'status', 'user_id', 'user__username', 'amount', 'payment_method',
+        'payment_details', 'processed_at', 'processed_by_id', 'rejection_reason',
+    ).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+def visit_rows(start=None, end=None):
+    visits = _filter_range(ReferralVisit.objects.all(), 'visited_at', start, end).order_by('id')
+    return visits.values_list(
+        'id', 'visited_at', 'referral_link_id', 'referral_link__code', 'anonymous_id', 'user_id',
+        'ip_address', 'agent__user_agent', 'page_url', 'product_id', 'utm_source', 'utm_medium',
+        'utm_campaign', 'utm_term', 'utm_content',
+    ).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+EXPORTS = {
+    'orders': (ORDER_COLUMNS, order_rows),
+    'referral-rewards': (REWARD_COLUMNS, reward_rows),
+    'referral-payouts': (PAYOUT_COLUMNS, payout_rows),
+    'referral-visits': (VISIT_COLUMNS, visit_rows),
+}
+
+
+def _csv_value(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, cls=DjangoJSONEncoder, ensure_ascii=False)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def stream_csv(columns, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+    buffer = []
+    for row in rows:
+        buffer.append(writer.writerow([_csv_value(value) for value in row]))
+        if len(buffer) >= ROWS_PER_WRITE:
+            yield ''.join(buffer)
+            buffer = []
+    if buffer:
+        yield ''.join(buffer)
+
+
+def stream_jsonl(columns, rows):
+    buffer = []
+    for row in rows:
+        buffer.append(json.dumps(dict(zip(columns, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + '\n')
+        if len(buffer) >= ROWS_PER_WRITE:
+            yield ''.join(buffer)
+            buffer = []
+    if buffer:
+        yield ''.join(buffer)
@@ -0,0 +1,215 @@
+"""
+Пакетная оценка вероятности мошенничества для реферальных вознаграждений.
+
+Признаки считаются сразу для пачки вознаграждений несколькими агрегирующими
+запросами (без запросов на каждое вознаграждение) и векторно в NumPy: переходы
+пачки кодируются в один отсортированный массив ключей (группа, время), окна
+по времени считаются через searchsorted, веса и ramp - операциями над массивами:
+- количество переходов с того же IP в окне перед конверсией;
+- время от последнего перехода по ссылке с того же IP до конверсии;
+- сколько разных рефереров получили вознаграждения с тем же User-Agent;
+- самореферал: покупатель совпадает с реферером по аккаунту, email или телефону.
+"""
+import re
+from datetime import timedelta
+
+import numpy as np
+from django.db.models import Count
+from django.utils import timezone
+
+from .models import ReferralReward, ReferralVisit
+
+MICROSECOND = timedelta(microseconds=1)
+# Окно для подсчета переходов с одного IP
+IP_CLICK_WINDOW = timedelta(hours=1)
+IP_CLICK_THRESHOLD = 20
+# Окно поиска перехода, приведшего к конверсии
+CONVERSION_LOOKBACK = timedelta(days=30)
+FAST_CONVERSION_SECONDS = 10
+SLOW_CONVERSION_SECONDS = 120
+# Окно и порог для общих User-Agent у разных рефереров
+SHARED_UA_WINDOW = timedelta(days=30)
+SHARED_UA_THRESHOLD = 3
+
+# Веса признаков; итог объединяется как "шумное ИЛИ": 1 - П(1 - w * x)
+WEIGHTS = {
+    'ip_clicks': 0.4,
+    'conversion_time': 0.3,
+    'shared_user_agent': 0.3,
+    'self_referral': 0.95,
+}
+
+
+def _normalize_phone(phone):
+    digits = re.sub(r'\D', '', phone or '')
+    return digits[-9:] if len(digits) >= 9 else digits
+
+
+def _ramp(values, low, high):
+    """0 при value <= low, 1 при value >= high, линейно между ними (поэлементно)"""
+    return np.clip((values - low) / (high - low), 0.0, 1.0)
+
+
+def _micros(moments, start):
+    """Микросекунды от start (точно, без округления float)"""
+    return np.fromiter(((moment - start) // MICROSECOND for moment in moments), dtype=np.int64)
+
+
+def _group_codes(keys):
+    """Номера групп по ключам вознаграждений: (массив номеров, {ключ: номер})"""
+    index = {}
+    return np.fromiter((index.setdefault(key, len(index)) for key in keys), dtype=np.int64), index
+
+
+def _event_keys(events, index, start, span):
+    """Отсортированные ключи событий (ключ группы, момент) из групп index"""
+    events = [(index[key], moment) for key, moment in events if key in index]
+    codes = np.fromiter((code for code, _ in events), dtype=np.int64, count=len(events))
+    return np.sort(codes * span + _micros((moment for _, moment in events), start))
+
+
+def _window_bounds(rewards, lookback):
+    start = min(r['created_at'] for r in rewards) - lookback
+    end = max(r['created_at'] for r in rewards)
+    # Ключ события: номер группы * span + микросекунды от start - один отсортированный массив на все группы
+    return start, end, (end - start) // MICROSECOND + 1
+
+
+def _ip_click_feature(rewards):
+    """Количество переходов с IP вознаграждения за IP_CLICK_WINDOW до его создания"""
+    start, end, span = _window_bounds(rewards, IP_CLICK_WINDOW)
+    reward_codes, ips = _group_codes(r['ip_address'] for r in rewards)
+    visits = (
+        ReferralVisit.objects.filter(ip_address__in=list(ips), visited_at__gte=start, visited_at__lte=end)
+        .values_list('ip_address', 'visited_at')
+    )
+    visit_keys = _event_keys(visits.iterator(chunk_size=5000), ips, start, span)
+    created = reward_codes * span + _micros((r['created_at'] for r in rewards), start)
+    window = IP_CLICK_WINDOW // MICROSECOND
+    return (
+        np.searchsorted(visit_keys, created, side='right')
+        - np.searchsorted(visit_keys, created - window, side='left')
+    )
+
+
+def _conversion_time_feature(rewards):
+    """Секунды от последнего перехода по той же ссылке с того же IP до конверсии (NaN - перехода нет)"""
+    start, end, span = _window_bounds(rewards, CONVERSION_LOOKBACK)
+    reward_codes, pairs = _group_codes((r['referral_link_id'], r['ip_address']) for r in rewards)
+    visits = (
+        ReferralVisit.objects.filter(
+            referral_link_id__in={link_id for link_id, _ in pairs}, ip_address__in={ip for _, ip in pairs},
+            visited_at__gte=start, visited_at__lte=end,
+        )
+        .values_list('referral_link_id', 'ip_address', 'visited_at')
+    )
+    visit_keys = _event_keys(
+        (((link_id, ip), moment) for link_id, ip, moment in visits.iterator(chunk_size=5000)), pairs, start, span,
+    )
+    created = reward_codes * span + _micros((r['created_at'] for r in rewards), start)
+    previous = np.searchsorted(visit_keys, created, side='right') - 1
+    last_visit = visit_keys[np.maximum(previous, 0)] if len(visit_keys) else np.zeros_like(created)
+    # Переход должен быть из той же группы (ключ не меньше начала группы)
+    found = (previous >= 0) & (last_visit >= reward_codes * span)
+    return np.where(found, (created - last_visit) / 1e6, np.nan)
+
+
+def _shared_user_agent_feature(rewards):
+    """Количество разных рефереров с вознаграждениями от того же User-Agent"""
+    user_agents = {r['user_agent'] for r in rewards if r['user_agent']}
+    shared = {}
+    if user_agents:
+        end = max(r['created_at'] for r in rewards)
+        shared = dict(
+            ReferralReward.objects.filter(
+                user_agent__in=user_agents,
+                created_at__gte=min(r['created_at'] for r in rewards) - SHARED_UA_WINDOW,
+                created_at__lte=end,
+            )
+            .order_by()
+            .values('user_agent')
+            .annotate(referrers=Count('attributed_user', distinct=True))
+            .values_list('user_agent', 'referrers')
+        )
+    return np.fromiter((shared.get(r['user_agent'], 0) for r in rewards), dtype=np.float64, count=len(rewards))
+
+
+def _is_self_referral(reward):
+    if reward['order__user_id'] and reward['order__user_id'] == reward['attributed_user_id']:
+        return True
+    buyer_email = (reward['order__user__email'] or '').strip().lower()
+    referrer_email = (reward['attributed_user__email'] or '').strip().lower()
+    if buyer_email and buyer_email == referrer_email:
+        return True
+    buyer_phone = _normalize_phone(reward['order__customer_phone'])
+    referrer_phone = _normalize_phone(reward['attributed_user__phone'])
+    return bool(buyer_phone) and buyer_phone == referrer_phone
+
+
+def score_rewards(rewards):
+    """
+    Считает fraud_score для пачки вознаграждений (словари из values()).
+    Возвращает {reward_id: (score, features)}.
+    """
+    if not rewards:
+        return {}
+    seconds = _conversion_time_feature(rewards)
+    features = {
+        'ip_clicks': _ramp(_ip_click_feature(rewards), IP_CLICK_THRESHOLD, IP_CLICK_THRESHOLD * 5),
+        # Конверсия без перехода с того же IP тоже подозрительна, но слабее
+        'conversion_time': np.where(
+            np.isnan(seconds), 0.5,
+            1.0 - _ramp(np.nan_to_num(seconds), FAST_CONVERSION_SECONDS, SLOW_CONVERSION_SECONDS),
+        ),
+        'shared_user_agent': _ramp(
+            _shared_user_agent_feature(rewards), SHARED_UA_THRESHOLD, SHARED_UA_THRESHOLD * 4
+        ),
+        'self_referral': np.fromiter(
+            (_is_self_referral(r) for r in rewards), dtype=np.float64, count=len(rewards)
+        ),
+    }
+    legit = np.ones(len(rewards))
+    for name, values in features.items():
+        legit *= 1.0 - WEIGHTS[name] * values
+    scores = np.round(1.0 - legit, 4)
+    return {
+        r['id']: (float(scores[i]), {name: float(values[i]) for name, values in features.items()})
+        for i, r in enumerate(rewards)
+    }
+
+
+REWARD_FIELDS = [
+    'id', 'created_at', 'referral_link_id', 'attributed_user_id', 'ip_address', 'user_agent',
+    'order__user_id', 'order__user__email', 'order__customer_phone',
+    'attributed_user__email', 'attributed_user__phone',
+]
+
+
+def score_unscored_rewards(batch_size=1000, rescore=False, limit=None):
+    """
+    Оценивает вознаграждения пачками и сохраняет результат через bulk_update.
+    Генерирует количество обработанных вознаграждений после каждой пачки.
+    """
+    queryset = ReferralReward.objects.all()
+    if not rescore:
+        queryset = queryset.filter(fraud_scored_at__isnull=True)
+
+    last_id = 0
+    processed = 0
+    while limit is None or processed < limit:
+        size = batch_size if limit is None else min(batch_size, limit - processed)
+        batch = list(queryset.filter(pk__gt=last_id).order_by('pk').values(*REWARD_FIELDS)[:size])
+        if not batch:
+            break
+        last_id = batch[-1]['id']
+        scores = score_rewards(batch)
+        now = timezone.now()
+        ReferralReward.objects.bulk_update(
+            [
+                ReferralReward(pk=reward_id, fraud_score=score, fraud_scored_at=now)
+                for reward_id, (score, _) in scores.items()
+            ],
+            ['fraud_score', 'fraud_scored_at'],
+        )
+        processed += len(batch)
+        yield len(batch)
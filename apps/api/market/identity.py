@@ -0,0 +1,87 @@
+"""
+Склейка анонимного посетителя с пользователем при входе и регистрации.
+
+Посещения и атрибуции с anonymous_id посетителя переназначаются пользователю
+пакетными UPDATE. Если у пользователя после этого несколько атрибуций одного
+товара (переходы с разных устройств), за ним остается последняя по сроку
+действия - конфликт решается одним UPDATE с коррелированным EXISTS, у прочих
+user сбрасывается (anonymous_id сохраняется для аудита). Живые атрибуции
+пользователя кладутся в хранилище атрибуций под ключом пользователя.
+Забираются только атрибуции без пользователя: чужие не переназначаются.
+Общая очередь атрибуций при входе не сбрасывается - посетитель запоминается за
+пользователем, и отложенные записи получают его при сохранении в БД.
+
+Посетителей с длинной историей (больше INLINE_VISIT_LIMIT посещений) склеивает
+фоновый поток после коммита, чтобы не задерживать ответ на вход.
+"""
+import logging
+import threading
+
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from .attribution import AttributionRecord, assign_visitor, remember
+from .models import ReferralAttribution, ReferralVisit
+
+logger = logging.getLogger(__name__)
+
+STITCH_BATCH_SIZE = 1000
+INLINE_VISIT_LIMIT = 200
+
+
+def _stitch_attributions(anonymous_id, user_id):
+    assigned = ReferralAttribution.objects.filter(anonymous_id=anonymous_id, user__isnull=True).update(user_id=user_id)
+    newer = ReferralAttribution.objects.filter(user_id=user_id, product_id=OuterRef('product_id')).filter(
+        Q(expires_at__gt=OuterRef('expires_at')) | Q(expires_at=OuterRef('expires_at'), pk__gt=OuterRef('pk'))
+    )
+    superseded = ReferralAttribution.objects.filter(user_id=user_id).filter(Exists(newer)).update(user=None)
+    return assigned, superseded
+
+
+def _stitch_visits(anonymous_id, user_id, batch_size):
+    pending = ReferralVisit.objects.filter(anonymous_id=anonymous_id, user__isnull=True)
+    total = 0
+    while True:
+        # Пачками по первичному ключу: короткие транзакции на длинной истории
+        ids = list(pending.order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return total
+        total += ReferralVisit.objects.filter(pk__in=ids).update(user_id=user_id)
+
+
+def stitch_identity(anonymous_id, user_id, batch_size=STITCH_BATCH_SIZE):
+    """Переназначает историю посетителя пользователю; возвращает счетчики"""
+    # Записи посетителя, еще лежащие в очереди, получат пользователя при сохранении
+    assign_visitor(anonymous_id, user_id)
+    with transaction.atomic():
+        assigned, superseded = _stitch_attributions(anonymous_id, user_id)
+    visits = _stitch_visits(anonymous_id, user_id, batch_size)
+
+    live = ReferralAttribution.objects.filter(user_id=user_id, expires_at__gt=timezone.now()).values_list(
+        'anonymous_id', 'product_id', 'user_id', 'referral_link_id', 'last_visit_id', 'expires_at',
+    )
+    remember([AttributionRecord(*row) for row in live])
+    return {'attributions': assigned, 'superseded': superseded, 'visits': visits}
+
+
+def _stitch_in_background(anonymous_id, user_id):
+    try:
+        stitch_identity(anonymous_id, user_id)
+    except Exception:
+        logger.exception(f'Identity stitching failed for user {user_id}')
+    finally:
+        connection.close()
+
+
+def schedule_identity_stitch(anonymous_id, user_id):
+    """Склеивает сразу или, для длинной истории, в фоновом потоке после коммита"""
+    if not anonymous_id:
+        return None
+    history = ReferralVisit.objects.filter(anonymous_id=anonymous_id, user__isnull=True)[:INLINE_VISIT_LIMIT + 1].count()
+    if history <= INLINE_VISIT_LIMIT:
+        return stitch_identity(anonymous_id, user_id)
+    transaction.on_commit(lambda: threading.Thread(
+        target=_stitch_in_background, args=(anonymous_id, user_id), daemon=True,
+    ).start())
+    return None
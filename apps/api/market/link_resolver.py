@@ -0,0 +1,111 @@
+"""
+Разрешение реферального кода в ссылку без запроса к БД на каждый клик.
+
+Два уровня: LRU в памяти процесса (короткий TTL) и общий кэш Django (Redis в
+продакшене). Неизвестные коды тоже кэшируются (negative caching), поэтому боты,
+перебирающие несуществующие коды, не доходят до БД. При сохранении и удалении
+ReferralLink записи сбрасываются сигналами; LRU других процессов устаревает
+не дольше LOCAL_TTL, изменения через QuerySet.update() - не дольше SHARED_TTL.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.apps import apps
+from django.core.cache import cache
+from django.utils import timezone
+
+LOCAL_MAX_SIZE = 10000
+LOCAL_TTL = 10  # секунд
+SHARED_TTL = 300
+NEGATIVE_TTL = 60
+MAX_CODE_LENGTH = 20  # ReferralLink.code.max_length
+MISSING = 'missing'  # Маркер неизвестного кода в общем кэше
+
+ResolvedLink = namedtuple('ResolvedLink', ['link_id', 'user_id', 'product_id', 'is_active', 'expires_at'])
+
+
+class LRUCache:
+    """Потокобезопасный LRU с TTL записей"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            if entry[0] < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            if len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_local = LRUCache(LOCAL_MAX_SIZE, LOCAL_TTL)
+
+
+def _cache_key(code):
+    # Коды приходят от клиентов как есть - в ключ кэша попадает только хэш
+    return 'referral_code:' + hashlib.sha1(code.encode()).hexdigest()
+
+
+def _load(code):
+    ReferralLink = apps.get_model('market', 'ReferralLink')
+    row = (
+        ReferralLink.objects.filter(code=code)
+        .values_list('id', 'user_id', 'product_id', 'is_active', 'expires_at').first()
+    )
+    return ResolvedLink(*row) if row else None
+
+
+def resolve_referral_code(code):
+    """ResolvedLink по коду или None, если ссылки с таким кодом нет"""
+    if not code or not isinstance(code, str) or len(code) > MAX_CODE_LENGTH:
+        return None
+    key = _cache_key(code)
+    value = _local.get(key)
+    if value is None:
+        value = cache.get(key)
+        if value is None:
+            link = _load(code)
+            value = MISSING if link is None else tuple(link)
+            cache.set(key, value, NEGATIVE_TTL if link is None else SHARED_TTL)
+        _local.set(key, value)
+    return None if value == MISSING else ResolvedLink(*value)
+
+
+def resolve_active_link(code):
+    """Как resolve_referral_code, но только активная и не истекшая ссылка"""
+    link = resolve_referral_code(code)
+    if link is None or not link.is_active or (link.expires_at and link.expires_at <= timezone.now()):
+        return None
+    return link
+
+
+def invalidate_referral_code(code):
+    if not code:
+        return
+    key = _cache_key(code)
+    _local.delete(key)
+    cache.delete(key)
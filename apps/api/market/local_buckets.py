@@ -0,0 +1,53 @@
+"""
+Заполнение колонок local_date / local_hour (LocalDateField, LocalHourField) у строк,
+созданных до их появления.
+
+Новые строки получают значения при вставке. Старые заполняются пачками по
+диапазонам первичного ключа: каждая пачка - один UPDATE, дата и час считаются
+в SQL (TruncDate / ExtractHour в часовом поясе проекта), строки в Python не читаются.
+Миграция 0028 заполняет строки на момент миграции; команда backfill_local_buckets
+дозаполняет строки, вставленные старыми воркерами во время выкладки.
+"""
+import time
+
+from django.db.models import Max, Min
+from django.db.models.functions import ExtractHour, TruncDate
+
+from .models import Order, ReferralAttribution, ReferralReward, ReferralVisit
+
+BATCH_SIZE = 5000
+
+# Модель -> поле момента, от которого считаются local_date и local_hour
+BUCKETED_MODELS = {
+    'referral_visits': (ReferralVisit, 'visited_at'),
+    'referral_attributions': (ReferralAttribution, 'created_at'),
+    'referral_rewards': (ReferralReward, 'created_at'),
+    'orders': (Order, 'created_at'),
+}
+
+
+def backfill_model(model, source, chunk_size=BATCH_SIZE, sleep=0.0):
+    """Заполняет пустые local_date / local_hour модели; возвращает количество обновленных строк"""
+    pending = model.objects.filter(local_date__isnull=True)
+    bounds = pending.aggregate(first=Min('pk'), last=Max('pk'))
+    if bounds['first'] is None:
+        return 0
+    updated = 0
+    position = bounds['first']
+    while position <= bounds['last']:
+        updated += pending.filter(pk__gte=position, pk__lt=position + chunk_size).update(
+            local_date=TruncDate(source), local_hour=ExtractHour(source),
+        )
+        position += chunk_size
+        if sleep and position <= bounds['last']:
+            time.sleep(sleep)
+    return updated
+
+
+def backfill_local_buckets(chunk_size=BATCH_SIZE, sleep=0.0, names=None):
+    """Заполняет все модели с локальными колонками (или только names); возвращает {имя: строк}"""
+    return {
+        name: backfill_model(model, source, chunk_size, sleep)
+        for name, (model, source) in BUCKETED_MODELS.items()
+        if names is None or name in names
+    }
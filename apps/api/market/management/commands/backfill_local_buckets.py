@@ -0,0 +1,25 @@
+"""
+Заполнение local_date / local_hour у посещений, атрибуций, вознаграждений и заказов,
+созданных до появления этих колонок
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from market.local_buckets import BATCH_SIZE, BUCKETED_MODELS, backfill_local_buckets
+
+
+class Command(BaseCommand):
+    help = 'Заполняет local_date и local_hour пачками по первичному ключу'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=BATCH_SIZE, help='Строк на один UPDATE')
+        parser.add_argument('--sleep', type=float, default=0.0, help='Пауза между пачками, секунд')
+        parser.add_argument('--only', nargs='+', choices=list(BUCKETED_MODELS), help='Только указанные таблицы')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        counts = backfill_local_buckets(options['chunk_size'], options['sleep'], options['only'])
+        elapsed = time.monotonic() - started
+        summary = ', '.join(f'{name}: {count}' for name, count in counts.items())
+        self.stdout.write(self.style.SUCCESS(f'Backfilled {summary} in {elapsed:.2f}s'))
@@ -0,0 +1,64 @@
+"""
+Пересчет денормализованных агрегатов отзывов для всех товаров
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+
+from market.models import Product, Review
+
+AGGREGATE_FIELDS = [
+    'rating_count', 'rating_sum', 'rating_average',
+    'rating_1_count', 'rating_2_count', 'rating_3_count', 'rating_4_count', 'rating_5_count',
+    'verified_review_count',
+]
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает агрегаты оценок товаров по существующим отзывам'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        rows = (
+            Review.objects.order_by()
+            .values('product_id')
+            .annotate(
+                count=Count('id'),
+                total=Sum('rating'),
+                verified=Count('id', filter=Q(verified=True)),
+                **{f'r{i}': Count('id', filter=Q(rating=i)) for i in range(1, 6)}
+            )
+        )
+
+        with transaction.atomic():
+            # Сбрасываем агрегаты одним запросом, затем заполняем товары с отзывами пачками
+            Product.objects.update(**{
+                field: 0.0 if field == 'rating_average' else 0
+                for field in AGGREGATE_FIELDS
+            })
+
+            batch = []
+            updated = 0
+            for row in rows.iterator(chunk_size=batch_size):
+                product = Product(
+                    pk=row['product_id'],
+                    rating_count=row['count'],
+                    rating_sum=row['total'],
+                    rating_average=row['total'] / row['count'],
+                    verified_review_count=row['verified'],
+                    **{f'rating_{i}_count': row[f'r{i}'] for i in range(1, 6)}
+                )
+                batch.append(product)
+                if len(batch) >= batch_size:
+                    Product.objects.bulk_update(batch, AGGREGATE_FIELDS)
+                    updated += len(batch)
+                    batch = []
+            if batch:
+                Product.objects.bulk_update(batch, AGGREGATE_FIELDS)
+                updated += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(f'Updated review aggregates for {updated} products'))
@@ -0,0 +1,72 @@
+"""
+Бенчмарк аналитического движка: типовые ad-hoc запросы над синтетическими
+колоночными выгрузками в памяти (по умолчанию 10 млн посещений) или, с --from-db,
+время чтения выгрузок текущей БД
+"""
+import json
+import platform
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from market.analytics import SOURCES, default_start, load_extract
+from market.benchmark import ANALYTICS_QUERIES, git_revision, run_analytics_benchmark, synthetic_extracts
+
+
+class Command(BaseCommand):
+    help = 'Замеряет векторные ad-hoc запросы аналитики на синтетических выгрузках'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--visits', type=int, default=10_000_000, help='Посещений в синтетической выгрузке')
+        parser.add_argument('--seed', type=int, default=0, help='Seed генератора данных')
+        parser.add_argument('--iterations', type=int, default=5, help='Замеров на запрос')
+        parser.add_argument('--warmup', type=int, default=1, help='Прогревочных запусков на запрос')
+        parser.add_argument(
+            '--query', action='append', choices=sorted(ANALYTICS_QUERIES), dest='queries',
+            help='Запрос (можно указать несколько раз; по умолчанию все)',
+        )
+        parser.add_argument(
+            '--from-db', action='store_true',
+            help='Замерить чтение выгрузок текущей БД за период по умолчанию вместо синтетики',
+        )
+        parser.add_argument('--output', help='Файл для JSON-отчета (по умолчанию stdout)')
+
+    def handle(self, *args, **options):
+        if options['iterations'] < 1 or options['visits'] < 1:
+            raise CommandError('--iterations and --visits must be positive')
+
+        report = {
+            'revision': git_revision(),
+            'created_at': timezone.now().isoformat(),
+            'environment': {'python': platform.python_version(), 'numpy': np.__version__},
+        }
+        if options['from_db']:
+            start = default_start()
+            extracts = {}
+            for source, (_, _, available) in SOURCES.items():
+                started = time.monotonic()
+                extract = load_extract(source, available, start)
+                extracts[source] = {'rows': len(extract), 'seconds': round(time.monotonic() - started, 3)}
+            report['extracts'] = extracts
+        else:
+            started = time.monotonic()
+            extracts = synthetic_extracts(options['visits'], seed=options['seed'])
+            report['dataset'] = {
+                'visits': options['visits'],
+                'rewards': len(extracts['rewards']),
+                'seed': options['seed'],
+                'generate_seconds': round(time.monotonic() - started, 2),
+            }
+            report['queries'] = run_analytics_benchmark(
+                extracts, queries=options['queries'], iterations=options['iterations'], warmup=options['warmup'],
+            )
+
+        text = json.dumps(report, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(text + '\n')
+            self.stdout.write(self.style.SUCCESS(f'Benchmark report written to {options["output"]}'))
+        else:
+            self.stdout.write(text)
@@ -0,0 +1,79 @@
+"""
+Воспроизводимый бенчмарк API: отдельная тестовая БД, синтетические данные,
+замеры ключевых эндпоинтов, отчет в JSON для сравнения между коммитами
+"""
+import json
+import platform
+import time
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+from market.benchmark import SCENARIOS, failed_scenarios, git_revision, run_benchmark
+from market.synthetic import SIZES, seed_dataset
+
+
+class Command(BaseCommand):
+    help = 'Запускает бенчмарк ключевых эндпоинтов на синтетических данных в тестовой БД'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', choices=sorted(SIZES), default='small', help='Размер набора данных')
+        parser.add_argument('--seed', type=int, default=0, help='Seed генератора данных')
+        parser.add_argument('--iterations', type=int, default=50, help='Замеряемых запросов на сценарий')
+        parser.add_argument('--warmup', type=int, default=5, help='Прогревочных запросов на сценарий')
+        parser.add_argument(
+            '--scenario', action='append', choices=SCENARIOS, dest='scenarios',
+            help='Сценарий (можно указать несколько раз; по умолчанию все)',
+        )
+        parser.add_argument('--output', help='Файл для JSON-отчета (по умолчанию stdout)')
+        parser.add_argument('--keepdb', action='store_true', help='Не удалять тестовую БД после запуска')
+
+    def handle(self, *args, **options):
+        if options['iterations'] < 1:
+            raise CommandError('--iterations must be positive')
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            started = time.monotonic()
+            dataset = seed_dataset(SIZES[options['size']], seed=options['seed'])
+            seed_seconds = time.monotonic() - started
+            results = run_benchmark(
+                dataset, scenarios=options['scenarios'],
+                iterations=options['iterations'], warmup=options['warmup'],
+            )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        report = {
+            'revision': git_revision(),
+            'created_at': timezone.now().isoformat(),
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+            },
+            'dataset': {
+                'size': options['size'],
+                'seed': options['seed'],
+                'rows': dataset['counts'],
+                'seed_seconds': round(seed_seconds, 2),
+            },
+            'iterations': options['iterations'],
+            'warmup': options['warmup'],
+            'scenarios': results,
+        }
+        text = json.dumps(report, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(text + '\n')
+            self.stdout.write(self.style.SUCCESS(f'Benchmark report written to {options["output"]}'))
+        else:
+            self.stdout.write(text)
+        failed = failed_scenarios(results)
+        if failed:
+            raise CommandError(f'Scenarios returned non-2xx responses: {", ".join(failed)}')
@@ -0,0 +1,26 @@
+"""
+Перенос отложенных атрибуций из очереди Redis в ReferralAttribution (журнал для аудита)
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from market.attribution import FLUSH_BATCH_SIZE, flush_pending
+from market.redis_client import get_client
+
+
+class Command(BaseCommand):
+    help = 'Сохраняет в БД атрибуции, накопленные в очереди Redis'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=FLUSH_BATCH_SIZE, help='Атрибуций на один upsert')
+
+    def handle(self, *args, **options):
+        if get_client() is None:
+            self.stdout.write('REDIS_URL is not set: attributions are written to the database directly')
+            return
+        started = time.monotonic()
+        flushed = flush_pending(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Flushed {flushed} attributions in {time.monotonic() - started:.2f}s'
+        ))
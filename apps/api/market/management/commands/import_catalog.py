@@ -0,0 +1,46 @@
+"""
+Пакетный импорт каталога продавца из CSV/JSONL (и zip с изображениями)
+"""
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from market.catalog import IMPORT_BATCH_SIZE, CatalogImportError, import_catalog
+from market.models import User
+
+
+class Command(BaseCommand):
+    help = 'Импортирует товары продавца: обновление по артикулу (sku) или slug, создание новых'
+
+    def add_arguments(self, parser):
+        parser.add_argument('vendor', help='username продавца')
+        parser.add_argument('path', help='Файл .csv или .jsonl')
+        parser.add_argument('--images', help='zip с изображениями, на которые ссылается колонка images')
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            vendor = User.objects.get(username=options['vendor'], role='vendor')
+        except User.DoesNotExist:
+            raise CommandError(f'Vendor {options["vendor"]} not found')
+        input_format = os.path.splitext(options['path'])[1].lstrip('.').lower()
+
+        images = open(options['images'], 'rb') if options['images'] else None
+        try:
+            with open(options['path'], 'rb') as fileobj:
+                report = import_catalog(
+                    vendor, fileobj, input_format, images_zip=images, batch_size=options['batch_size'],
+                )
+        except CatalogImportError as e:
+            raise CommandError(str(e))
+        finally:
+            if images:
+                images.close()
+
+        for error in report['errors']:
+            self.stderr.write(f'line {error["line"]}: {json.dumps(error["errors"], ensure_ascii=False)}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {report["created"]}, updated {report["updated"]}, images {report["images"]}, '
+            f'errors {report["error_count"]}'
+        ))
@@ -0,0 +1,40 @@
+"""
+Обслуживание помесячных секций ReferralVisit на Postgres (запускать по cron, например ежедневно)
+"""
+from django.core.management.base import BaseCommand
+
+from market import partitions
+
+
+class Command(BaseCommand):
+    help = 'Создает будущие секции ReferralVisit и отсоединяет/удаляет старые'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int, default=3, help='На сколько месяцев вперед создавать секции')
+        parser.add_argument(
+            '--retain-months', type=int, default=None,
+            help='Сколько полных прошлых месяцев хранить; более старые секции удаляются',
+        )
+        parser.add_argument('--detach-only', action='store_true', help='Только отсоединить старые секции, не удаляя')
+
+    def handle(self, *args, **options):
+        if not partitions.is_supported() or not partitions.is_partitioned():
+            self.stdout.write('ReferralVisit is not partitioned on this database, nothing to do')
+            return
+
+        created = partitions.ensure_future_partitions(options['months_ahead'])
+        for name in created:
+            self.stdout.write(f'Created partition {name}')
+
+        if options['retain_months'] is not None:
+            removed = partitions.drop_old_partitions(
+                retain_months=options['retain_months'],
+                detach_only=options['detach_only'],
+            )
+            action = 'Detached' if options['detach_only'] else 'Dropped'
+            for name in removed:
+                self.stdout.write(f'{action} partition {name}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(partitions.list_partitions())} monthly partitions attached'
+        ))
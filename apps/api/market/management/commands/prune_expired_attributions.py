@@ -0,0 +1,33 @@
+"""
+Удаление истекших реферальных атрибуций пачками с возобновлением
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from market.retention import prune_expired_attributions
+
+
+class Command(BaseCommand):
+    help = 'Удаляет истекшие атрибуции пачками по диапазонам pk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Размер диапазона pk на пачку')
+        parser.add_argument('--sleep', type=float, default=0.1, help='Пауза между пачками, сек')
+        parser.add_argument('--resume', action='store_true', help='Продолжить с сохраненной позиции')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        total = 0
+        for deleted, seconds in prune_expired_attributions(
+            chunk_size=options['chunk_size'],
+            sleep=options['sleep'],
+            resume=options['resume'],
+        ):
+            total += deleted
+            if options['verbosity'] > 1 and deleted:
+                self.stdout.write(f'Deleted {deleted} attributions in {seconds:.2f}s ({deleted / max(seconds, 1e-6):.0f} rows/s)')
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Deleted {total} attributions in {elapsed:.2f}s ({total / max(elapsed, 1e-6):.0f} rows/s)'
+        ))
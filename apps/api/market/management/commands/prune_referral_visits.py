@@ -0,0 +1,37 @@
+"""
+Удаление старых реферальных посещений пачками с архивацией и возобновлением
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from market.retention import prune_referral_visits
+
+
+class Command(BaseCommand):
+    help = 'Удаляет посещения старше --days дней пачками по диапазонам pk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=90)
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Размер диапазона pk на пачку')
+        parser.add_argument('--sleep', type=float, default=0.1, help='Пауза между пачками, сек')
+        parser.add_argument('--resume', action='store_true', help='Продолжить с сохраненной позиции')
+        parser.add_argument('--archive-dir', help='Каталог для gzip JSONL архива удаляемых строк')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        total = 0
+        for deleted, seconds in prune_referral_visits(
+            days=options['days'],
+            chunk_size=options['chunk_size'],
+            sleep=options['sleep'],
+            resume=options['resume'],
+            archive_dir=options['archive_dir'],
+        ):
+            total += deleted
+            if options['verbosity'] > 1 and deleted:
+                self.stdout.write(f'Deleted {deleted} visits in {seconds:.2f}s ({deleted / max(seconds, 1e-6):.0f} rows/s)')
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Deleted {total} visits in {elapsed:.2f}s ({total / max(elapsed, 1e-6):.0f} rows/s)'
+        ))
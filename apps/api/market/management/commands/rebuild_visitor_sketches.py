@@ -0,0 +1,33 @@
+"""
+Пересчет HyperLogLog-скетчей уникальных посетителей по сохраненным посещениям
+(первичное заполнение или восстановление после сбоя)
+"""
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from market.visitor_sketches import rebuild_day
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает скетчи уникальных посетителей ReferralVisitSketch за последние дни'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=90, help='Сколько последних дней пересчитать')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        today = timezone.localdate()
+        total = 0
+        for offset in range(options['days'], -1, -1):
+            day = today - timedelta(days=offset)
+            visits = rebuild_day(day)
+            total += visits
+            if options['verbosity'] > 1 and visits:
+                self.stdout.write(f'{day}: {visits} visits')
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt sketches for {options["days"] + 1} days from {total} visits in {elapsed:.2f}s'
+        ))
@@ -0,0 +1,45 @@
+"""
+Пересчет счетчиков реферальных ссылок, балансов и продаж товаров по журналу событий
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from market.event_replay import BATCH_SIZE, backfill_events, replay_events
+
+
+class Command(BaseCommand):
+    help = 'Восстанавливает производные счетчики одним проходом по журналу ReferralEvent'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help='Процессов (не для SQLite)')
+        parser.add_argument('--shards', type=int, help='Диапазонов рефереров (по умолчанию 4 на процесс)')
+        parser.add_argument('--chunk-size', type=int, default=BATCH_SIZE, help='Событий на чтение и рефереров на запись')
+        parser.add_argument(
+            '--backfill', action='store_true',
+            help='Сначала дописать в журнал историю до выкладки (посещения, вознаграждения, выплаты)',
+        )
+
+    def handle(self, *args, **options):
+        if options['workers'] > 1 and connection.vendor == 'sqlite':
+            self.stdout.write(self.style.WARNING('SQLite: replaying in a single process'))
+        started = time.monotonic()
+        if options['backfill']:
+            try:
+                counts = backfill_events(batch_size=options['chunk_size'])
+            except ValueError as e:
+                raise CommandError(str(e))
+            self.stdout.write(f'Backfilled events: {counts}')
+        try:
+            totals = replay_events(
+                workers=options['workers'], shards=options['shards'], chunk_size=options['chunk_size'],
+                progress=lambda message: self.stdout.write(message),
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(
+            f"Replayed {totals['events']} events of {totals['referrers']} referrers: fixed {totals['links']} links, "
+            f"{totals['balances']} balances, {totals['products']} products "
+            f"({totals['orphans']} orphan reward states, {time.monotonic() - started:.2f}s)"
+        ))
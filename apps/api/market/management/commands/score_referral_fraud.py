@@ -0,0 +1,35 @@
+"""
+Периодическая оценка мошенничества для новых реферальных вознаграждений (запускать по cron)
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from market.fraud import score_unscored_rewards
+
+
+class Command(BaseCommand):
+    help = 'Рассчитывает fraud_score для неоцененных реферальных вознаграждений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--limit', type=int, default=None, help='Максимум вознаграждений за запуск')
+        parser.add_argument('--rescore', action='store_true', help='Пересчитать уже оцененные вознаграждения')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        total = 0
+        for count in score_unscored_rewards(
+            batch_size=options['batch_size'],
+            rescore=options['rescore'],
+            limit=options['limit'],
+        ):
+            total += count
+            if options['verbosity'] > 1:
+                elapsed = time.monotonic() - started
+                self.stdout.write(f'Scored {total} rewards ({total / elapsed:.0f} rewards/s)')
+        elapsed = time.monotonic() - started
+        rate = total / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Scored {total} rewards in {elapsed:.2f}s ({rate:.0f} rewards/s)'
+        ))
@@ -0,0 +1,55 @@
+"""
+Генерация больших синтетических наборов данных для проверки производительности
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from market.synthetic import SIZES, seed_dataset
+
+OVERRIDES = [
+    ('users', int), ('vendors', int), ('categories', int), ('products', int), ('photos_per_product', int),
+    ('orders', int), ('items_per_order', int), ('links', int), ('visits', int), ('reviews', int),
+    ('zipf_s', float), ('conversion_rate', float), ('payout_rate', float), ('withdrawal_rate', float),
+    ('days', int),
+]
+
+
+class Command(BaseCommand):
+    help = 'Заполняет базу синтетическими данными (bulk_create пачками, опционально в несколько процессов)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', choices=list(SIZES), default='small', help='Базовый размер набора')
+        parser.add_argument('--seed', type=int, default=0, help='Seed генератора (разные seed не пересекаются)')
+        parser.add_argument('--workers', type=int, default=1, help='Процессов для генерации фактов (не для SQLite)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Строк на INSERT для справочных таблиц')
+        for name, kind in OVERRIDES:
+            parser.add_argument(f'--{name.replace("_", "-")}', type=kind, dest=name, help=f'Переопределить {name}')
+
+    def handle(self, *args, **options):
+        sizes = dict(SIZES[options['size']])
+        for name, _ in OVERRIDES:
+            if options[name] is not None:
+                sizes[name] = options[name]
+        if min(sizes['users'], sizes['vendors'], sizes['categories'], sizes['products'], sizes['links']) < 1:
+            raise CommandError('users, vendors, categories, products and links must be positive')
+        if options['workers'] > 1 and connection.vendor == 'sqlite':
+            self.stderr.write('SQLite does not support parallel writers, using a single process')
+
+        def progress(message):
+            if options['verbosity'] > 1:
+                self.stdout.write(message)
+
+        started = time.monotonic()
+        dataset = seed_dataset(
+            sizes, seed=options['seed'], batch_size=options['batch_size'],
+            workers=options['workers'], progress=progress,
+        )
+        elapsed = time.monotonic() - started
+        total = sum(dataset['counts'].values())
+        for name, count in sorted(dataset['counts'].items()):
+            self.stdout.write(f'{name}: {count}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Seeded {total} rows in {elapsed:.1f}s ({total / max(elapsed, 1e-6):.0f} rows/s)'
+        ))
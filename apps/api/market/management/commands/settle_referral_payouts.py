@@ -0,0 +1,29 @@
+"""
+Пакетная выплата реферальных вознаграждений (например, в конце месяца)
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from market.settlement import settle_payouts
+
+
+class Command(BaseCommand):
+    help = 'Выполняет все ожидающие выплаты одной транзакцией; повторный запуск с тем же --run-id ничего не меняет'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--run-id',
+            help='Идентификатор запуска (по умолчанию settlement-YYYY-MM)',
+        )
+
+    def handle(self, *args, **options):
+        run_id = options['run_id'] or f"settlement-{timezone.localdate():%Y-%m}"
+        started = time.monotonic()
+        run = settle_payouts(run_id)
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Run {run.run_id}: {run.payouts_count} payouts settled, {run.skipped_count} skipped, '
+            f'{run.rewards_count} rewards linked, total {run.total_amount} ({elapsed:.2f}s)'
+        ))
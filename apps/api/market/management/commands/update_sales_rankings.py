@@ -0,0 +1,31 @@
+"""
+Обновление счетчиков продаж и рейтинга бестселлеров/трендовых товаров (запускать по cron)
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from market.ranking import (
+    TRENDING_HALF_LIFE_DAYS, TRENDING_WINDOW_DAYS, rebuild_sales_rankings, update_sales_counters,
+)
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает продажи товаров по подтвержденным заказам и рейтинг продаж'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--window-days', type=int, default=TRENDING_WINDOW_DAYS)
+        parser.add_argument('--half-life-days', type=float, default=TRENDING_HALF_LIFE_DAYS)
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        updated = update_sales_counters(batch_size=options['batch_size'])
+        ranked = rebuild_sales_rankings(
+            window_days=options['window_days'],
+            half_life_days=options['half_life_days'],
+        )
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Updated sales counters for {updated} products, ranked {ranked} products in {elapsed:.2f}s'
+        ))
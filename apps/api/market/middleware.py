@@ -1,11 +1,17 @@
 """
 Middleware для автоматического отслеживания реферальных посещений
 """
+import logging
+
 import requests
 import json
 from django.conf import settings
 from django.utils.deprecation import MiddlewareMixin
-from .referral_utils import track_referral_from_url, get_or_create_anonymous_id, set_anonymous_id_cookie
+from .link_resolver import resolve_active_link
+from .referral_utils import track_referral_from_url, get_or_create_anonymous_id, read_anonymous_id, set_anonymous_id_cookie
+from .throttling import client_ip
+
+logger = logging.getLogger(__name__)
 
 class ReferralTrackingMiddleware(MiddlewareMixin):
     """
@@ -17,16 +23,16 @@ class ReferralTrackingMiddleware(MiddlewareMixin):
         # Проверяем, есть ли реферальные параметры в URL
         tracking_data = track_referral_from_url(request)
         
-        if tracking_data:
+        # Неизвестные и неактивные коды не отправляем на API (проверка по кэшу кодов)
+        if tracking_data and resolve_active_link(tracking_data['referral_code']):
             # Сохраняем данные для обработки в process_response
             request._referral_tracking_data = tracking_data
     
     def process_response(self, request, response):
         """Обрабатывает исходящий ответ"""
-        # Устанавливаем anonymous_id cookie если его нет
-        anonymous_id = get_or_create_anonymous_id(request)
-        if not request.COOKIES.get('anonymous_id'):
-            response = set_anonymous_id_cookie(response, anonymous_id)
+        # Устанавливаем anonymous_id cookie если ее нет или подпись неверна
+        if not read_anonymous_id(request):
+            response = set_anonymous_id_cookie(response, get_or_create_anonymous_id(request))
         
         # Отправляем данные о реферальном посещении на API
         if hasattr(request, '_referral_tracking_data'):
@@ -40,9 +46,9 @@ class ReferralTrackingMiddleware(MiddlewareMixin):
             # URL API для отслеживания посещений
             api_url = f"{settings.API_BASE_URL}/market/track-visit/"
             
-            # Добавляем IP адрес и User-Agent
+            # Добавляем IP адрес (разобранный справа налево по доверенным прокси) и User-Agent
             tracking_data.update({
-                'ip_address': self._get_client_ip(request),
+                'ip_address': client_ip(request),
                 'user_agent': request.META.get('HTTP_USER_AGENT', ''),
             })
             
@@ -51,22 +57,18 @@ class ReferralTrackingMiddleware(MiddlewareMixin):
                 api_url,
                 json=tracking_data,
                 timeout=5,
-                headers={'Content-Type': 'application/json'}
+                # Передаем User-Agent и IP посетителя: по ним API фильтрует ботов и ограничивает частоту
+                headers={
+                    'Content-Type': 'application/json',
+                    'User-Agent': tracking_data['user_agent'],
+                    'X-Forwarded-For': tracking_data['ip_address'] or '',
+                }
             )
             
             if response.status_code == 201:
-                print(f"Successfully tracked referral visit: {tracking_data['referral_code']}")
+                logger.info(f"Tracked referral visit: {tracking_data['referral_code']}")
             else:
-                print(f"Failed to track referral visit: {response.status_code} - {response.text}")
-                
+                logger.warning(f"Failed to track referral visit: {response.status_code} - {response.text}")
+
         except Exception as e:
-            print(f"Error tracking referral visit: {e}")
-    
-    def _get_client_ip(self, request):
-        """Получает IP адрес клиента"""
-        x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-        if x_forwarded_for:
-            ip = x_forwarded_for.split(',')[0]
-        else:
-            ip = request.META.get('REMOTE_ADDR')
-        return ip
\ No newline at end of file
+            logger.error(f"Error tracking referral visit: {e}")
\ No newline at end of file
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.5 on 2026-10-19 11:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0015_product_review_aggregates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSalesRank',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='sales_rank', serialize=False, to='market.product')),
+                ('total_sales', models.PositiveIntegerField(default=0)),
+                ('trending_units', models.PositiveIntegerField(default=0)),
+                ('trending_score', models.FloatField(default=0.0)),
+                ('bestseller_rank', models.PositiveIntegerField()),
+                ('trending_rank', models.PositiveIntegerField(blank=True, null=True)),
+                ('computed_at', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['bestseller_rank'], name='market_prod_bestsel_c48039_idx'), models.Index(fields=['trending_rank'], name='market_prod_trendin_724afd_idx')],
+            },
+        ),
+    ]
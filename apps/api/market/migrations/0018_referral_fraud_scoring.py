@@ -0,0 +1,26 @@
+# Generated by Django 5.2.5 on 2026-10-19 11:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0017_payout_settlement_runs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='referralreward',
+            name='fraud_scored_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='referralreward',
+            index=models.Index(fields=['fraud_scored_at'], name='market_refe_fraud_s_4a4a97_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='referralvisit',
+            index=models.Index(fields=['ip_address', 'visited_at'], name='market_refe_ip_addr_ca33eb_idx'),
+        ),
+    ]
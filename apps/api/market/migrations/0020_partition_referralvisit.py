@@ -0,0 +1,96 @@
+# Generated by Django 5.2.5 on 2026-10-19 11:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+TABLE = 'market_referralvisit'
+OLD_TABLE = 'market_referralvisit_unpartitioned'
+SEQUENCE = 'market_referralvisit_part_id_seq'
+
+
+def _add_months(day, months):
+    import datetime
+    index = day.year * 12 + day.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def partition_referral_visits(apps, schema_editor):
+    """
+    Postgres: превращает market_referralvisit в секционированную по месяцам
+    (RANGE по visited_at) таблицу с первичным ключом (id, visited_at).
+    На других СУБД таблица остается обычной.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    import datetime
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s AND indexname NOT LIKE %s",
+            [TABLE, '%_pkey'],
+        )
+        indexes = cursor.fetchall()
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = %s::regclass AND contype = 'f'",
+            [TABLE],
+        )
+        foreign_keys = cursor.fetchall()
+
+        cursor.execute(f'ALTER TABLE "{TABLE}" RENAME TO "{OLD_TABLE}"')
+        for name, _ in foreign_keys:
+            cursor.execute(f'ALTER TABLE "{OLD_TABLE}" DROP CONSTRAINT "{name}"')
+        for name, _ in indexes:
+            cursor.execute(f'DROP INDEX "{name}"')
+
+        cursor.execute(
+            f'CREATE TABLE "{TABLE}" (LIKE "{OLD_TABLE}" INCLUDING DEFAULTS) PARTITION BY RANGE (visited_at)'
+        )
+        cursor.execute(f'CREATE SEQUENCE "{SEQUENCE}"')
+        cursor.execute(f'ALTER TABLE "{TABLE}" ALTER COLUMN id SET DEFAULT nextval(\'"{SEQUENCE}"\')')
+        cursor.execute(f'ALTER TABLE "{TABLE}" ADD PRIMARY KEY (id, visited_at)')
+        cursor.execute(f'CREATE TABLE "{TABLE}_default" PARTITION OF "{TABLE}" DEFAULT')
+
+        # Секции на месяцы с существующими данными и на три месяца вперед
+        cursor.execute(f'SELECT min(visited_at) FROM "{OLD_TABLE}"')
+        first = cursor.fetchone()[0]
+        today = datetime.date.today()
+        first_day = first.date() if first else today
+        month = datetime.date(first_day.year, first_day.month, 1)
+        last = _add_months(datetime.date(today.year, today.month, 1), 3)
+        while month <= last:
+            cursor.execute(
+                f'CREATE TABLE "{TABLE}_p{month:%Y%m}" PARTITION OF "{TABLE}" '
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_add_months(month, 1).isoformat()}')"
+            )
+            month = _add_months(month, 1)
+
+        cursor.execute(f'INSERT INTO "{TABLE}" SELECT * FROM "{OLD_TABLE}"')
+        cursor.execute(
+            f'SELECT setval(\'"{SEQUENCE}"\', COALESCE((SELECT max(id) FROM "{TABLE}"), 0) + 1, false)'
+        )
+        cursor.execute(f'ALTER SEQUENCE "{SEQUENCE}" OWNED BY "{TABLE}".id')
+        cursor.execute(f'DROP TABLE "{OLD_TABLE}"')
+
+        # Определения индексов сняты до переименования и ссылаются на новую таблицу
+        for _, definition in indexes:
+            cursor.execute(definition)
+        for name, definition in foreign_keys:
+            cursor.execute(f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{name}" {definition}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0019_retentioncheckpoint'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='referralattribution',
+            name='last_visit',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='market.referralvisit'),
+        ),
+        migrations.RunPython(partition_referral_visits, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.5 on 2026-10-19 11:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0020_partition_referralvisit'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferralVisitSketch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('registers', models.BinaryField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('referral_link', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='visit_sketches', to='market.referrallink')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['day'], name='market_refe_day_c1d6ff_idx')],
+                'constraints': [models.UniqueConstraint(fields=('referral_link', 'day'), name='unique_visit_sketch_link_day'), models.UniqueConstraint(condition=models.Q(('referral_link__isnull', True)), fields=('day',), name='unique_visit_sketch_total_day')],
+            },
+        ),
+    ]
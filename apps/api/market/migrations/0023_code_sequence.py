@@ -0,0 +1,49 @@
+# Generated by Django 5.2.5 on 2026-10-19 11:53
+
+import secrets
+
+from django.db import migrations, models
+
+
+CODE_NAMES = ('user', 'order', 'referral_link')
+BLOCK_SIZE = 100
+
+
+def create_code_sequences(apps, schema_editor):
+    """Ключи перестановки для каждого вида кодов; на Postgres - нативные последовательности блоков"""
+    CodeSequence = apps.get_model('market', 'CodeSequence')
+    for name in CODE_NAMES:
+        CodeSequence.objects.get_or_create(name=name, defaults={'key': secrets.token_hex(16)})
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for name in CODE_NAMES:
+            cursor.execute(f'CREATE SEQUENCE IF NOT EXISTS "market_code_{name}" INCREMENT BY {BLOCK_SIZE}')
+
+
+def drop_code_sequences(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for name in CODE_NAMES:
+            cursor.execute(f'DROP SEQUENCE IF EXISTS "market_code_{name}"')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0022_product_sku'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CodeSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('key', models.CharField(max_length=64)),
+                ('next_value', models.BigIntegerField(default=1)),
+            ],
+        ),
+        migrations.RunPython(create_code_sequences, drop_code_sequences),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-19 12:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0023_code_sequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='referrallink',
+            name='repeat_clicks',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.5 on 2026-10-19 12:10
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0024_referrallink_repeat_clicks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferralEvent',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('kind', models.PositiveSmallIntegerField(choices=[(1, 'Переход'), (2, 'Атрибуция'), (3, 'Конверсия'), (4, 'Состояние вознаграждения'), (5, 'Выплата')])),
+                ('referrer_id', models.PositiveIntegerField()),
+                ('referral_link_id', models.PositiveIntegerField(blank=True, null=True)),
+                ('object_id', models.BigIntegerField(blank=True, null=True)),
+                ('product_id', models.PositiveIntegerField(blank=True, null=True)),
+                ('status', models.CharField(blank=True, max_length=20)),
+                ('amount', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('occurred_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['referrer_id', 'id'], name='market_refe_referre_c32405_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.5 on 2026-10-19 12:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0025_referral_event'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='referralreward',
+            name='attributed_visit',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='market.referralvisit'),
+        ),
+        migrations.CreateModel(
+            name='CampaignDailyStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('utm_source', models.CharField(blank=True, default='', max_length=100)),
+                ('utm_medium', models.CharField(blank=True, default='', max_length=100)),
+                ('utm_campaign', models.CharField(blank=True, default='', max_length=100)),
+                ('utm_term', models.CharField(blank=True, default='', max_length=100)),
+                ('utm_content', models.CharField(blank=True, default='', max_length=100)),
+                ('clicks', models.PositiveIntegerField(default=0)),
+                ('conversions', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('commission', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('visitors', models.BinaryField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['day'], name='market_camp_day_bb694e_idx')],
+                'constraints': [models.UniqueConstraint(fields=('day', 'utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content'), name='unique_campaign_daily_stat')],
+            },
+        ),
+    ]
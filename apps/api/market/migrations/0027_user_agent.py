@@ -0,0 +1,152 @@
+# Generated by Django 5.2.5 on 2026-10-19 12:23
+
+import hashlib
+import re
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Max, Min
+
+BATCH_SIZE = 1000
+
+# Копия правил классификации market.user_agents на момент миграции:
+# миграция не импортирует код приложения, который меняется вместе с моделями
+BOT_USER_AGENT_RE = re.compile(
+    r'bot\b|bot/|crawl|spider|slurp|scrapy|curl/|wget/|python-requests|python-urllib|aiohttp|httpx|'
+    r'go-http-client|okhttp|java/|libwww|headlesschrome|phantomjs|facebookexternalhit',
+    re.IGNORECASE,
+)
+TABLET_RE = re.compile(r'ipad|tablet|kindle|silk/|playbook|android(?!.*mobile)', re.IGNORECASE)
+MOBILE_RE = re.compile(r'mobi|iphone|ipod|android|windows phone|blackberry|opera mini', re.IGNORECASE)
+OS_PATTERNS = [
+    ('Windows', re.compile(r'windows', re.IGNORECASE)),
+    ('iOS', re.compile(r'iphone|ipad|ipod', re.IGNORECASE)),
+    ('Android', re.compile(r'android', re.IGNORECASE)),
+    ('macOS', re.compile(r'mac os x|macintosh', re.IGNORECASE)),
+    ('ChromeOS', re.compile(r'cros', re.IGNORECASE)),
+    ('Linux', re.compile(r'linux', re.IGNORECASE)),
+]
+BROWSER_PATTERNS = [
+    ('Edge', re.compile(r'edg(e|a|ios)?/', re.IGNORECASE)),
+    ('Opera', re.compile(r'opr/|opera', re.IGNORECASE)),
+    ('Yandex', re.compile(r'yabrowser', re.IGNORECASE)),
+    ('Samsung Internet', re.compile(r'samsungbrowser', re.IGNORECASE)),
+    ('Firefox', re.compile(r'firefox|fxios', re.IGNORECASE)),
+    ('Chrome', re.compile(r'chrome|crios', re.IGNORECASE)),
+    ('Safari', re.compile(r'safari', re.IGNORECASE)),
+]
+
+
+def _match(patterns, user_agent):
+    for name, pattern in patterns:
+        if pattern.search(user_agent):
+            return name
+    return 'Other'
+
+
+def _user_agent_row(UserAgent, user_agent):
+    is_bot = bool(BOT_USER_AGENT_RE.search(user_agent))
+    if is_bot:
+        device_type = 'bot'
+    elif TABLET_RE.search(user_agent):
+        device_type = 'tablet'
+    elif MOBILE_RE.search(user_agent):
+        device_type = 'mobile'
+    elif user_agent:
+        device_type = 'desktop'
+    else:
+        device_type = 'other'
+    return UserAgent(
+        user_agent_hash=hashlib.sha256(user_agent.encode()).hexdigest(), user_agent=user_agent,
+        device_type=device_type, os=_match(OS_PATTERNS, user_agent),
+        browser=_match(BROWSER_PATTERNS, user_agent), is_bot=is_bot,
+    )
+
+
+def _link_range(schema_editor, ReferralVisit, UserAgent, first, last):
+    if schema_editor.connection.vendor == 'postgresql':
+        # Один UPDATE с hash join на диапазон первичного ключа
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(
+                'UPDATE market_referralvisit AS v SET agent_id = a.id '
+                'FROM market_useragent AS a '
+                'WHERE a.user_agent = v.user_agent AND v.agent_id IS NULL AND v.id >= %s AND v.id < %s',
+                [first, last],
+            )
+            return cursor.rowcount
+    pending = ReferralVisit.objects.filter(agent__isnull=True, pk__gte=first, pk__lt=last)
+    values = set(pending.values_list('user_agent', flat=True))
+    return sum(
+        pending.filter(user_agent=value).update(agent_id=agent_id)
+        for agent_id, value in UserAgent.objects.filter(user_agent__in=values).values_list('pk', 'user_agent')
+    )
+
+
+def intern_user_agents(apps, schema_editor):
+    """
+    Заполняет справочник различными User-Agent посещений и проставляет ссылки на него.
+    Миграция не атомарна: справочник пишется пачками, ссылки - UPDATE по диапазонам
+    первичного ключа, каждый в своей транзакции. Проход повторяется, пока есть
+    посещения без ссылки (их могли вставить воркеры со старым кодом).
+    """
+    ReferralVisit = apps.get_model('market', 'ReferralVisit')
+    UserAgent = apps.get_model('market', 'UserAgent')
+    pending = ReferralVisit.objects.filter(agent__isnull=True)
+    while True:
+        bounds = pending.aggregate(first=Min('pk'), last=Max('pk'))
+        if bounds['first'] is None:
+            return
+        batch = []
+        values = pending.order_by().values_list('user_agent', flat=True).distinct()
+        for value in values.iterator(chunk_size=BATCH_SIZE):
+            batch.append(_user_agent_row(UserAgent, value))
+            if len(batch) >= BATCH_SIZE:
+                UserAgent.objects.bulk_create(batch, ignore_conflicts=True)
+                batch = []
+        UserAgent.objects.bulk_create(batch, ignore_conflicts=True)
+        linked = sum(
+            _link_range(schema_editor, ReferralVisit, UserAgent, first, first + BATCH_SIZE)
+            for first in range(bounds['first'], bounds['last'] + 1, BATCH_SIZE)
+        )
+        if not linked:
+            raise RuntimeError('ReferralVisit rows without a matching UserAgent remain')
+
+
+class Migration(migrations.Migration):
+    # Справочник, проход по посещениям и смена схемы - в отдельных транзакциях
+    atomic = False
+
+    dependencies = [
+        ('market', '0026_campaign_daily_stat'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserAgent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_agent_hash', models.CharField(max_length=64, unique=True)),
+                ('user_agent', models.TextField()),
+                ('device_type', models.CharField(choices=[('desktop', 'Компьютер'), ('mobile', 'Телефон'), ('tablet', 'Планшет'), ('bot', 'Бот'), ('other', 'Другое')], max_length=10)),
+                ('os', models.CharField(max_length=32)),
+                ('browser', models.CharField(max_length=32)),
+                ('is_bot', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='referralvisit',
+            name='agent',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='visits', to='market.useragent'),
+        ),
+        migrations.RunPython(intern_user_agents, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='referralvisit',
+            name='agent',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='visits', to='market.useragent'),
+        ),
+        migrations.RemoveField(
+            model_name='referralvisit',
+            name='user_agent',
+        ),
+    ]
@@ -0,0 +1,105 @@
+# Generated by Django 5.2.5 on 2026-10-19 12:27
+
+import market.models
+from django.db import migrations, models
+from django.db.models import Max, Min
+from django.db.models.functions import ExtractHour, TruncDate
+
+BATCH_SIZE = 5000
+
+
+def backfill_local_buckets(apps, schema_editor):
+    """
+    Заполняет local_date / local_hour существующих строк (до создания индексов).
+    Миграция не атомарна: каждая пачка по диапазону первичного ключа - отдельный
+    UPDATE в своей транзакции, блокировки не держатся на весь проход.
+    """
+    for model_name, source in [
+        ('ReferralVisit', 'visited_at'), ('ReferralAttribution', 'created_at'),
+        ('ReferralReward', 'created_at'), ('Order', 'created_at'),
+    ]:
+        pending = apps.get_model('market', model_name).objects.filter(local_date__isnull=True)
+        bounds = pending.aggregate(first=Min('pk'), last=Max('pk'))
+        if bounds['first'] is None:
+            continue
+        for position in range(bounds['first'], bounds['last'] + 1, BATCH_SIZE):
+            pending.filter(pk__gte=position, pk__lt=position + BATCH_SIZE).update(
+                local_date=TruncDate(source), local_hour=ExtractHour(source),
+            )
+
+
+class Migration(migrations.Migration):
+    # Добавление колонок, проход по данным и индексы - в отдельных транзакциях
+    atomic = False
+
+    dependencies = [
+        ('market', '0027_user_agent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='local_date',
+            field=market.models.LocalDateField(editable=False, null=True, source='created_at'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='local_hour',
+            field=market.models.LocalHourField(editable=False, null=True, source='created_at'),
+        ),
+        migrations.AddField(
+            model_name='referralattribution',
+            name='local_date',
+            field=market.models.LocalDateField(editable=False, null=True, source='created_at'),
+        ),
+        migrations.AddField(
+            model_name='referralattribution',
+            name='local_hour',
+            field=market.models.LocalHourField(editable=False, null=True, source='created_at'),
+        ),
+        migrations.AddField(
+            model_name='referralreward',
+            name='local_date',
+            field=market.models.LocalDateField(editable=False, null=True, source='created_at'),
+        ),
+        migrations.AddField(
+            model_name='referralreward',
+            name='local_hour',
+            field=market.models.LocalHourField(editable=False, null=True, source='created_at'),
+        ),
+        migrations.AddField(
+            model_name='referralvisit',
+            name='local_date',
+            field=market.models.LocalDateField(editable=False, null=True, source='visited_at'),
+        ),
+        migrations.AddField(
+            model_name='referralvisit',
+            name='local_hour',
+            field=market.models.LocalHourField(editable=False, null=True, source='visited_at'),
+        ),
+        migrations.RunPython(backfill_local_buckets, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['local_date', 'local_hour'], name='market_orde_local_d_19d638_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='referralattribution',
+            index=models.Index(fields=['local_date', 'local_hour'], name='market_refe_local_d_215760_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='referralreward',
+            index=models.Index(fields=['local_date', 'local_hour'], name='market_refe_local_d_06e96c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='referralreward',
+            index=models.Index(fields=['referral_link', 'local_date'], name='market_refe_referra_1c2863_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='referralvisit',
+            index=models.Index(fields=['local_date', 'local_hour'], name='market_refe_local_d_7d5fab_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='referralvisit',
+            index=models.Index(fields=['referral_link', 'local_date'], name='market_refe_referra_378989_idx'),
+        ),
+    ]
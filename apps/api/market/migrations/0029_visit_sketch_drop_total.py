@@ -0,0 +1,30 @@
+# Generated by Django 5.2.5 on 2026-10-19 14:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def delete_total_sketches(apps, schema_editor):
+    """Удаляет общие скетчи дня (referral_link=NULL): итог считается слиянием скетчей ссылок"""
+    ReferralVisitSketch = apps.get_model('market', 'ReferralVisitSketch')
+    ReferralVisitSketch.objects.filter(referral_link__isnull=True).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0028_local_date_buckets'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='referralvisitsketch',
+            name='unique_visit_sketch_total_day',
+        ),
+        migrations.RunPython(delete_total_sketches, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='referralvisitsketch',
+            name='referral_link',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='visit_sketches', to='market.referrallink'),
+        ),
+    ]
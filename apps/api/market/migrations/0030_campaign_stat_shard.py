@@ -0,0 +1,26 @@
+# Generated by Django 5.2.5 on 2026-10-19 12:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0029_visit_sketch_drop_total'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='campaigndailystat',
+            name='unique_campaign_daily_stat',
+        ),
+        migrations.AddField(
+            model_name='campaigndailystat',
+            name='shard',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddConstraint(
+            model_name='campaigndailystat',
+            constraint=models.UniqueConstraint(fields=('day', 'utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content', 'shard'), name='unique_campaign_daily_stat'),
+        ),
+    ]
@@ -1,12 +1,43 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Case, When, Value
+from django.db.models.functions import Cast
 from django.contrib.auth.models import AbstractUser
 from django.core.validators import MinValueValidator
 from django.utils import timezone
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import post_save, post_delete, pre_delete
 from django.dispatch import receiver
-import uuid
-import string
-import random
+from .codes import allocate_code
+from .link_resolver import invalidate_referral_code
+from .attribution import invalidate_attribution_window
+from .referral_events import log_payout, log_reward_change
+from .campaigns import record_reward_change
+class LocalBucketMixin:
+    """
+    Локальная дата или час (TIME_ZONE) момента из поля source. Заполняется при
+    каждом сохранении, в том числе в bulk_create; поле объявляется после source,
+    чтобы auto_now_add успел его заполнить. Фильтр по такому полю использует
+    индекс, в отличие от __date с переводом часового пояса в SQL.
+    """
+    def __init__(self, *args, source=None, **kwargs):
+        self.source = source
+        kwargs.setdefault('null', True)
+        kwargs.setdefault('editable', False)
+        super().__init__(*args, **kwargs)
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['source'] = self.source
+        return name, path, args, kwargs
+    def pre_save(self, model_instance, add):
+        moment = getattr(model_instance, self.source)
+        value = self.local_value(moment) if moment is not None else None
+        setattr(model_instance, self.attname, value)
+        return value
+class LocalDateField(LocalBucketMixin, models.DateField):
+    def local_value(self, moment):
+        return timezone.localdate(moment)
+class LocalHourField(LocalBucketMixin, models.PositiveSmallIntegerField):
+    def local_value(self, moment):
+        return timezone.localtime(moment).hour
 class UserRole(models.Model):
     ROLE_CHOICES = [
         ('superadmin', 'Super Admin'),
@@ -51,7 +82,7 @@ class User(AbstractUser):
     )
     def save(self, *args, **kwargs):
         if not self.referral_code:
-            self.referral_code = str(uuid.uuid4())[:8].upper()
+            self.referral_code = allocate_code('user')
         super().save(*args, **kwargs)
     def __str__(self):
         return f"{self.username} ({self.get_role_display()})"
@@ -87,6 +118,7 @@ class Product(models.Model):
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='products', null=True, blank=True)
     title = models.CharField(max_length=200)
     slug = models.SlugField(unique=True)
+    sku = models.CharField(max_length=64, null=True, blank=True, help_text="Артикул продавца (уникален в пределах продавца)")
     price_uzs = models.DecimalField(max_digits=10, decimal_places=2, validators=[MinValueValidator(0)])
     description = models.TextField(blank=True)
     stock = models.PositiveIntegerField(default=0)
@@ -98,12 +130,47 @@ class Product(models.Model):
     total_referral_sales = models.PositiveIntegerField(default=0, help_text="Количество продаж по реферальным ссылкам")
     sales_percentage = models.DecimalField(max_digits=5, decimal_places=2, default=0.00, help_text="Процент продаж")
     booked_quantity = models.PositiveIntegerField(default=0, help_text="Зарезервированное количество")
+    # Денормализованные агрегаты отзывов (поддерживаются сигналами Review)
+    rating_count = models.PositiveIntegerField(default=0, help_text="Количество отзывов")
+    rating_sum = models.PositiveIntegerField(default=0, help_text="Сумма оценок")
+    rating_average = models.FloatField(default=0.0, help_text="Средняя оценка")
+    rating_1_count = models.PositiveIntegerField(default=0)
+    rating_2_count = models.PositiveIntegerField(default=0)
+    rating_3_count = models.PositiveIntegerField(default=0)
+    rating_4_count = models.PositiveIntegerField(default=0)
+    rating_5_count = models.PositiveIntegerField(default=0)
+    verified_review_count = models.PositiveIntegerField(default=0, help_text="Количество подтвержденных отзывов")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-rating_average', '-rating_count']),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['vendor', 'sku'], name='unique_product_vendor_sku'),
+        ]
     def __str__(self):
         return self.title
+    @property
+    def rating_histogram(self):
+        return {str(i): getattr(self, f'rating_{i}_count') for i in range(1, 6)}
+class ProductSalesRank(models.Model):
+    """Рейтинг продаж товара (пересчитывается командой update_sales_rankings)"""
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, primary_key=True, related_name='sales_rank')
+    total_sales = models.PositiveIntegerField(default=0)  # Продано единиц по подтвержденным заказам
+    trending_units = models.PositiveIntegerField(default=0)  # Продано единиц в скользящем окне
+    trending_score = models.FloatField(default=0.0)  # Продажи в окне с экспоненциальным затуханием
+    bestseller_rank = models.PositiveIntegerField()
+    trending_rank = models.PositiveIntegerField(null=True, blank=True)
+    computed_at = models.DateTimeField()
+    class Meta:
+        indexes = [
+            models.Index(fields=['bestseller_rank']),
+            models.Index(fields=['trending_rank']),
+        ]
+    def __str__(self):
+        return f"{self.product.title}: #{self.bestseller_rank}"
 class ProductImage(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='photos')
     image = models.ImageField(upload_to='products/%Y/%m/%d/')
@@ -141,9 +208,15 @@ class Order(models.Model):
     notes = models.TextField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    local_date = LocalDateField(source='created_at')
+    local_hour = LocalHourField(source='created_at')
+    class Meta:
+        indexes = [
+            models.Index(fields=['local_date', 'local_hour']),
+        ]
     def save(self, *args, **kwargs):
         if not self.public_id:
-            self.public_id = str(uuid.uuid4())[:8].upper()
+            self.public_id = allocate_code('order')
         super().save(*args, **kwargs)
     def __str__(self):
         return f"Order {self.public_id} - {self.customer_name}"
@@ -166,13 +239,72 @@ class Review(models.Model):
         ordering = ['-created_at']
     def __str__(self):
         return f"{self.user.username} - {self.product.title} ({self.rating} stars)"
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._remember_aggregate_state()
+        return instance
+    AGGREGATE_FIELDS = ('product_id', 'rating', 'verified')
+    def _remember_aggregate_state(self):
+        # Запоминаем вклад отзыва в агрегаты товара, чтобы при обновлении применить разницу.
+        # Значения берутся из __dict__: обращение к отложенному полю (only/defer) загрузило бы
+        # его через from_db и снова пришло бы сюда. Если поля не загружены - снимка нет.
+        values = self.__dict__
+        if all(field in values for field in self.AGGREGATE_FIELDS):
+            self._aggregate_state = tuple(values[field] for field in self.AGGREGATE_FIELDS)
+        else:
+            self._aggregate_state = None
+    def save(self, *args, **kwargs):
+        # Отзыв и агрегаты товара сохраняются в одной транзакции
+        with transaction.atomic():
+            if not self._state.adding and getattr(self, '_aggregate_state', None) is None:
+                # Снимка нет (поля были отложены) - берем прежний вклад из БД до записи
+                self._aggregate_state = Review.objects.filter(pk=self.pk).values_list(*self.AGGREGATE_FIELDS).first()
+            super().save(*args, **kwargs)
+def apply_review_to_product(product_id, rating, verified, sign):
+    """Атомарно добавляет (sign=1) или вычитает (sign=-1) вклад отзыва в агрегаты товара"""
+    new_count = F('rating_count') + sign
+    new_sum = F('rating_sum') + sign * rating
+    updates = {
+        'rating_count': new_count,
+        'rating_sum': new_sum,
+        f'rating_{rating}_count': F(f'rating_{rating}_count') + sign,
+        'rating_average': Case(
+            When(rating_count=-sign, then=Value(0.0)),
+            default=Cast(new_sum, models.FloatField()) / new_count,
+            output_field=models.FloatField(),
+        ),
+    }
+    if verified:
+        updates['verified_review_count'] = F('verified_review_count') + sign
+    Product.objects.filter(pk=product_id).update(**updates)
+class RetentionCheckpoint(models.Model):
+    """
+    Позиция (последний обработанный pk) фоновых задач очистки для возобновления;
+    также отметка о разовом заполнении журнала ReferralEvent (market/event_replay.py)
+    """
+    job = models.CharField(max_length=100, unique=True)
+    position = models.BigIntegerField(default=0)
+    processed = models.BigIntegerField(default=0)  # Удалено строк с начала прохода
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    def __str__(self):
+        return f"{self.job} @ {self.position}"
+class CodeSequence(models.Model):
+    """
+    Последовательность коротких кодов (см. market/codes.py): ключ перестановки
+    и счетчик номеров для СУБД без нативных последовательностей.
+    Ключ нельзя менять - иначе новые коды могут совпасть со старыми.
+    """
+    name = models.CharField(max_length=50, unique=True)
+    key = models.CharField(max_length=64)
+    next_value = models.BigIntegerField(default=1)
+    def __str__(self):
+        return self.name
 # Referral System Models
 def generate_referral_code():
     """Генерирует уникальный код реферальной ссылки"""
-    while True:
-        code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-        if not ReferralLink.objects.filter(code=code).exists():
-            return code
+    return allocate_code('referral_link')
 class ReferralProgram(models.Model):
     """Настройки реферальной программы"""
     name = models.CharField(max_length=100, default="Default Referral Program")
@@ -195,19 +327,58 @@ class ReferralLink(models.Model):
     expires_at = models.DateTimeField(null=True, blank=True)  # Опциональная дата истечения
     # Статистика
     total_clicks = models.PositiveIntegerField(default=0)
+    repeat_clicks = models.PositiveIntegerField(default=0)  # Повторные клики, схлопнутые без записи посещения
     total_conversions = models.PositiveIntegerField(default=0)
     total_rewards = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     class Meta:
         unique_together = ['user', 'product']  # Один пользователь может создать только одну ссылку на товар
+    # Поля, которые хранит кэш разрешения кодов (market/link_resolver.py)
+    RESOLVED_FIELDS = {'code', 'user', 'user_id', 'product', 'product_id', 'is_active', 'expires_at'}
     def __str__(self):
         return f"{self.user.username} - {self.code}"
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Запоминаем код, чтобы при его смене сбросить кэш и для старого кода
+        instance._loaded_code = instance.__dict__.get('code')
+        return instance
+class UserAgent(models.Model):
+    """
+    Справочник User-Agent: строка и ее классификация хранятся один раз,
+    посещения ссылаются на id (market/user_agents.py)
+    """
+    DESKTOP = 'desktop'
+    MOBILE = 'mobile'
+    TABLET = 'tablet'
+    BOT = 'bot'
+    OTHER = 'other'
+    DEVICE_TYPE_CHOICES = [
+        (DESKTOP, 'Компьютер'),
+        (MOBILE, 'Телефон'),
+        (TABLET, 'Планшет'),
+        (BOT, 'Бот'),
+        (OTHER, 'Другое'),
+    ]
+    user_agent_hash = models.CharField(max_length=64, unique=True)  # sha256 строки: уникальный индекс по длинному тексту не строится
+    user_agent = models.TextField()
+    device_type = models.CharField(max_length=10, choices=DEVICE_TYPE_CHOICES)
+    os = models.CharField(max_length=32)
+    browser = models.CharField(max_length=32)
+    is_bot = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    def __str__(self):
+        return f"{self.device_type} / {self.os} / {self.browser}"
 class ReferralVisit(models.Model):
-    """Записи о посещениях по реферальным ссылкам"""
+    """
+    Записи о посещениях по реферальным ссылкам.
+    На Postgres таблица секционирована по месяцам (visited_at), секции ведет
+    команда manage_visit_partitions; на SQLite это обычная таблица.
+    """
     referral_link = models.ForeignKey(ReferralLink, on_delete=models.CASCADE, related_name='visits')
     anonymous_id = models.CharField(max_length=100)  # ID анонимного пользователя из cookie
     user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)  # Если пользователь залогинился
     ip_address = models.GenericIPAddressField()
-    user_agent = models.TextField()
+    agent = models.ForeignKey(UserAgent, on_delete=models.PROTECT, related_name='visits')
     page_url = models.URLField(max_length=500, null=True, blank=True)
     product_id = models.PositiveIntegerField(null=True, blank=True)
     utm_source = models.CharField(max_length=100, null=True, blank=True)
@@ -216,14 +387,73 @@ class ReferralVisit(models.Model):
     utm_term = models.CharField(max_length=100, null=True, blank=True)
     utm_content = models.CharField(max_length=100, null=True, blank=True)
     visited_at = models.DateTimeField(auto_now_add=True)
+    local_date = LocalDateField(source='visited_at')
+    local_hour = LocalHourField(source='visited_at')
     class Meta:
         indexes = [
             models.Index(fields=['anonymous_id']),
             models.Index(fields=['referral_link']),
             models.Index(fields=['visited_at']),
+            models.Index(fields=['ip_address', 'visited_at']),
+            models.Index(fields=['local_date', 'local_hour']),
+            models.Index(fields=['referral_link', 'local_date']),
         ]
     def __str__(self):
         return f"Visit {self.anonymous_id} via {self.referral_link.code}"
+    @property
+    def user_agent(self):
+        return self.agent.user_agent
+class ReferralVisitSketch(models.Model):
+    """
+    HyperLogLog-скетч уникальных посетителей за день (локальная дата) по ссылке.
+    Итог по всем ссылкам - слияние скетчей ссылок при чтении.
+    Регистры хранятся сжатыми (см. market/hll.py).
+    """
+    referral_link = models.ForeignKey(ReferralLink, on_delete=models.CASCADE, related_name='visit_sketches')
+    day = models.DateField()
+    registers = models.BinaryField()
+    updated_at = models.DateTimeField(auto_now=True)
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['referral_link', 'day'], name='unique_visit_sketch_link_day'),
+        ]
+        indexes = [
+            models.Index(fields=['day']),
+        ]
+    def __str__(self):
+        return f"Sketch {self.referral_link_id or 'all'} @ {self.day}"
+class CampaignDailyStat(models.Model):
+    """
+    Показатели UTM-кампании за день (локальная дата), ведутся инкрементально
+    (market/campaigns.py). Отсутствующая метка хранится пустой строкой, чтобы
+    уникальность работала без NULL. Посетители - HyperLogLog-скетч (market/hll.py).
+    Строка дня и меток разбита на шарды (shard), показатели - сумма шардов.
+    """
+    day = models.DateField()
+    utm_source = models.CharField(max_length=100, blank=True, default='')
+    utm_medium = models.CharField(max_length=100, blank=True, default='')
+    utm_campaign = models.CharField(max_length=100, blank=True, default='')
+    utm_term = models.CharField(max_length=100, blank=True, default='')
+    utm_content = models.CharField(max_length=100, blank=True, default='')
+    clicks = models.PositiveIntegerField(default=0)
+    conversions = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)  # Сумма заказов
+    commission = models.DecimalField(max_digits=14, decimal_places=2, default=0)  # Сумма вознаграждений
+    visitors = models.BinaryField()
+    shard = models.PositiveSmallIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['day', 'utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content', 'shard'],
+                name='unique_campaign_daily_stat',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['day']),
+        ]
+    def __str__(self):
+        return f"{self.utm_campaign or '-'} @ {self.day}"
 class ReferralAttribution(models.Model):
     """Атрибуция реферальных покупок"""
     anonymous_id = models.CharField(max_length=100)
@@ -232,13 +462,18 @@ class ReferralAttribution(models.Model):
     product = models.ForeignKey('Product', on_delete=models.CASCADE)
     expires_at = models.DateTimeField()  # Когда истекает атрибуция
     created_at = models.DateTimeField(auto_now_add=True)
-    last_visit = models.ForeignKey(ReferralVisit, on_delete=models.CASCADE)
+    # Без ограничения в БД: на Postgres ReferralVisit секционирована по visited_at,
+    # и первичный ключ (id, visited_at) не может быть целью внешнего ключа по id
+    last_visit = models.ForeignKey(ReferralVisit, on_delete=models.CASCADE, db_constraint=False)
+    local_date = LocalDateField(source='created_at')
+    local_hour = LocalHourField(source='created_at')
     class Meta:
         unique_together = ['anonymous_id', 'product']  # Одна атрибуция на товар для анонимного пользователя
         indexes = [
             models.Index(fields=['anonymous_id']),
             models.Index(fields=['user']),
             models.Index(fields=['expires_at']),
+            models.Index(fields=['local_date', 'local_hour']),
         ]
     def __str__(self):
         return f"Attribution {self.anonymous_id} -> {self.referral_link.user.username}"
@@ -270,14 +505,51 @@ class ReferralReward(models.Model):
     ip_address = models.GenericIPAddressField()
     user_agent = models.TextField()
     fraud_score = models.FloatField(default=0.0)  # Оценка вероятности мошенничества
+    fraud_scored_at = models.DateTimeField(null=True, blank=True)  # Когда рассчитана оценка (команда score_referral_fraud)
+    # Посещение, к которому атрибутирована покупка (его UTM-метки - кампания конверсии).
+    # Без ограничения в БД по той же причине, что ReferralAttribution.last_visit
+    attributed_visit = models.ForeignKey(
+        ReferralVisit, on_delete=models.SET_NULL, null=True, blank=True, db_constraint=False, related_name='+'
+    )
+    local_date = LocalDateField(source='created_at')
+    local_hour = LocalHourField(source='created_at')
     class Meta:
         indexes = [
             models.Index(fields=['attributed_user']),
             models.Index(fields=['status']),
             models.Index(fields=['created_at']),
+            models.Index(fields=['fraud_scored_at']),
+            models.Index(fields=['local_date', 'local_hour']),
+            models.Index(fields=['referral_link', 'local_date']),
         ]
     def __str__(self):
         return f"Reward {self.reward_amount} for {self.attributed_user.username}"
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Запоминаем состояние, чтобы писать в журнал событий только его изменения
+        if {'status', 'locked_amount', 'available_amount'} <= set(field_names):
+            instance._event_state = instance.event_state()
+        return instance
+    def event_state(self):
+        """(статус, сумма на балансе) для журнала событий: заблокированная у ожидающего, доступная у одобренного"""
+        if self.status == 'PENDING':
+            return self.status, self.locked_amount
+        if self.status == 'APPROVED':
+            return self.status, self.available_amount
+        return self.status, 0
+    def counted_change(self, created, previous_status):
+        """
+        Изменение учета вознаграждения в счетчиках конверсий (+1, -1 или 0): учитываются
+        все, кроме REVERSED. previous_status - статус до сохранения (None - неизвестен).
+        """
+        if created:
+            counted_before = False
+        elif previous_status is None:
+            return 0
+        else:
+            counted_before = previous_status != 'REVERSED'
+        return int(self.status != 'REVERSED') - int(counted_before)
 class ReferralPayout(models.Model):
     """Запросы на выплату реферальных вознаграждений"""
     STATUS_CHOICES = [
@@ -303,8 +575,25 @@ class ReferralPayout(models.Model):
     rejection_reason = models.TextField(null=True, blank=True)
     # Связанные вознаграждения
     rewards = models.ManyToManyField(ReferralReward, related_name='payouts')
+    settlement_run = models.ForeignKey('PayoutSettlementRun', on_delete=models.SET_NULL, null=True, blank=True, related_name='payouts')
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+        ]
     def __str__(self):
         return f"Payout {self.amount} for {self.user.username}"
+class PayoutSettlementRun(models.Model):
+    """Пакетная обработка выплат (повторный запуск с тем же run_id ничего не меняет)"""
+    run_id = models.CharField(max_length=64, unique=True)
+    processed_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='settlement_runs')
+    payouts_count = models.PositiveIntegerField(default=0)  # Выполнено выплат
+    skipped_count = models.PositiveIntegerField(default=0)  # Пропущено (недостаточно одобренных вознаграждений)
+    rewards_count = models.PositiveIntegerField(default=0)  # Связано вознаграждений
+    total_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    def __str__(self):
+        return f"Settlement {self.run_id}: {self.payouts_count} payouts"
 class ReferralBalance(models.Model):
     """Баланс реферальных вознаграждений пользователя"""
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='referral_balance')
@@ -322,13 +611,111 @@ class ReferralBalance(models.Model):
         self.locked_amount = sum(reward.locked_amount for reward in rewards if reward.status == 'PENDING')
         self.available_amount = sum(
             reward.available_amount for reward in rewards
-            if reward.status in ['APPROVED', 'PAID_OUT']
-        )
-        self.total_paid_out = sum(
-            reward.available_amount for reward in rewards
-            if reward.status == 'PAID_OUT'
+            if reward.status == 'APPROVED'
         )
+        self.total_paid_out = ReferralPayout.objects.filter(
+            user=self.user, status='COMPLETED'
+        ).aggregate(total=models.Sum('amount'))['total'] or 0
         self.save()
+class ReferralEvent(models.Model):
+    """
+    Журнал реферальных событий (только добавление; пишется через market/referral_events.py),
+    из которого market/event_replay.py пересчитывает счетчики ссылок и балансы. Ссылки на объекты - просто числа без
+    внешних ключей: журнал компактный и переживает удаление строк.
+    """
+    CLICK = 1
+    ATTRIBUTION = 2
+    CONVERSION = 3
+    REWARD_STATE = 4
+    PAYOUT = 5
+    KIND_CHOICES = [
+        (CLICK, 'Переход'),
+        (ATTRIBUTION, 'Атрибуция'),
+        (CONVERSION, 'Конверсия'),
+        (REWARD_STATE, 'Состояние вознаграждения'),
+        (PAYOUT, 'Выплата'),
+    ]
+    id = models.BigAutoField(primary_key=True)
+    kind = models.PositiveSmallIntegerField(choices=KIND_CHOICES)
+    referrer_id = models.PositiveIntegerField()  # Владелец ссылки или получатель выплаты - ключ шардирования
+    referral_link_id = models.PositiveIntegerField(null=True, blank=True)
+    object_id = models.BigIntegerField(null=True, blank=True)  # Посещение, вознаграждение или выплата
+    product_id = models.PositiveIntegerField(null=True, blank=True)
+    status = models.CharField(max_length=20, blank=True)
+    amount = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    occurred_at = models.DateTimeField(default=timezone.now)
+    class Meta:
+        indexes = [
+            models.Index(fields=['referrer_id', 'id']),
+        ]
+    def __str__(self):
+        return f"Event {self.get_kind_display()} for {self.referrer_id}"
+@receiver(post_save, sender=Review)
+def update_product_rating_on_review_save(sender, instance, created, raw=False, **kwargs):
+    """Поддерживает агрегаты оценок товара при создании и изменении отзыва"""
+    if raw:
+        return
+    new_state = (instance.product_id, instance.rating, instance.verified)
+    old_state = None if created else getattr(instance, '_aggregate_state', None)
+    if old_state == new_state:
+        return
+    if old_state is not None:
+        apply_review_to_product(*old_state, sign=-1)
+    apply_review_to_product(*new_state, sign=1)
+    instance._remember_aggregate_state()
+@receiver(pre_delete, sender=Review)
+def remember_review_state_before_delete(sender, instance, **kwargs):
+    """Загружает вклад отзыва до удаления, если поля были отложены (после удаления строки нет)"""
+    if getattr(instance, '_aggregate_state', None) is None:
+        instance._aggregate_state = Review.objects.filter(pk=instance.pk).values_list(*Review.AGGREGATE_FIELDS).first()
+@receiver(post_delete, sender=Review)
+def update_product_rating_on_review_delete(sender, instance, **kwargs):
+    """Вычитает удаленный отзыв из агрегатов товара"""
+    state = getattr(instance, '_aggregate_state', None)
+    if state is not None:
+        apply_review_to_product(*state, sign=-1)
+@receiver(post_save, sender=ReferralProgram)
+@receiver(post_delete, sender=ReferralProgram)
+def invalidate_attribution_window_on_change(sender, **kwargs):
+    """Окно атрибуции кэшируется (market/attribution.py) - сбрасываем при изменении программы"""
+    invalidate_attribution_window()
+@receiver(post_save, sender=ReferralLink)
+def invalidate_referral_code_on_save(sender, instance, update_fields=None, **kwargs):
+    """Сбрасывает кэш разрешения кода, если изменились кэшируемые поля"""
+    if update_fields is not None and not ReferralLink.RESOLVED_FIELDS & set(update_fields):
+        return
+    invalidate_referral_code(instance.code)
+    loaded_code = getattr(instance, '_loaded_code', None)
+    if loaded_code != instance.code:
+        invalidate_referral_code(loaded_code)
+    instance._loaded_code = instance.code
+@receiver(post_delete, sender=ReferralLink)
+def invalidate_referral_code_on_delete(sender, instance, **kwargs):
+    invalidate_referral_code(instance.code)
+    invalidate_referral_code(getattr(instance, '_loaded_code', None))
+@receiver(post_save, sender=ReferralReward)
+def log_reward_event(sender, instance, created, raw=False, **kwargs):
+    """
+    Пишет в журнал событий создание вознаграждения и смену его состояния, обновляет
+    счетчики конверсий ссылки (без REVERSED, как при пересчете по журналу) и статистику кампании
+    """
+    if raw:
+        return
+    previous_state = getattr(instance, '_event_state', None)
+    sign = instance.counted_change(created, previous_state[0] if previous_state else None)
+    log_reward_change(instance, created)
+    if sign:
+        ReferralLink.objects.filter(pk=instance.referral_link_id).update(
+            total_conversions=F('total_conversions') + sign,
+            total_rewards=F('total_rewards') + sign * instance.reward_amount,
+        )
+    record_reward_change(instance, sign)
+@receiver(post_save, sender=ReferralPayout)
+def log_payout_event(sender, instance, raw=False, **kwargs):
+    """Пишет в журнал событий состояние выплаты (пакетные выплаты пишут его сами)"""
+    if raw:
+        return
+    log_payout(instance)
 # Сигналы для автоматического обновления баланса
 @receiver(post_save, sender=ReferralReward)
 def update_user_balance_on_reward_change(sender, instance, **kwargs):
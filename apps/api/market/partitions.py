@@ -0,0 +1,112 @@
+"""
+Помесячные секции таблицы ReferralVisit (только Postgres).
+
+Родительская таблица market_referralvisit секционирована RANGE (visited_at),
+секции называются market_referralvisit_pYYYYMM. Секция по умолчанию
+(market_referralvisit_default) принимает строки вне созданных диапазонов,
+поэтому будущие секции нужно создавать заранее - иначе при появлении в ней
+строк нового месяца создать секцию на этот месяц уже не получится.
+"""
+import re
+from datetime import date
+
+from django.db import connection, transaction
+
+from .models import ReferralAttribution, ReferralVisit
+
+PARENT_TABLE = ReferralVisit._meta.db_table
+DEFAULT_PARTITION = f'{PARENT_TABLE}_default'
+PARTITION_RE = re.compile(rf'^{PARENT_TABLE}_p(\d{{4}})(\d{{2}})$')
+
+
+def is_supported():
+    return connection.vendor == 'postgresql'
+
+
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def add_months(day, months):
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f'{PARENT_TABLE}_p{month:%Y%m}'
+
+
+def is_partitioned():
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+            "WHERE c.relname = %s",
+            [PARENT_TABLE],
+        )
+        return cursor.fetchone() is not None
+
+
+def list_partitions():
+    """Список (месяц, имя секции) присоединенных помесячных секций"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = %s",
+            [PARENT_TABLE],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+    partitions = []
+    for name in names:
+        match = PARTITION_RE.match(name)
+        if match:
+            partitions.append((date(int(match.group(1)), int(match.group(2)), 1), name))
+    return sorted(partitions)
+
+
+def create_partition(month):
+    """Создает секцию на месяц month (если ее еще нет). Возвращает True, если создана."""
+    month = month_start(month)
+    name = partition_name(month)
+    if name in {existing for _, existing in list_partitions()}:
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "{PARENT_TABLE}" '
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+        )
+    return True
+
+
+def ensure_future_partitions(months_ahead=3, today=None):
+    """Создает секции с текущего месяца на months_ahead месяцев вперед"""
+    current = month_start(today or date.today())
+    return [
+        partition_name(add_months(current, i))
+        for i in range(months_ahead + 1)
+        if create_partition(add_months(current, i))
+    ]
+
+
+def drop_old_partitions(retain_months=3, detach_only=False, today=None):
+    """
+    Отсоединяет (и, если не detach_only, удаляет) секции старше retain_months месяцев.
+    Атрибуции, ссылающиеся на удаляемые посещения, удаляются одним запросом,
+    как это делал бы каскад ORM.
+    """
+    cutoff = add_months(month_start(today or date.today()), -retain_months)
+    removed = []
+    for month, name in list_partitions():
+        if month >= cutoff:
+            continue
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'ALTER TABLE "{PARENT_TABLE}" DETACH PARTITION "{name}"')
+            if not detach_only:
+                cursor.execute(
+                    f'DELETE FROM "{ReferralAttribution._meta.db_table}" '
+                    f'WHERE last_visit_id IN (SELECT id FROM "{name}")'
+                )
+                cursor.execute(f'DROP TABLE "{name}"')
+        removed.append(name)
+    return removed
@@ -1,10 +1,16 @@
+import os
+
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, parser_classes, permission_classes
+from rest_framework.parsers import MultiPartParser
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
 from rest_framework import status
 from .models import Product, Category, ProductImage
 from .serializers import ProductSerializer
+from .catalog import CATALOG_COLUMNS, CatalogImportError, catalog_rows, import_catalog
+from .exports import stream_csv, stream_jsonl
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
@@ -95,3 +101,50 @@ def vendor_get_product(request, product_id):
 def get_categories(request):
     categories = Category.objects.filter(is_active=True)
     return Response([{'id': c.id, 'name': c.name} for c in categories])
+
+
+CATALOG_OUTPUTS = {
+    'csv': (stream_csv, 'text/csv; charset=utf-8'),
+    'jsonl': (stream_jsonl, 'application/x-ndjson; charset=utf-8'),
+}
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+@parser_classes([MultiPartParser])
+def vendor_catalog_import(request):
+    """
+    Пакетный импорт каталога: multipart с полями file (.csv или .jsonl) и images (zip, необязательно)
+    """
+    if request.user.role != 'vendor':
+        return Response({'error': 'Access denied'}, status=status.HTTP_403_FORBIDDEN)
+
+    upload = request.FILES.get('file')
+    if not upload:
+        return Response({'error': 'file is required'}, status=status.HTTP_400_BAD_REQUEST)
+    input_format = os.path.splitext(upload.name)[1].lstrip('.').lower()
+    if input_format not in CATALOG_OUTPUTS:
+        return Response({'error': 'file must be .csv or .jsonl'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        report = import_catalog(request.user, upload, input_format, images_zip=request.FILES.get('images'))
+    except CatalogImportError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(report, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def vendor_catalog_export(request):
+    """Потоковая выгрузка каталога продавца: ?output=csv|jsonl (формат совместим с импортом)"""
+    if request.user.role != 'vendor':
+        return Response({'error': 'Access denied'}, status=status.HTTP_403_FORBIDDEN)
+
+    output = request.query_params.get('output', 'csv')
+    if output not in CATALOG_OUTPUTS:
+        return Response({'error': 'output must be csv or jsonl'}, status=status.HTTP_400_BAD_REQUEST)
+
+    writer, content_type = CATALOG_OUTPUTS[output]
+    response = StreamingHttpResponse(writer(CATALOG_COLUMNS, catalog_rows(request.user)), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="catalog-{request.user.username}.{output}"'
+    return response
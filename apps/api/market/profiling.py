@@ -0,0 +1,192 @@
+"""
+Выборочное профилирование запросов по эндпоинтам.
+
+ProfilingMiddleware включается настройкой PROFILING_ENABLED и замеряет только
+долю запросов PROFILING_SAMPLE_RATE: время обработки, количество и время
+SQL-запросов (connection.execute_wrapper), время сериализаторов DRF
+(BaseSerializer.data) и размер ответа. Замеры складываются в гистограммы в
+памяти процесса (у каждого воркера свои) и отдаются в формате Prometheus
+эндпоинтом admin/metrics/.
+"""
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from rest_framework.serializers import BaseSerializer
+
+METRIC_PREFIX = 'market'
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# (метрика, описание, границы корзин)
+HISTOGRAMS = (
+    ('request_duration_seconds', 'Wall time of sampled requests', DURATION_BUCKETS),
+    ('db_queries', 'SQL queries per sampled request', QUERY_COUNT_BUCKETS),
+    ('db_duration_seconds', 'SQL time per sampled request', DURATION_BUCKETS),
+    ('serializer_duration_seconds', 'DRF serializer time per sampled request', DURATION_BUCKETS),
+    ('response_size_bytes', 'Response body size of sampled requests', SIZE_BUCKETS),
+)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """Гистограммы по (view, method) в памяти процесса"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, labels, values):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = {name: Histogram(buckets) for name, _, buckets in HISTOGRAMS}
+            for name, value in values.items():
+                if value is not None:
+                    series[name].observe(value)
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+
+    def render(self):
+        """Текст в формате Prometheus exposition 0.0.4"""
+        with self._lock:
+            snapshot = sorted(self._series.items())
+            lines = [
+                f'# HELP {METRIC_PREFIX}_profiling_sample_rate Fraction of requests being profiled',
+                f'# TYPE {METRIC_PREFIX}_profiling_sample_rate gauge',
+                f'{METRIC_PREFIX}_profiling_sample_rate {_sample_rate()}',
+            ]
+            for name, description, buckets in HISTOGRAMS:
+                metric = f'{METRIC_PREFIX}_{name}'
+                lines.append(f'# HELP {metric} {description}')
+                lines.append(f'# TYPE {metric} histogram')
+                for (view, method), series in snapshot:
+                    histogram = series[name]
+                    labels = f'view="{_escape(view)}",method="{method}"'
+                    cumulative = 0
+                    for bound, count in zip(buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                    lines.append(f'{metric}_sum{{{labels}}} {histogram.sum:.6f}')
+                    lines.append(f'{metric}_count{{{labels}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+_local = threading.local()
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _sample_rate():
+    return getattr(settings, 'PROFILING_SAMPLE_RATE', 0.01)
+
+
+class _RequestStats:
+    __slots__ = ('queries', 'db_time', 'serializer_time', 'serializer_depth')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.serializer_depth = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        # Обертка connection.execute_wrapper
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - started
+            self.queries += 1
+
+
+_original_serializer_data = BaseSerializer.data
+
+
+def _timed_serializer_data(self):
+    stats = getattr(_local, 'stats', None)
+    if stats is None or stats.serializer_depth:
+        return _original_serializer_data.fget(self)
+    stats.serializer_depth += 1
+    started = time.perf_counter()
+    try:
+        return _original_serializer_data.fget(self)
+    finally:
+        stats.serializer_time += time.perf_counter() - started
+        stats.serializer_depth -= 1
+
+
+def _patch_serializers():
+    if BaseSerializer.data is _original_serializer_data:
+        BaseSerializer.data = property(_timed_serializer_data)
+
+
+def _view_label(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return '<unresolved>'
+    return match.view_name or match._func_path
+
+
+class ProfilingMiddleware:
+    """Замеры выборки запросов; без PROFILING_ENABLED исключается из цепочки"""
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILING_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        _patch_serializers()
+
+    def __call__(self, request):
+        if random.random() >= _sample_rate():
+            return self.get_response(request)
+
+        stats = _RequestStats()
+        _local.stats = stats
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(stats))
+                response = self.get_response(request)
+        finally:
+            _local.stats = None
+        duration = time.perf_counter() - started
+
+        registry.observe((_view_label(request), request.method), {
+            'request_duration_seconds': duration,
+            'db_queries': stats.queries,
+            'db_duration_seconds': stats.db_time,
+            'serializer_duration_seconds': stats.serializer_time,
+            # Для потоковых ответов размер заранее неизвестен
+            'response_size_bytes': None if response.streaming else len(response.content),
+        })
+        return response
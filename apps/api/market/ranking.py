@@ -0,0 +1,156 @@
+"""
+Рейтинг продаж: счетчики продаж товаров, трендовые товары и бестселлеры
+"""
+import math
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Sum
+from django.utils import timezone
+
+from .models import OrderItem, Product, ProductSalesRank, ReferralReward
+
+# Статусы заказов, продажи по которым учитываются в рейтинге
+CONFIRMED_ORDER_STATUSES = ['processing', 'shipped', 'delivered']
+
+TRENDING_WINDOW_DAYS = 30
+TRENDING_HALF_LIFE_DAYS = 7
+
+
+def confirmed_order_items():
+    """Позиции подтвержденных заказов"""
+    return OrderItem.objects.filter(order__status__in=CONFIRMED_ORDER_STATUSES).order_by()
+
+
+def _units_by_product(items):
+    return dict(
+        items.values('product_id')
+        .annotate(units=Sum('quantity'))
+        .values_list('product_id', 'units')
+    )
+
+
+def update_sales_counters(batch_size=1000):
+    """
+    Пересчитывает Product.total_sales, total_referral_sales и sales_percentage
+    по подтвержденным заказам. Возвращает количество измененных товаров.
+    """
+    items = confirmed_order_items()
+    referral_rewards = ReferralReward.objects.filter(
+        order_id=OuterRef('order_id'),
+        product_id=OuterRef('product_id'),
+    ).exclude(status='REVERSED')
+
+    total_units = _units_by_product(items)
+    referral_units = _units_by_product(items.filter(Exists(referral_rewards)))
+    grand_total = sum(total_units.values())
+
+    fields = ['total_sales', 'total_referral_sales', 'sales_percentage']
+    changed = []
+    updated = 0
+    products = Product.objects.only(*fields).order_by('pk')
+    for product in products.iterator(chunk_size=batch_size):
+        total_sales = total_units.get(product.pk, 0)
+        total_referral_sales = referral_units.get(product.pk, 0)
+        # Доля товара в общем объеме продаж, %
+        sales_percentage = (
+            (Decimal(total_sales) * 100 / grand_total).quantize(Decimal('0.01'))
+            if grand_total else Decimal('0.00')
+        )
+        if (product.total_sales, product.total_referral_sales, product.sales_percentage) == (
+            total_sales, total_referral_sales, sales_percentage
+        ):
+            continue
+        product.total_sales = total_sales
+        product.total_referral_sales = total_referral_sales
+        product.sales_percentage = sales_percentage
+        changed.append(product)
+        if len(changed) >= batch_size:
+            Product.objects.bulk_update(changed, fields)
+            updated += len(changed)
+            changed = []
+    if changed:
+        Product.objects.bulk_update(changed, fields)
+        updated += len(changed)
+    return updated
+
+
+def compute_trending_scores(now=None, window_days=TRENDING_WINDOW_DAYS, half_life_days=TRENDING_HALF_LIFE_DAYS):
+    """
+    Считает трендовый балл товаров: продажи за окно window_days, где вклад
+    каждого дня затухает экспоненциально с периодом полураспада half_life_days.
+    Возвращает {product_id: (units, score)}.
+    """
+    now = now or timezone.now()
+    today = timezone.localdate(now)
+    decay = math.log(2) / half_life_days
+
+    daily_units = (
+        confirmed_order_items()
+        .filter(order__created_at__gte=now - timedelta(days=window_days))
+        .values('product_id', day=F('order__local_date'))
+        .annotate(units=Sum('quantity'))
+        .values_list('product_id', 'day', 'units')
+    )
+
+    scores = defaultdict(lambda: [0, 0.0])
+    for product_id, day, units in daily_units.iterator():
+        age_days = max((today - day).days, 0)
+        entry = scores[product_id]
+        entry[0] += units
+        entry[1] += units * math.exp(-decay * age_days)
+    return {product_id: (units, score) for product_id, (units, score) in scores.items()}
+
+
+def rebuild_sales_rankings(now=None, window_days=TRENDING_WINDOW_DAYS, half_life_days=TRENDING_HALF_LIFE_DAYS):
+    """Пересобирает таблицу ProductSalesRank. Возвращает количество товаров в рейтинге."""
+    now = now or timezone.now()
+    total_units = _units_by_product(confirmed_order_items())
+    trending = compute_trending_scores(now, window_days, half_life_days)
+
+    product_ids = set(total_units) | set(trending)
+    bestseller_order = sorted(product_ids, key=lambda pk: (-total_units.get(pk, 0), pk))
+    trending_order = sorted(
+        (pk for pk in product_ids if pk in trending),
+        key=lambda pk: (-trending[pk][1], pk),
+    )
+    trending_ranks = {pk: rank for rank, pk in enumerate(trending_order, start=1)}
+
+    ranks = [
+        ProductSalesRank(
+            product_id=pk,
+            total_sales=total_units.get(pk, 0),
+            trending_units=trending.get(pk, (0, 0.0))[0],
+            trending_score=trending.get(pk, (0, 0.0))[1],
+            bestseller_rank=rank,
+            trending_rank=trending_ranks.get(pk),
+            computed_at=now,
+        )
+        for rank, pk in enumerate(bestseller_order, start=1)
+    ]
+
+    with transaction.atomic():
+        ProductSalesRank.objects.all().delete()
+        ProductSalesRank.objects.bulk_create(ranks, batch_size=1000)
+    return len(ranks)
+
+
+def trending_products(limit=8):
+    """Активные товары по трендовому рейтингу (с откатом на общие продажи)"""
+    queryset = (
+        Product.objects.filter(is_active=True, sales_rank__trending_rank__isnull=False)
+        .order_by('sales_rank__trending_rank')
+    )
+    if not queryset.exists():
+        queryset = Product.objects.filter(is_active=True).order_by('-total_sales')
+    return queryset[:limit]
+
+
+def bestseller_products(limit=20):
+    """Активные товары по количеству продаж"""
+    return (
+        Product.objects.filter(is_active=True, sales_rank__isnull=False)
+        .order_by('sales_rank__bestseller_rank')[:limit]
+    )
@@ -0,0 +1,29 @@
+"""
+Общий клиент Redis (REDIS_URL) для структур, которых нет в API кэша Django:
+Lua-скрипты, битовые карты, очереди. Без REDIS_URL или пакета redis
+get_client() возвращает None, и вызывающий код работает в памяти процесса.
+"""
+import threading
+
+from django.conf import settings
+
+try:
+    import redis
+except ImportError:  # Redis не обязателен
+    redis = None
+
+RedisError = redis.RedisError if redis is not None else Exception
+
+_client = None
+_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    url = getattr(settings, 'REDIS_URL', None)
+    if not url or redis is None:
+        return None
+    with _lock:
+        if _client is None:
+            _client = redis.Redis.from_url(url)
+        return _client
@@ -0,0 +1,97 @@
+"""
+Запись событий в журнал ReferralEvent (только добавление).
+
+Переход - одно записанное посещение, конверсия - создание вознаграждения.
+Состояние вознаграждения (статус и сумма на балансе) и выплаты (статус и сумма)
+пишутся снимками, а не приращениями: повторная запись того же состояния
+безопасна, при пересчете (market/event_replay.py) побеждает последнее.
+Модели загружаются лениво: модуль импортируется из models.py.
+"""
+from django.apps import apps
+
+BATCH_SIZE = 1000
+
+
+def _event(**fields):
+    if fields.get('occurred_at') is None:
+        fields.pop('occurred_at', None)  # Время записи по умолчанию
+    return apps.get_model('market', 'ReferralEvent')(**fields)
+
+
+def log_events(events, batch_size=BATCH_SIZE):
+    events = list(events)
+    if events:
+        apps.get_model('market', 'ReferralEvent').objects.bulk_create(events, batch_size=batch_size)
+    return len(events)
+
+
+def click_event(visit, referrer_id):
+    ReferralEvent = apps.get_model('market', 'ReferralEvent')
+    return _event(
+        kind=ReferralEvent.CLICK, referrer_id=referrer_id, referral_link_id=visit.referral_link_id,
+        object_id=visit.pk, product_id=visit.product_id, occurred_at=visit.visited_at,
+    )
+
+
+def attribution_event(record, referrer_id, occurred_at):
+    """record - AttributionRecord (market/attribution.py)"""
+    ReferralEvent = apps.get_model('market', 'ReferralEvent')
+    return _event(
+        kind=ReferralEvent.ATTRIBUTION, referrer_id=referrer_id, referral_link_id=record.referral_link_id,
+        object_id=record.last_visit_id, product_id=record.product_id, occurred_at=occurred_at,
+    )
+
+
+def conversion_event(reward_id, referrer_id, link_id, product_id, reward_amount, occurred_at):
+    ReferralEvent = apps.get_model('market', 'ReferralEvent')
+    return _event(
+        kind=ReferralEvent.CONVERSION, referrer_id=referrer_id, referral_link_id=link_id,
+        object_id=reward_id, product_id=product_id, amount=reward_amount, occurred_at=occurred_at,
+    )
+
+
+def reward_state_event(reward_id, referrer_id, status, amount, occurred_at):
+    ReferralEvent = apps.get_model('market', 'ReferralEvent')
+    return _event(
+        kind=ReferralEvent.REWARD_STATE, referrer_id=referrer_id, object_id=reward_id,
+        status=status, amount=amount, occurred_at=occurred_at,
+    )
+
+
+def payout_event(payout_id, user_id, status, amount, occurred_at):
+    ReferralEvent = apps.get_model('market', 'ReferralEvent')
+    return _event(
+        kind=ReferralEvent.PAYOUT, referrer_id=user_id, object_id=payout_id,
+        status=status, amount=amount, occurred_at=occurred_at,
+    )
+
+
+def log_click(visit, referrer_id, attributions=()):
+    """Переход и атрибуции по нему - одной вставкой"""
+    return log_events([
+        click_event(visit, referrer_id),
+        *[attribution_event(record, referrer_id, visit.visited_at) for record in attributions],
+    ])
+
+
+def log_reward_change(reward, created):
+    """Конверсия при создании вознаграждения и новое состояние, если оно изменилось"""
+    state = reward.event_state()
+    if not created and getattr(reward, '_event_state', None) == state:
+        return 0
+    occurred_at = reward.created_at if created else None
+    events = []
+    if created:
+        events.append(conversion_event(
+            reward.pk, reward.attributed_user_id, reward.referral_link_id, reward.product_id,
+            reward.reward_amount, occurred_at,
+        ))
+    events.append(reward_state_event(reward.pk, reward.attributed_user_id, *state, occurred_at))
+    reward._event_state = state
+    return log_events(events)
+
+
+def log_payout(payout):
+    return log_events([payout_event(
+        payout.pk, payout.user_id, payout.status, payout.amount, payout.processed_at or payout.created_at,
+    )])
@@ -6,7 +6,12 @@ import hashlib
 from django.utils import timezone
 from django.db import transaction
 from django.conf import settings
-from .models import ReferralAttribution, ReferralReward, ReferralBalance
+from .attribution import find_attribution
+from .codes import allocate_code
+from .models import ReferralReward, ReferralBalance
+
+# Подпись cookie: склейка с пользователем доверяет только выданным сервером anonymous_id
+ANONYMOUS_ID_COOKIE_SALT = 'market.anonymous_id'
 
 def generate_anonymous_id():
     """Генерирует уникальный ID для анонимного пользователя"""
@@ -14,20 +19,25 @@ def generate_anonymous_id():
 
 def generate_referral_code():
     """Генерирует уникальный код реферальной ссылки"""
-    return str(uuid.uuid4())[:8].upper()
+    return allocate_code('referral_link')
+
+def read_anonymous_id(request):
+    """anonymous_id из подписанной сервером cookie; None, если cookie нет или подпись неверна"""
+    return request.get_signed_cookie('anonymous_id', default=None, salt=ANONYMOUS_ID_COOKIE_SALT)
 
 def get_or_create_anonymous_id(request):
     """Получает или создает anonymous_id для пользователя"""
-    anonymous_id = request.COOKIES.get('anonymous_id')
+    anonymous_id = read_anonymous_id(request)
     if not anonymous_id:
         anonymous_id = generate_anonymous_id()
     return anonymous_id
 
 def set_anonymous_id_cookie(response, anonymous_id):
-    """Устанавливает cookie с anonymous_id"""
-    response.set_cookie(
-        'anonymous_id', 
-        anonymous_id, 
+    """Устанавливает подписанную cookie с anonymous_id"""
+    response.set_signed_cookie(
+        'anonymous_id',
+        anonymous_id,
+        salt=ANONYMOUS_ID_COOKIE_SALT,
         max_age=365*24*60*60,  # 1 год
         httponly=True,
         secure=settings.DEBUG == False,  # HTTPS только в продакшене
@@ -62,24 +72,10 @@ def track_referral_from_url(request, product_slug=None):
 
 def get_referral_attribution_for_product(anonymous_id, user, product):
     """
-    Получает активную атрибуцию для товара
+    Получает активную атрибуцию для товара (из хранилища атрибуций с TTL, см. market/attribution.py)
     """
-    if user and user.is_authenticated:
-        # Ищем по пользователю
-        attribution = ReferralAttribution.objects.filter(
-            user=user,
-            product=product,
-            expires_at__gt=timezone.now()
-        ).first()
-    else:
-        # Ищем по anonymous_id
-        attribution = ReferralAttribution.objects.filter(
-            anonymous_id=anonymous_id,
-            product=product,
-            expires_at__gt=timezone.now()
-        ).first()
-    
-    return attribution
+    user_id = user.id if user and user.is_authenticated else None
+    return find_attribution(anonymous_id, user_id, product.id)
 
 def create_referral_reward_for_order(order, anonymous_id=None, user=None):
     """
@@ -150,14 +146,11 @@ def create_single_referral_reward(attribution, order, order_item):
             locked_amount=reward_amount,  # Блокируем всю сумму
             fraud_score=0.0,  # Будет рассчитано позже
             ip_address=attribution.last_visit.ip_address,
-            user_agent=attribution.last_visit.user_agent
+            user_agent=attribution.last_visit.agent.user_agent,
+            attributed_visit_id=attribution.last_visit_id
         )
         
-        # Обновляем статистику реферальной ссылки
-        attribution.referral_link.total_conversions += 1
-        attribution.referral_link.total_rewards += reward_amount
-        attribution.referral_link.save(update_fields=['total_conversions', 'total_rewards'])
-        
+        # Счетчики ссылки обновляет обработчик post_save вознаграждения
         return reward
         
     except Exception as e:
@@ -0,0 +1,119 @@
+"""
+Очистка старых реферальных данных пачками по диапазонам первичного ключа.
+
+Каждая пачка удаляется отдельным коротким запросом (без загрузки всей таблицы
+в сборщик удаления Django), позиция сохраняется в RetentionCheckpoint, поэтому
+прерванную очистку можно продолжить с места остановки.
+"""
+import gzip
+import json
+import os
+import time
+from datetime import timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import F, Max, Min
+from django.utils import timezone
+
+from .models import ReferralAttribution, ReferralVisit, RetentionCheckpoint
+
+VISITS_JOB = 'prune_referral_visits'
+ATTRIBUTIONS_JOB = 'prune_expired_attributions'
+
+VISIT_ARCHIVE_FIELDS = [
+    'id', 'visited_at', 'referral_link_id', 'anonymous_id', 'user_id', 'ip_address',
+    'page_url', 'product_id', 'utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content',
+]
+
+
+def _start_position(job, queryset, resume):
+    """Начальный pk: сохраненная позиция (при resume) или минимальный pk кандидатов"""
+    first_pk = queryset.aggregate(first=Min('pk'))['first']
+    if first_pk is None:
+        return None
+    if resume:
+        checkpoint = RetentionCheckpoint.objects.filter(job=job, finished_at__isnull=True).first()
+        if checkpoint:
+            return max(checkpoint.position, first_pk)
+    RetentionCheckpoint.objects.update_or_create(
+        job=job, defaults={'position': first_pk, 'processed': 0, 'finished_at': None}
+    )
+    return first_pk
+
+
+def _save_position(job, position, deleted):
+    RetentionCheckpoint.objects.filter(job=job).update(
+        position=position,
+        processed=F('processed') + deleted,
+        updated_at=timezone.now(),
+    )
+
+
+def _finish(job):
+    RetentionCheckpoint.objects.filter(job=job).update(finished_at=timezone.now())
+
+
+def _archive_rows(path, rows):
+    """Дописывает строки в gzip JSONL (каждая пачка - отдельный gzip-член файла)"""
+    with gzip.open(path, 'at', encoding='utf-8') as archive:
+        for row in rows:
+            archive.write(json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False))
+            archive.write('\n')
+
+
+def _chunked_prune(job, queryset, delete_chunk, chunk_size, sleep, resume):
+    """
+    Проходит диапазоны pk от начальной позиции до максимального pk кандидатов.
+    delete_chunk(chunk_queryset) удаляет пачку и возвращает количество удаленных строк.
+    Генерирует (удалено в пачке, секунд на пачку).
+    """
+    position = _start_position(job, queryset, resume)
+    if position is None:
+        _finish(job)
+        return
+    last_pk = queryset.aggregate(last=Max('pk'))['last']
+
+    while position <= last_pk:
+        upper = position + chunk_size
+        started = time.monotonic()
+        with transaction.atomic():
+            deleted = delete_chunk(queryset.filter(pk__gte=position, pk__lt=upper))
+            _save_position(job, upper, deleted)
+        yield deleted, time.monotonic() - started
+        position = upper
+        if sleep and position <= last_pk:
+            time.sleep(sleep)
+    _finish(job)
+
+
+def prune_referral_visits(days=90, chunk_size=5000, sleep=0.0, resume=False, archive_dir=None):
+    """
+    Удаляет посещения старше days дней (вместе с атрибуциями, ссылающимися на них).
+    При archive_dir строки предварительно сохраняются в gzip JSONL.
+    """
+    cutoff = timezone.now() - timedelta(days=days)
+    queryset = ReferralVisit.objects.filter(visited_at__lt=cutoff)
+    archive_path = None
+    if archive_dir:
+        os.makedirs(archive_dir, exist_ok=True)
+        archive_path = os.path.join(archive_dir, f"referral_visits_before_{cutoff:%Y%m%d}.jsonl.gz")
+
+    def delete_chunk(chunk):
+        if archive_path:
+            _archive_rows(archive_path, chunk.order_by('pk').values(*VISIT_ARCHIVE_FIELDS, user_agent=F('agent__user_agent')).iterator())
+        # Атрибуции удаляются явно одним запросом, чтобы каскад не собирался поштучно
+        ReferralAttribution.objects.filter(last_visit__in=chunk.values('pk')).delete()
+        return chunk.delete()[0]
+
+    return _chunked_prune(VISITS_JOB, queryset, delete_chunk, chunk_size, sleep, resume)
+
+
+def prune_expired_attributions(chunk_size=5000, sleep=0.0, resume=False):
+    """Удаляет истекшие атрибуции"""
+    queryset = ReferralAttribution.objects.filter(expires_at__lt=timezone.now())
+
+    def delete_chunk(chunk):
+        return chunk.delete()[0]
+
+    return _chunked_prune(ATTRIBUTIONS_JOB, queryset, delete_chunk, chunk_size, sleep, resume)
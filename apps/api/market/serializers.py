@@ -6,6 +6,7 @@ from .models import (
     ReferralProgram, ReferralLink, ReferralVisit, ReferralAttribution,
     ReferralReward, ReferralPayout, ReferralBalance, Product, ProductImage, Category, Order, OrderItem, WithdrawalRequest, Review
 )
+from .slugs import save_with_unique_slug
 
 
 
@@ -26,9 +27,9 @@ class ReferralLinkSerializer(serializers.ModelSerializer):
         fields = [
             'id', 'user', 'user_username', 'product', 'product_name',
             'code', 'is_active', 'created_at', 'expires_at',
-            'total_clicks', 'total_conversions', 'total_rewards', 'referral_url'
+            'total_clicks', 'repeat_clicks', 'total_conversions', 'total_rewards', 'referral_url'
         ]
-        read_only_fields = ['id', 'created_at', 'total_clicks', 'total_conversions', 'total_rewards']
+        read_only_fields = ['id', 'created_at', 'total_clicks', 'repeat_clicks', 'total_conversions', 'total_rewards']
 
 
     def get_referral_url(self, obj):
@@ -60,6 +61,7 @@ class ReferralLinkCreateSerializer(serializers.ModelSerializer):
 class ReferralVisitSerializer(serializers.ModelSerializer):
     referral_code = serializers.CharField(source='referral_link.code', read_only=True)
     referrer_username = serializers.CharField(source='referral_link.user.username', read_only=True)
+    user_agent = serializers.CharField(source='agent.user_agent', read_only=True)
 
     class Meta:
         model = ReferralVisit
@@ -208,7 +210,7 @@ class ReferralLinkStatsSerializer(serializers.ModelSerializer):
     class Meta:
         model = ReferralLink
         fields = [
-            'id', 'code', 'product', 'total_clicks', 'total_conversions',
+            'id', 'code', 'product', 'total_clicks', 'repeat_clicks', 'total_conversions',
             'total_rewards', 'clicks_today', 'clicks_this_week', 'clicks_this_month',
             'conversions_today', 'conversions_this_week', 'conversions_this_month'
         ]
@@ -217,8 +219,8 @@ class ReferralLinkStatsSerializer(serializers.ModelSerializer):
     def get_clicks_today(self, obj):
         from django.utils import timezone
         from datetime import timedelta
-        today = timezone.now().date()
-        return obj.visits.filter(visited_at__date=today).count()
+        today = timezone.localdate()
+        return obj.visits.filter(local_date=today).count()
 
 
     def get_clicks_this_week(self, obj):
@@ -238,8 +240,8 @@ class ReferralLinkStatsSerializer(serializers.ModelSerializer):
     def get_conversions_today(self, obj):
         from django.utils import timezone
         from datetime import timedelta
-        today = timezone.now().date()
-        return obj.rewards.filter(created_at__date=today).count()
+        today = timezone.localdate()
+        return obj.rewards.filter(local_date=today).count()
 
 
     def get_conversions_this_week(self, obj):
@@ -320,6 +322,7 @@ class ProductSerializer(serializers.ModelSerializer):
     category_name = serializers.CharField(source='category.name', read_only=True)
     photos = ProductImageSerializer(many=True, read_only=True)
     slug = serializers.SlugField(required=False, allow_blank=True)
+    rating_histogram = serializers.DictField(child=serializers.IntegerField(), read_only=True)
 
     class Meta:
         model = Product
@@ -329,47 +332,32 @@ class ProductSerializer(serializers.ModelSerializer):
             'is_active', 'created_at', 'updated_at', 'photos',
             'referral_commission', 'referral_enabled', 'total_sales',
             'total_referral_sales', 'sales_percentage', 'booked_quantity',
-            'stock'
+            'stock', 'rating_count', 'rating_average', 'rating_histogram',
+            'verified_review_count'
         ]
         read_only_fields = ['id', 'vendor', 'created_at', 'updated_at', 'total_sales',
-                           'total_referral_sales', 'sales_percentage']
+                           'total_referral_sales', 'sales_percentage', 'rating_count',
+                           'rating_average', 'verified_review_count']
 
     def create(self, validated_data):
         # Generate slug from title if not provided or empty
         if not validated_data.get('slug'):
-            from django.utils.text import slugify
-            validated_data['slug'] = self._generate_unique_slug(validated_data['title'])
+            return save_with_unique_slug(
+                lambda slug: super(ProductSerializer, self).create({**validated_data, 'slug': slug}),
+                validated_data['title'],
+            )
         return super().create(validated_data)
 
     def update(self, instance, validated_data):
         # Generate slug from title if title is being updated and slug is not provided or empty
         if 'title' in validated_data and (not validated_data.get('slug')):
-            from django.utils.text import slugify
-            validated_data['slug'] = self._generate_unique_slug(validated_data['title'], instance.id)
+            return save_with_unique_slug(
+                lambda slug: super(ProductSerializer, self).update(instance, {**validated_data, 'slug': slug}),
+                validated_data['title'],
+                exclude_id=instance.id,
+            )
         return super().update(instance, validated_data)
 
-    def _generate_unique_slug(self, title, exclude_id=None):
-        """Generate a unique slug from title"""
-        from django.utils.text import slugify
-        from .models import Product
-        
-        base_slug = slugify(title)
-        slug = base_slug
-        counter = 1
-        
-        while True:
-            queryset = Product.objects.filter(slug=slug)
-            if exclude_id:
-                queryset = queryset.exclude(id=exclude_id)
-            
-            if not queryset.exists():
-                break
-                
-            slug = f"{base_slug}-{counter}"
-            counter += 1
-            
-        return slug
-
 
 
 class ProductCreateSerializer(serializers.ModelSerializer):
@@ -384,6 +372,30 @@ class ProductCreateSerializer(serializers.ModelSerializer):
         return super().create(validated_data)
 
 
+class CatalogRowSerializer(serializers.Serializer):
+    """
+    Проверка строки импорта каталога (см. market/catalog.py).
+    title и price_uzs обязательны только для новых товаров - это проверяет импорт,
+    зная, какие артикулы уже есть у продавца.
+    """
+    sku = serializers.CharField(max_length=64, required=False)
+    slug = serializers.SlugField(max_length=50, required=False)
+    title = serializers.CharField(max_length=200, required=False)
+    description = serializers.CharField(required=False, allow_blank=True)
+    price_uzs = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0, required=False)
+    stock = serializers.IntegerField(min_value=0, required=False)
+    is_active = serializers.BooleanField(required=False)
+    category = serializers.CharField(required=False)
+    referral_commission = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0, required=False)
+    referral_enabled = serializers.BooleanField(required=False)
+    images = serializers.ListField(child=serializers.CharField(), required=False)
+
+    def validate(self, attrs):
+        if not attrs.get('sku') and not attrs.get('slug'):
+            raise serializers.ValidationError('sku или slug обязателен')
+        return attrs
+
+
 
 class OrderItemSerializer(serializers.ModelSerializer):
     product_name = serializers.CharField(source='product.title', read_only=True)
@@ -0,0 +1,170 @@
+"""
+Пакетная выплата реферальных вознаграждений.
+
+Запуск с run_id выполняется в одной транзакции: выбирает все ожидающие выплаты,
+покрывает каждую одобренными вознаграждениями пользователя (старые первыми),
+связывает их с выплатой, переводит в PAID_OUT и списывает балансы
+множественными UPDATE. Новые состояния вознаграждений и выплат пишутся в
+журнал событий одной вставкой. Повторный запуск с тем же run_id возвращает уже
+сохраненный результат.
+"""
+from collections import defaultdict, deque
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, DecimalField, F, Value, When
+from django.utils import timezone
+
+from .models import PayoutSettlementRun, ReferralBalance, ReferralPayout, ReferralReward
+from .referral_events import log_events, payout_event, reward_state_event
+
+BATCH_SIZE = 500
+
+
+def _chunks(items, size=BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _load_approved_rewards(user_ids):
+    """Одобренные невыплаченные вознаграждения по пользователям, старые первыми"""
+    pool = defaultdict(deque)
+    for chunk in _chunks(user_ids):
+        rewards = (
+            ReferralReward.objects.select_for_update()
+            .filter(attributed_user_id__in=chunk, status='APPROVED', available_amount__gt=0)
+            .order_by('attributed_user_id', 'approved_at', 'id')
+            .values_list('id', 'attributed_user_id', 'available_amount')
+        )
+        for reward_id, user_id, available in rewards:
+            pool[user_id].append([reward_id, available])
+    return pool
+
+
+def _allocate(payouts, pool):
+    """
+    Покрывает выплаты вознаграждениями. Полностью покрытые вознаграждения выплачиваются,
+    последнее частично покрытое остается APPROVED с уменьшенной доступной суммой.
+    """
+    settled = []          # (payout_id, user_id, amount)
+    skipped = []          # payout_id
+    links = []            # (payout_id, reward_id)
+    paid_rewards = []     # reward_id
+    partial = {}          # reward_id -> новая доступная сумма
+    for payout_id, user_id, amount in payouts:
+        rewards = pool[user_id]
+        if sum(available for _, available in rewards) < amount:
+            skipped.append(payout_id)
+            continue
+        remaining = amount
+        while remaining > 0:
+            reward = rewards[0]
+            reward_id, available = reward
+            links.append((payout_id, reward_id))
+            if available <= remaining:
+                remaining -= available
+                paid_rewards.append(reward_id)
+                partial.pop(reward_id, None)
+                rewards.popleft()
+            else:
+                reward[1] = available - remaining
+                partial[reward_id] = reward[1]
+                remaining = Decimal('0')
+        settled.append((payout_id, user_id, amount))
+    return settled, skipped, links, paid_rewards, partial
+
+
+def _debit_balances(debits):
+    """Списывает суммы с балансов: один UPDATE с CASE на пачку пользователей"""
+    ReferralBalance.objects.bulk_create(
+        [ReferralBalance(user_id=user_id) for user_id in debits],
+        ignore_conflicts=True,
+    )
+    for chunk in _chunks(debits.items()):
+        amount = Case(
+            *[When(user_id=user_id, then=Value(debit)) for user_id, debit in chunk],
+            output_field=DecimalField(max_digits=10, decimal_places=2),
+        )
+        ReferralBalance.objects.filter(user_id__in=[user_id for user_id, _ in chunk]).update(
+            available_amount=F('available_amount') - amount,
+            total_paid_out=F('total_paid_out') + amount,
+            updated_at=timezone.now(),
+        )
+
+
+def settle_payouts(run_id, processed_by=None, payout_ids=None):
+    """
+    Выполняет пакетную выплату. payout_ids ограничивает запуск конкретными выплатами.
+    Возвращает PayoutSettlementRun.
+    """
+    existing = PayoutSettlementRun.objects.filter(run_id=run_id).first()
+    if existing:
+        return existing
+
+    try:
+        return _settle(run_id, processed_by, payout_ids)
+    except IntegrityError:
+        # Параллельный запуск с тем же run_id успел завершиться первым
+        existing = PayoutSettlementRun.objects.filter(run_id=run_id).first()
+        if existing:
+            return existing
+        raise
+
+
+def _settle(run_id, processed_by, payout_ids):
+    now = timezone.now()
+    with transaction.atomic():
+        run = PayoutSettlementRun.objects.create(run_id=run_id, processed_by=processed_by)
+
+        payouts = ReferralPayout.objects.select_for_update().filter(status='PENDING')
+        if payout_ids is not None:
+            payouts = payouts.filter(pk__in=payout_ids)
+        payouts = list(payouts.order_by('created_at', 'id').values_list('id', 'user_id', 'amount'))
+
+        pool = _load_approved_rewards({user_id for _, user_id, _ in payouts})
+        owners = {reward_id: user_id for user_id, rewards in pool.items() for reward_id, _ in rewards}
+        settled, skipped, links, paid_rewards, partial = _allocate(payouts, pool)
+
+        Through = ReferralPayout.rewards.through
+        Through.objects.bulk_create(
+            [Through(referralpayout_id=payout_id, referralreward_id=reward_id) for payout_id, reward_id in links],
+            batch_size=BATCH_SIZE,
+            ignore_conflicts=True,
+        )
+        for chunk in _chunks(paid_rewards):
+            ReferralReward.objects.filter(pk__in=chunk).update(status='PAID_OUT')
+        if partial:
+            ReferralReward.objects.bulk_update(
+                [ReferralReward(pk=reward_id, available_amount=available) for reward_id, available in partial.items()],
+                ['available_amount'],
+                batch_size=BATCH_SIZE,
+            )
+        for chunk in _chunks(payout_id for payout_id, _, _ in settled):
+            ReferralPayout.objects.filter(pk__in=chunk).update(
+                status='COMPLETED',
+                processed_at=now,
+                processed_by=processed_by,
+                settlement_run=run,
+            )
+
+        log_events(
+            [reward_state_event(reward_id, owners[reward_id], 'PAID_OUT', 0, now) for reward_id in paid_rewards]
+            + [reward_state_event(reward_id, owners[reward_id], 'APPROVED', available, now)
+               for reward_id, available in partial.items()]
+            + [payout_event(payout_id, user_id, 'COMPLETED', amount, now) for payout_id, user_id, amount in settled],
+            batch_size=BATCH_SIZE,
+        )
+
+        debits = defaultdict(Decimal)
+        for _, user_id, amount in settled:
+            debits[user_id] += amount
+        _debit_balances(debits)
+
+        run.payouts_count = len(settled)
+        run.skipped_count = len(skipped)
+        run.rewards_count = len(links)
+        run.total_amount = sum(debits.values(), Decimal('0'))
+        run.completed_at = timezone.now()
+        run.save()
+    return run
@@ -139,20 +139,15 @@ def process_referral_attribution_on_order_creation(sender, instance, created, **
 
 def cleanup_expired_attributions():
     """
-    Очищает истекшие атрибуции (можно вызывать по cron)
+    Очищает истекшие атрибуции (можно вызывать по cron).
+    Удаление идет пачками, см. команду prune_expired_attributions.
     """
     try:
-        from .models import ReferralAttribution
+        from .retention import prune_expired_attributions
         
-        expired_count = ReferralAttribution.objects.filter(
-            expires_at__lt=timezone.now()
-        ).count()
+        expired_count = sum(deleted for deleted, _ in prune_expired_attributions())
         
         if expired_count > 0:
-            ReferralAttribution.objects.filter(
-                expires_at__lt=timezone.now()
-            ).delete()
-            
             print(f"Cleaned up {expired_count} expired attributions")
             
     except Exception as e:
@@ -160,20 +155,16 @@ def cleanup_expired_attributions():
 
 def cleanup_old_referral_visits(days=90):
     """
-    Очищает старые записи о посещениях (можно вызывать по cron)
+    Очищает старые записи о посещениях (можно вызывать по cron).
+    Удаление идет пачками, см. команду prune_referral_visits.
     """
     try:
-        from .models import ReferralVisit
-        from datetime import timedelta
+        from .retention import prune_referral_visits
         
-        cutoff_date = timezone.now() - timedelta(days=days)
-        old_visits = ReferralVisit.objects.filter(visited_at__lt=cutoff_date)
-        count = old_visits.count()
+        count = sum(deleted for deleted, _ in prune_referral_visits(days=days))
         
         if count > 0:
-            old_visits.delete()
             print(f"Cleaned up {count} old referral visits")
             
     except Exception as e:
         print(f"Error cleaning up old referral visits: {e}")
-
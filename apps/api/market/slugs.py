@@ -0,0 +1,92 @@
+"""
+Выделение уникальных slug товаров.
+
+Следующий свободный суффикс ищется одним запросом по префиксу (base, base-1,
+base-2, ...) вместо перебора exists() по одному. Гонку между параллельными
+созданиями ловит уникальный индекс: save_with_unique_slug повторяет
+сохранение со следующим суффиксом при конфликте.
+"""
+import re
+
+from django.db import IntegrityError, transaction
+from django.utils.text import slugify
+
+from .models import Product
+
+SLUG_MAX_LENGTH = Product._meta.get_field('slug').max_length
+MAX_ATTEMPTS = 5
+SUFFIX_RE = re.compile(r'^.*-(\d+)$')
+
+
+def base_slug(title):
+    return slugify(title or '')[:SLUG_MAX_LENGTH].strip('-') or 'product'
+
+
+def _with_suffix(base, number):
+    if number == 0:
+        return base
+    suffix = f'-{number}'
+    return base[:SLUG_MAX_LENGTH - len(suffix)].rstrip('-') + suffix
+
+
+def _taken_numbers(base, exclude_id=None):
+    """Занятые номера для base одним запросом: base -> 0, base-N -> N (с учетом обрезки base)"""
+    # Самая короткая возможная обрезка base для длинных суффиксов - общий префикс всех кандидатов
+    prefix = base[:SLUG_MAX_LENGTH - 8].rstrip('-')
+    queryset = Product.objects.filter(slug__startswith=prefix)
+    if exclude_id:
+        queryset = queryset.exclude(pk=exclude_id)
+    taken = set()
+    for slug in queryset.values_list('slug', flat=True).iterator(chunk_size=2000):
+        if slug == base:
+            taken.add(0)
+            continue
+        match = SUFFIX_RE.match(slug)
+        if match and int(match.group(1)) > 0 and _with_suffix(base, int(match.group(1))) == slug:
+            taken.add(int(match.group(1)))
+    return taken
+
+
+def allocate_slugs(titles, exclude_id=None):
+    """
+    Уникальные slug для списка названий: один запрос на каждый различный base,
+    одинаковые названия внутри списка получают последовательные суффиксы.
+    """
+    taken_by_base = {}
+    next_number = {}
+    slugs = []
+    for title in titles:
+        base = base_slug(title)
+        taken = taken_by_base.get(base)
+        if taken is None:
+            taken = taken_by_base[base] = _taken_numbers(base, exclude_id)
+        # Номера выдаются по возрастанию, поэтому поиск продолжается с последнего выданного
+        number = next_number.get(base, 0)
+        while number in taken:
+            number += 1
+        taken.add(number)
+        next_number[base] = number + 1
+        slugs.append(_with_suffix(base, number))
+    return slugs
+
+
+def unique_slug(title, exclude_id=None):
+    return allocate_slugs([title], exclude_id=exclude_id)[0]
+
+
+def save_with_unique_slug(save, title, exclude_id=None, attempts=MAX_ATTEMPTS):
+    """
+    Вызывает save(slug) с выделенным slug; если параллельный запрос успел занять
+    тот же slug, выделяет следующий и повторяет. Другие нарушения целостности пробрасываются.
+    """
+    for attempt in range(attempts):
+        slug = unique_slug(title, exclude_id=exclude_id)
+        try:
+            with transaction.atomic():
+                return save(slug)
+        except IntegrityError:
+            conflict = Product.objects.filter(slug=slug)
+            if exclude_id:
+                conflict = conflict.exclude(pk=exclude_id)
+            if attempt == attempts - 1 or not conflict.exists():
+                raise
@@ -0,0 +1,540 @@
+"""
+Синтетические данные для нагрузочных тестов и бенчмарков.
+
+Генерация в две фазы:
+1. Справочные таблицы (пользователи, категории, товары, фото, реферальные
+   ссылки) - в одном процессе, объекты остаются в памяти для второй фазы.
+2. Факты (заказы, посещения с конверсиями, отзывы) - независимыми пачками по
+   CHUNK_ROWS строк, опционально в нескольких процессах.
+
+Все строки создаются через bulk_create. Генератор детерминирован: у каждой
+пачки свой random.Random(f'{seed}:{вид}:{номер}'), поэтому результат не
+зависит от количества процессов. Имена и slug строятся из seed и порядкового
+номера, коды (referral_code, public_id) выделяются из общих последовательностей
+(market/codes.py), так что наборы с разными seed можно загружать в одну базу.
+
+Популярность товаров и ссылок распределена по Ципфу (zipf_s), доля
+посещений, закончившихся покупкой, задается conversion_rate.
+
+Посещения ссылаются на строки справочника UserAgent (USER_AGENTS через intern()),
+вознаграждения - на посещение, приведшее к покупке. Журнал ReferralEvent
+пишется теми же конструкторами событий, что и живой трафик
+(market/referral_events.py), в транзакции пачки фактов; дневные агрегаты
+CampaignDailyStat и скетчи посетителей пересчитываются после загрузки.
+"""
+import io
+import multiprocessing
+import random
+from collections import Counter
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.db.models import Count, DecimalField, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .attribution import AttributionRecord
+from .campaigns import rebuild_day as rebuild_campaign_day
+from .codes import reserve_codes
+from .models import (
+    Category, Order, OrderItem, Product, ProductImage, ReferralAttribution, ReferralBalance,
+    ReferralLink, ReferralPayout, ReferralProgram, ReferralReward, ReferralVisit, Review, User,
+    UserRole, WithdrawalRequest,
+)
+from .ranking import rebuild_sales_rankings
+from .referral_events import (
+    attribution_event, click_event, conversion_event, log_events, payout_event, reward_state_event,
+)
+from .user_agents import intern as intern_user_agent
+from .visitor_sketches import rebuild_day
+
+CHUNK_ROWS = 10_000
+
+DISTRIBUTIONS = {
+    'zipf_s': 1.1,            # Показатель распределения Ципфа для популярности товаров и ссылок
+    'conversion_rate': 0.02,  # Доля посещений, закончившихся покупкой
+    'payout_rate': 0.3,       # Доля рефереров с одобренным балансом, запросивших выплату
+    'withdrawal_rate': 0.2,   # Доля продавцов с заявкой на вывод
+    'days': 90,               # Глубина истории, дней
+}
+
+SIZES = {
+    'small': {
+        'users': 200, 'vendors': 10, 'categories': 8, 'products': 500, 'photos_per_product': 2,
+        'orders': 1000, 'items_per_order': 3, 'links': 100, 'visits': 5000, 'reviews': 1000,
+        **DISTRIBUTIONS,
+    },
+    'medium': {
+        'users': 2000, 'vendors': 50, 'categories': 20, 'products': 5000, 'photos_per_product': 3,
+        'orders': 10000, 'items_per_order': 3, 'links': 1000, 'visits': 50000, 'reviews': 10000,
+        **DISTRIBUTIONS,
+    },
+    'large': {
+        'users': 20000, 'vendors': 200, 'categories': 40, 'products': 50000, 'photos_per_product': 3,
+        'orders': 100000, 'items_per_order': 3, 'links': 10000, 'visits': 500000, 'reviews': 100000,
+        **DISTRIBUTIONS,
+    },
+    'xlarge': {
+        'users': 200000, 'vendors': 1000, 'categories': 60, 'products': 200000, 'photos_per_product': 3,
+        'orders': 2000000, 'items_per_order': 3, 'links': 50000, 'visits': 5000000, 'reviews': 1000000,
+        **DISTRIBUTIONS,
+    },
+}
+
+SEED_PASSWORD = 'seed-password'
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148',
+    'Mozilla/5.0 (Linux; Android 14; SM-A546E) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Mobile Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 14_0) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15',
+]
+ORDER_STATUSES = ['pending', 'processing', 'shipped', 'delivered', 'cancelled']
+ORDER_STATUS_WEIGHTS = [15, 15, 20, 45, 5]
+RATING_WEIGHTS = [5, 7, 15, 33, 40]  # Оценки 1..5
+UTM_SOURCES = [None, 'telegram', 'instagram', 'facebook', 'google']
+
+# Поля с auto_now/auto_now_add, которым генератор задает значения сам
+TIMESTAMP_FIELDS = [
+    (Order, ['created_at', 'updated_at']),
+    (Review, ['created_at', 'updated_at']),
+    (ReferralVisit, ['visited_at']),
+    (ReferralAttribution, ['created_at']),
+    (ReferralReward, ['created_at']),
+]
+
+
+def _price(rng):
+    return Decimal(rng.randrange(10, 5000) * 1000)
+
+
+def _ip(rng):
+    return f'10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}'
+
+
+def zipf_cum_weights(n, s):
+    """Накопленные веса распределения Ципфа для рангов 1..n (для random.choices)"""
+    total = 0.0
+    weights = []
+    for rank in range(1, n + 1):
+        total += 1.0 / rank ** s
+        weights.append(total)
+    return weights
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _bulk_create(model, rows, batch_size):
+    """bulk_create из генератора пачками; возвращает созданные объекты"""
+    created = []
+    for batch in _batches(rows, batch_size):
+        created.extend(model.objects.bulk_create(batch))
+    return created
+
+
+@contextmanager
+def explicit_timestamps():
+    """Временно отключает auto_now/auto_now_add, чтобы сохранить сгенерированные даты"""
+    saved = []
+    for model, names in TIMESTAMP_FIELDS:
+        for name in names:
+            field = model._meta.get_field(name)
+            saved.append((field, field.auto_now, field.auto_now_add))
+            field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+def _seed_dimensions(sizes, seed, batch_size):
+    rng = random.Random(f'{seed}:dimensions')
+    password = make_password(SEED_PASSWORD)
+    prefix = f'seed{seed}'
+
+    for name, _ in UserRole.ROLE_CHOICES:
+        UserRole.objects.get_or_create(name=name)
+    if not ReferralProgram.objects.exists():
+        ReferralProgram.objects.create()
+
+    user_codes = iter(reserve_codes('user', sizes['vendors'] + sizes['users'] + 1))
+    admin = User.objects.create(
+        username=f'{prefix}_admin', role='superadmin', password=password, referral_code=next(user_codes),
+    )
+    vendors = _bulk_create(User, (
+        User(
+            username=f'{prefix}_vendor{i}', email=f'{prefix}_vendor{i}@example.com',
+            role='vendor', password=password, is_verified=True, referral_code=next(user_codes),
+        )
+        for i in range(sizes['vendors'])
+    ), batch_size)
+    users = _bulk_create(User, (
+        User(
+            username=f'{prefix}_user{i}', email=f'{prefix}_user{i}@example.com',
+            phone=f'+99890{i:07d}', password=password, referral_code=next(user_codes),
+        )
+        for i in range(sizes['users'])
+    ), batch_size)
+
+    categories = _bulk_create(Category, (
+        Category(name=f'Category {i}', slug=f'{prefix}-category-{i}') for i in range(sizes['categories'])
+    ), batch_size)
+    products = _bulk_create(Product, (
+        Product(
+            vendor=rng.choice(vendors), category=rng.choice(categories),
+            title=f'Product {i}', slug=f'{prefix}-product-{i}', price_uzs=_price(rng),
+            description=f'Synthetic product {i}', stock=rng.randrange(0, 500),
+            referral_commission=Decimal(rng.randrange(1, 20)),
+        )
+        for i in range(sizes['products'])
+    ), batch_size)
+    images = 0
+    for batch in _batches((
+        ProductImage(product=product, image=f'products/seed/{product.slug}-{n}.jpg', alt=product.title, sort_order=n)
+        for product in products
+        for n in range(sizes['photos_per_product'])
+    ), batch_size):
+        images += len(ProductImage.objects.bulk_create(batch))
+
+    # Ссылка i: пользователь i % users, товар i // users - пары (user, product) уникальны
+    link_codes = reserve_codes('referral_link', sizes['links'])
+    links = _bulk_create(ReferralLink, (
+        ReferralLink(
+            user=users[i % len(users)], product=products[(i // len(users)) % len(products)],
+            code=link_codes[i],
+        )
+        for i in range(sizes['links'])
+    ), batch_size)
+
+    counts = {
+        'users': len(users) + len(vendors) + 1,
+        'categories': len(categories),
+        'products': len(products),
+        'product_images': images,
+        'referral_links': len(links),
+    }
+    return admin, vendors, users, products, links, counts
+
+
+# Контекст второй фазы; в дочерних процессах задается инициализатором пула
+_context = None
+
+
+def _init_worker(context):
+    global _context
+    _context = context
+    # Соединения родителя закрыты до fork; потомок откроет свои
+    connections.close_all()
+
+
+def _when(rng):
+    return _context['now'] - timedelta(seconds=rng.random() * _context['days'] * 86400)
+
+
+def _order(rng, public_id, user_id, created_at, status=None):
+    return Order(
+        public_id=public_id, user_id=user_id,
+        customer_name=f'Customer {public_id}', customer_phone='+998901234567', customer_address='Tashkent',
+        total_amount=Decimal(0), status=status or rng.choices(ORDER_STATUSES, ORDER_STATUS_WEIGHTS)[0],
+        payment_method=rng.choice(['cash', 'card', 'transfer']),
+        created_at=created_at, updated_at=created_at,
+    )
+
+
+def _seed_orders(chunk, start, end):
+    """Обычные (не реферальные) заказы с позициями"""
+    ctx = _context
+    rng = random.Random(f'{ctx["seed"]}:orders:{chunk}')
+    orders = []
+    lines = []
+    for public_id in reserve_codes('order', end - start):
+        order = _order(rng, public_id, rng.choice(ctx['user_ids']), _when(rng))
+        picked = set(rng.choices(ctx['popular_products'], cum_weights=ctx['product_weights'], k=rng.randint(1, ctx['items_per_order'])))
+        for product_id in picked:
+            quantity = rng.randint(1, 3)
+            price = ctx['prices'][product_id]
+            lines.append((len(orders), product_id, quantity, price))
+            order.total_amount += price * quantity
+        orders.append(order)
+    with transaction.atomic():
+        Order.objects.bulk_create(orders)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=orders[n], product_id=product_id, quantity=quantity, price=price)
+            for n, product_id, quantity, price in lines
+        ])
+    return {'orders': len(orders), 'order_items': len(lines)}
+
+
+def _reward_status(order_status, rng):
+    if order_status == 'cancelled':
+        return 'REVERSED'
+    if order_status == 'delivered':
+        return rng.choices(['APPROVED', 'PAID_OUT'], [60, 40])[0]
+    return 'PENDING'
+
+
+def _seed_visits(chunk, start, end):
+    """Посещения по ссылкам; доля conversion_rate заканчивается заказом, атрибуцией и вознаграждением"""
+    ctx = _context
+    rng = random.Random(f'{ctx["seed"]}:visits:{chunk}')
+    visitor_pool = max(ctx['visits'] // 3, 1)
+    agent_ids = list(ctx['agents'])
+    visits = []
+    converted = []
+    for _ in range(start, end):
+        link_id, referrer_id, product_id = rng.choices(ctx['popular_links'], cum_weights=ctx['link_weights'])[0]
+        visited_at = _when(rng)
+        source = rng.choice(UTM_SOURCES)
+        visits.append(ReferralVisit(
+            referral_link_id=link_id, anonymous_id=f'{ctx["prefix"]}-anon-{rng.randrange(visitor_pool)}',
+            ip_address=_ip(rng), agent_id=rng.choice(agent_ids), product_id=product_id,
+            utm_source=source, utm_medium='referral' if source else None, visited_at=visited_at,
+        ))
+        if rng.random() < ctx['conversion_rate']:
+            converted.append(len(visits) - 1)
+
+    with transaction.atomic():
+        ReferralVisit.objects.bulk_create(visits)
+        orders, lines, attributions, rewards = [], [], [], []
+        for n, public_id in zip(converted, reserve_codes('order', len(converted))):
+            visit = visits[n]
+            link_id, referrer_id, product_id = ctx['links'][visit.referral_link_id]
+            buyer_id = rng.choice(ctx['user_ids'])
+            created_at = visit.visited_at + timedelta(minutes=rng.randint(2, 120))
+            order = _order(rng, public_id, buyer_id, created_at)
+            quantity = rng.randint(1, 2)
+            price = ctx['prices'][product_id]
+            order.total_amount = price * quantity
+            orders.append(order)
+            lines.append((product_id, quantity, price))
+            attributions.append(ReferralAttribution(
+                anonymous_id=visit.anonymous_id, user_id=buyer_id, referral_link_id=link_id, product_id=product_id,
+                created_at=visit.visited_at, expires_at=visit.visited_at + timedelta(days=30), last_visit=visit,
+            ))
+        Order.objects.bulk_create(orders)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product_id=product_id, quantity=quantity, price=price)
+            for order, (product_id, quantity, price) in zip(orders, lines)
+        ])
+        # Повторная конверсия того же посетителя по тому же товару не создает новой атрибуции
+        ReferralAttribution.objects.bulk_create(attributions, ignore_conflicts=True)
+        for n, order, (product_id, _, _) in zip(converted, orders, lines):
+            visit = visits[n]
+            _, referrer_id, _ = ctx['links'][visit.referral_link_id]
+            status = _reward_status(order.status, rng)
+            amount = (order.total_amount * Decimal('0.05')).quantize(Decimal('0.01'))
+            rewards.append(ReferralReward(
+                referral_link_id=visit.referral_link_id, order=order, attributed_user_id=referrer_id,
+                product_id=product_id, order_amount=order.total_amount, reward_percentage=Decimal('5.00'),
+                reward_amount=amount,
+                locked_amount=amount if status == 'PENDING' else 0,
+                available_amount=amount if status == 'APPROVED' else 0,
+                status=status, created_at=order.created_at,
+                approved_at=order.created_at + timedelta(days=3) if status in ('APPROVED', 'PAID_OUT') else None,
+                reversed_at=order.created_at + timedelta(days=1) if status == 'REVERSED' else None,
+                ip_address=visit.ip_address, user_agent=ctx['agents'][visit.agent_id], attributed_visit=visit,
+            ))
+        ReferralReward.objects.bulk_create(rewards)
+
+        # Журнал событий - как при живом трафике: переход, атрибуция, конверсия и состояние вознаграждения
+        events = [click_event(visit, ctx['links'][visit.referral_link_id][1]) for visit in visits]
+        for attribution in attributions:
+            record = AttributionRecord(
+                attribution.anonymous_id, attribution.product_id, attribution.user_id,
+                attribution.referral_link_id, attribution.last_visit_id, attribution.expires_at,
+            )
+            events.append(attribution_event(record, ctx['links'][attribution.referral_link_id][1], attribution.created_at))
+        for reward in rewards:
+            events.append(conversion_event(
+                reward.pk, reward.attributed_user_id, reward.referral_link_id, reward.product_id,
+                reward.reward_amount, reward.created_at,
+            ))
+            events.append(reward_state_event(reward.pk, reward.attributed_user_id, *reward.event_state(), reward.created_at))
+        log_events(events)
+    return {
+        'referral_visits': len(visits),
+        'orders': len(orders),
+        'order_items': len(lines),
+        'referral_attributions': len(attributions),
+        'referral_rewards': len(rewards),
+        'referral_events': len(events),
+    }
+
+
+def _seed_reviews(chunk, start, end):
+    ctx = _context
+    rng = random.Random(f'{ctx["seed"]}:reviews:{chunk}')
+    reviews = []
+    for _ in range(start, end):
+        created_at = _when(rng)
+        reviews.append(Review(
+            product_id=rng.choices(ctx['popular_products'], cum_weights=ctx['product_weights'])[0],
+            user_id=rng.choice(ctx['user_ids']),
+            rating=rng.choices(range(1, 6), RATING_WEIGHTS)[0],
+            comment='Synthetic review', verified=rng.random() < 0.6,
+            created_at=created_at, updated_at=created_at,
+        ))
+    Review.objects.bulk_create(reviews)
+    return {'reviews': len(reviews)}
+
+
+FACT_GENERATORS = {
+    'orders': _seed_orders,
+    'visits': _seed_visits,
+    'reviews': _seed_reviews,
+}
+
+
+def _run_task(task):
+    kind, chunk, start, end = task
+    with explicit_timestamps():
+        return FACT_GENERATORS[kind](chunk, start, end)
+
+
+def _tasks(sizes):
+    for kind in FACT_GENERATORS:
+        total = sizes[kind]
+        for chunk, start in enumerate(range(0, total, CHUNK_ROWS)):
+            yield kind, chunk, start, min(start + CHUNK_ROWS, total)
+
+
+def _rebuild_link_counters():
+    visits = ReferralVisit.objects.filter(referral_link=OuterRef('pk')).order_by().values('referral_link')
+    rewards = ReferralReward.objects.filter(referral_link=OuterRef('pk')).exclude(status='REVERSED').order_by().values('referral_link')
+    money = DecimalField(max_digits=10, decimal_places=2)
+    ReferralLink.objects.update(
+        total_clicks=Coalesce(Subquery(visits.annotate(n=Count('pk')).values('n')), 0),
+        total_conversions=Coalesce(Subquery(rewards.annotate(n=Count('pk')).values('n')), 0),
+        total_rewards=Coalesce(Subquery(rewards.annotate(s=Sum('reward_amount')).values('s')), Value(0), output_field=money),
+    )
+
+
+def _seed_payouts_and_balances(sizes, seed, vendors, batch_size):
+    """Заявки на выплату, выводы продавцов и балансы рефереров по созданным вознаграждениям"""
+    rng = random.Random(f'{seed}:payouts')
+    totals = (
+        ReferralReward.objects.filter(attributed_user__username__startswith=f'seed{seed}_')
+        .order_by().values('attributed_user_id')
+        .annotate(
+            earned=Sum('reward_amount'),
+            locked=Sum('locked_amount', filter=Q(status='PENDING')),
+            available=Sum('available_amount', filter=Q(status='APPROVED')),
+        )
+    )
+    balances, payouts = [], []
+    for row in totals.iterator(chunk_size=batch_size):
+        available = row['available'] or Decimal(0)
+        balances.append(ReferralBalance(
+            user_id=row['attributed_user_id'], total_earned=row['earned'] or 0,
+            locked_amount=row['locked'] or 0, available_amount=available,
+        ))
+        if available > 0 and rng.random() < sizes['payout_rate']:
+            payouts.append(ReferralPayout(
+                user_id=row['attributed_user_id'], amount=available, payment_method='BANK_TRANSFER',
+                payment_details={'card': f'8600{rng.randrange(10 ** 12):012d}'},
+            ))
+    ReferralBalance.objects.bulk_create(balances, batch_size=batch_size)
+    ReferralPayout.objects.bulk_create(payouts, batch_size=batch_size)
+    events = log_events(
+        [payout_event(payout.pk, payout.user_id, payout.status, payout.amount, payout.created_at) for payout in payouts],
+        batch_size=batch_size,
+    )
+    withdrawals = WithdrawalRequest.objects.bulk_create([
+        WithdrawalRequest(
+            user=vendor, amount=Decimal(rng.randrange(100, 5000) * 1000),
+            status=rng.choice(['pending', 'approved', 'rejected']), bank_details='Synthetic bank account',
+        )
+        for vendor in vendors
+        if rng.random() < sizes['withdrawal_rate']
+    ], batch_size=batch_size)
+    return {
+        'referral_balances': len(balances), 'referral_payouts': len(payouts), 'referral_events': events,
+        'withdrawal_requests': len(withdrawals),
+    }
+
+
+def seed_dataset(sizes, seed=0, batch_size=1000, workers=1, progress=None):
+    """
+    Загружает набор данных размера sizes (см. SIZES). workers > 1 распределяет
+    пачки фактов по процессам (только не на SQLite: там запись однопоточна).
+    Возвращает словарь с ключевыми объектами для сценариев нагрузки и количеством строк.
+    """
+    report = progress or (lambda message: None)
+    if connection.vendor == 'sqlite':
+        workers = 1
+
+    with transaction.atomic():
+        admin, vendors, users, products, links, counts = _seed_dimensions(sizes, seed, batch_size)
+    counts = Counter(counts)
+    report(f'Dimensions: {dict(counts)}')
+    agents = {intern_user_agent(user_agent): user_agent for user_agent in USER_AGENTS}
+    counts['user_agents'] = len(agents)
+
+    rng = random.Random(f'{seed}:popularity')
+    popular_products = [product.pk for product in products]
+    rng.shuffle(popular_products)
+    popular_links = [(link.pk, link.user_id, link.product_id) for link in links]
+    rng.shuffle(popular_links)
+    context = {
+        'seed': seed,
+        'prefix': f'seed{seed}',
+        'now': timezone.now(),
+        'days': sizes['days'],
+        'visits': sizes['visits'],
+        'items_per_order': sizes['items_per_order'],
+        'conversion_rate': sizes['conversion_rate'],
+        'user_ids': [user.pk for user in users],
+        'prices': {product.pk: product.price_uzs for product in products},
+        'popular_products': popular_products,
+        'product_weights': zipf_cum_weights(len(popular_products), sizes['zipf_s']),
+        'popular_links': popular_links,
+        'link_weights': zipf_cum_weights(len(popular_links), sizes['zipf_s']),
+        'links': {link_id: (link_id, user_id, product_id) for link_id, user_id, product_id in popular_links},
+        'agents': agents,
+    }
+
+    tasks = list(_tasks(sizes))
+    if workers > 1:
+        connections.close_all()
+        with multiprocessing.get_context('fork').Pool(workers, initializer=_init_worker, initargs=(context,)) as pool:
+            for done, result in enumerate(pool.imap_unordered(_run_task, tasks), start=1):
+                counts.update(result)
+                report(f'Chunks {done}/{len(tasks)}')
+    else:
+        _init_worker(context)
+        for done, task in enumerate(tasks, start=1):
+            counts.update(_run_task(task))
+            report(f'Chunks {done}/{len(tasks)}')
+
+    # Производные данные: агрегаты отзывов, рейтинги продаж, счетчики ссылок, балансы,
+    # скетчи посетителей и дневная статистика кампаний
+    call_command('backfill_review_aggregates', batch_size=batch_size, stdout=io.StringIO())
+    rebuild_sales_rankings()
+    _rebuild_link_counters()
+    counts.update(_seed_payouts_and_balances(sizes, seed, vendors, batch_size))
+    today = timezone.localdate()
+    for offset in range(sizes['days'] + 1):
+        day = today - timedelta(days=offset)
+        rebuild_day(day)
+        counts['campaign_daily_stats'] += rebuild_campaign_day(day)
+    report('Derived tables rebuilt')
+
+    return {
+        'admin': admin,
+        'users': users,
+        'products': products,
+        'links': links,
+        'counts': dict(counts),
+    }
@@ -1,3 +1,1259 @@
-from django.test import TestCase
+import random
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from io import BytesIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import DatabaseError, connection
+from django.db.models import Sum
+from django.db.models.functions import ExtractHour, TruncDate
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import fraud, hll
+from .analytics import clear_extracts, run_query
+from .attribution import (
+    PENDING_QUEUE_KEY, AttributionRecord, find_attribution, flush_pending, persist, record_attributions,
+)
+from .campaigns import (
+    campaign_report, rebuild_day as rebuild_campaign_day, record_click as record_campaign_click,
+)
+from .catalog import import_catalog
+from .event_replay import BACKFILL_JOB, backfill_events, replay_events
+from .identity import schedule_identity_stitch, stitch_identity
+from .local_buckets import backfill_model
+from .middleware import ReferralTrackingMiddleware
+from .models import (
+    CampaignDailyStat, Order, OrderItem, PayoutSettlementRun, Product, ProductSalesRank, ReferralAttribution,
+    ReferralBalance, ReferralEvent, ReferralLink, ReferralPayout, ReferralProgram, ReferralReward, ReferralVisit,
+    ReferralVisitSketch, RetentionCheckpoint, Review, User, UserAgent,
+)
+from .ranking import bestseller_products, rebuild_sales_rankings, trending_products, update_sales_counters
+from .referral_events import log_click
+from .referral_utils import set_anonymous_id_cookie
+from .serializers import ReferralLinkStatsSerializer
+from .settlement import settle_payouts
+from .synthetic import SIZES, USER_AGENTS, seed_dataset
+from .throttling import client_ip
+from .user_agents import classify, clear_cache as clear_user_agent_cache, intern, user_agent_hash
+from .visitor_sketches import rebuild_day, record_visit, unique_visitors
+
+
+class EstimateAssertions:
+    # Допуск - три стандартные ошибки 1.04 / sqrt(m)
+    TOLERANCE = 3 * 1.04 / (hll.REGISTERS ** 0.5)
+
+    def assertEstimateClose(self, estimate, exact):
+        self.assertLessEqual(abs(estimate - exact), max(2, exact * self.TOLERANCE), (estimate, exact))
+
+
+class HyperLogLogTests(EstimateAssertions, TestCase):
+    """Точность оценок HyperLogLog относительно точного подсчета"""
+
+    def sketch_of(self, values):
+        registers = hll.empty()
+        for value in values:
+            hll.add(registers, value)
+        return registers
+
+    def test_empty_sketch(self):
+        self.assertEqual(hll.estimate(hll.empty()), 0)
+
+    def test_estimate_matches_exact_count(self):
+        for exact in (10, 500, 5000, 50000):
+            values = [f'anon-{exact}-{i}' for i in range(exact)]
+            # Повторы не должны влиять на оценку
+            sketch = self.sketch_of(values + values[: exact // 2])
+            self.assertEstimateClose(hll.estimate(sketch), exact)
+
+    def test_merge_estimates_union(self):
+        first = [f'visitor-{i}' for i in range(0, 20000)]
+        second = [f'visitor-{i}' for i in range(15000, 40000)]
+        merged = hll.merge(self.sketch_of(first), self.sketch_of(second))
+        self.assertEstimateClose(hll.estimate(merged), len(set(first) | set(second)))
+        # Слияние совпадает со скетчем объединенного множества
+        self.assertEqual(merged, self.sketch_of(first + second))
+
+    def test_serialization_roundtrip(self):
+        sketch = self.sketch_of(f'v{i}' for i in range(1000))
+        data = hll.dumps(sketch)
+        self.assertLess(len(data), hll.REGISTERS)
+        self.assertEqual(hll.loads(data), sketch)
+
+
+class VisitorSketchTests(EstimateAssertions, TestCase):
+    """Скетчи посещений в БД против точного COUNT(DISTINCT anonymous_id)"""
+
+    def setUp(self):
+        self.referrer = User.objects.create_user(username='referrer', password='x')
+        other = User.objects.create_user(username='other', password='x')
+        self.links = [
+            ReferralLink.objects.create(user=self.referrer, code='LINKONE1'),
+            ReferralLink.objects.create(user=other, code='LINKTWO2'),
+        ]
+        self.today = timezone.localdate()
+        # Кэш справочника User-Agent переживает откат транзакции теста
+        clear_user_agent_cache()
+        self.agent_id = intern('test')
+
+    def visit(self, link, anonymous_id, days_ago=0):
+        visit = ReferralVisit.objects.create(
+            referral_link=link, anonymous_id=anonymous_id, ip_address='127.0.0.1', agent_id=self.agent_id
+        )
+        if days_ago:
+            visit.visited_at -= timedelta(days=days_ago)
+            ReferralVisit.objects.filter(pk=visit.pk).update(visited_at=visit.visited_at)
+        record_visit(visit)
+        return visit
+
+    def exact(self, **filters):
+        return ReferralVisit.objects.filter(**filters).values('anonymous_id').distinct().count()
+
+    def test_unique_visitors_by_link_referrer_and_total(self):
+        for i in range(300):
+            self.visit(self.links[0], f'a{i}', days_ago=i % 3)
+            self.visit(self.links[1], f'a{i + 200}', days_ago=i % 2)
+        start = self.today - timedelta(days=2)
+
+        self.assertEstimateClose(unique_visitors(start, self.today), self.exact())
+        self.assertEstimateClose(
+            unique_visitors(start, self.today, link_ids=[self.links[1].pk]),
+            self.exact(referral_link=self.links[1]),
+        )
+        self.assertEstimateClose(
+            unique_visitors(start, self.today, referrer=self.referrer),
+            self.exact(referral_link__user=self.referrer),
+        )
+        # Один день
+        self.assertEstimateClose(
+            unique_visitors(self.today, self.today),
+            self.exact(visited_at__date=self.today),
+        )
+
+    def test_repeat_visit_does_not_rewrite_sketch(self):
+        self.visit(self.links[0], 'same')
+        repeat = ReferralVisit.objects.create(
+            referral_link=self.links[0], anonymous_id='same', ip_address='127.0.0.1', agent_id=self.agent_id
+        )
+        with self.assertNumQueries(3):
+            # Только скетч ссылки: SAVEPOINT, SELECT ... FOR UPDATE, RELEASE - без UPDATE
+            record_visit(repeat)
+        self.assertEqual(unique_visitors(self.today, self.today), 1)
+
+    def test_rebuild_day_matches_incremental_sketches(self):
+        for i in range(100):
+            self.visit(self.links[i % 2], f'v{i % 60}')
+        incremental = {
+            sketch.referral_link_id: hll.loads(sketch.registers)
+            for sketch in ReferralVisitSketch.objects.filter(day=self.today)
+        }
+        self.assertEqual(rebuild_day(self.today), 100)
+        rebuilt = {
+            sketch.referral_link_id: hll.loads(sketch.registers)
+            for sketch in ReferralVisitSketch.objects.filter(day=self.today)
+        }
+        self.assertEqual(rebuilt, incremental)
+
+
+class ReferralFixtures:
+    """Пользователи, товары, ссылки, заказы и вознаграждения для тестов реферальной программы"""
+
+    def setUp(self):
+        super().setUp()
+        # Кэш справочника User-Agent переживает откат транзакции теста
+        clear_user_agent_cache()
+
+    def make_user(self, username, **extra):
+        return User.objects.create_user(username=username, password='x', **extra)
+
+    def make_product(self, vendor, slug, price=100000):
+        return Product.objects.create(vendor=vendor, title=slug, slug=slug, price_uzs=price)
+
+    def make_order(self, customer, amount):
+        return Order.objects.create(
+            user=customer, customer_name=customer.username, customer_phone='+998901234567',
+            customer_address='Tashkent', total_amount=amount,
+        )
+
+    def make_visit(self, link, anonymous_id, visited_at=None, **extra):
+        visit = ReferralVisit.objects.create(
+            referral_link=link, anonymous_id=anonymous_id, ip_address='127.0.0.1', agent_id=intern('test'), **extra
+        )
+        if visited_at is not None:
+            visit.visited_at = visited_at
+            self.move(ReferralVisit, visit.pk, 'visited_at', visited_at)
+        return visit
+
+    def move(self, model, pk, source, moment):
+        """Переносит строку в прошлое; локальные колонки пересчитываются в SQL, как при дозаполнении"""
+        model.objects.filter(pk=pk).update(**{source: moment})
+        model.objects.filter(pk=pk).update(local_date=TruncDate(source), local_hour=ExtractHour(source))
+
+    def make_reward(self, link, order, product, amount, status='APPROVED', **extra):
+        return ReferralReward.objects.create(
+            referral_link=link, order=order, attributed_user=link.user, product=product,
+            order_amount=order.total_amount, reward_percentage=Decimal('5.00'), reward_amount=amount,
+            status=status, ip_address='127.0.0.1', user_agent='test', **extra,
+        )
+
+
+class ReferralAnalyticsViewTests(ReferralFixtures, EstimateAssertions, TestCase):
+    """GET /api/referral-analytics/ по посещениям и вознаграждениям"""
+
+    def setUp(self):
+        super().setUp()
+        self.admin = self.make_user('admin', role='superadmin')
+        self.referrer = self.make_user('referrer')
+        vendor = self.make_user('vendor', role='vendor')
+        self.product = self.make_product(vendor, 'phone')
+        self.link = ReferralLink.objects.create(user=self.referrer, product=self.product)
+        self.client.force_login(self.admin)
+
+    def analytics(self, time_range='7d'):
+        response = self.client.get('/api/referral-analytics/', {'time_range': time_range})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def test_conversions_come_from_rewards_without_reversed(self):
+        for i in range(4):
+            self.make_visit(self.link, f'v{i}')
+        customer = self.make_user('customer')
+        self.make_reward(self.link, self.make_order(customer, Decimal('200000')), self.product, Decimal('10000'))
+        self.make_reward(
+            self.link, self.make_order(customer, Decimal('50000')), self.product, Decimal('2500'), status='REVERSED',
+        )
+
+        data = self.analytics()
+        overview = data['overview']
+        self.assertEqual(overview['total_clicks'], 4)
+        self.assertEqual(overview['total_conversions'], 1)
+        self.assertEqual(overview['total_revenue'], 200000)
+        self.assertEqual(overview['total_commission'], 10000)
+        self.assertEqual(overview['conversion_rate'], 25)
+        self.assertEqual(data['top_products'][0]['id'], self.product.pk)
+        self.assertEqual(data['top_products'][0]['clicks'], 4)
+        self.assertEqual(data['top_referrers'][0]['username'], 'referrer')
+        self.assertEqual(data['top_referrers'][0]['commission'], 10000)
+
+    def test_funnel_visitors_match_distinct_visitors(self):
+        other = ReferralLink.objects.create(user=self.referrer)
+        now = timezone.now()
+        for i in range(400):
+            # Повторы и пересечение посетителей между ссылками и днями
+            record_visit(self.make_visit(self.link, f'a{i % 250}', visited_at=now - timedelta(days=i % 3)))
+            record_visit(self.make_visit(other, f'a{i % 300 + 100}'))
+        exact = ReferralVisit.objects.values('anonymous_id').distinct().count()
+
+        funnel = self.analytics()['conversion_funnel']
+        self.assertEqual(funnel['clicks'], 800)
+        self.assertEstimateClose(funnel['visitors'], exact)
+
+    def test_daily_stats_follow_local_days(self):
+        today_start = timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0)
+        late_yesterday = today_start - timedelta(minutes=30)
+        self.make_visit(self.link, 'late', visited_at=late_yesterday)
+        self.make_visit(self.link, 'early', visited_at=today_start + timedelta(minutes=1))
+        reward = self.make_reward(
+            self.link, self.make_order(self.make_user('customer'), Decimal('80000')), self.product, Decimal('4000'),
+        )
+        self.move(ReferralReward, reward.pk, 'created_at', late_yesterday)
+
+        daily = {row['date']: row for row in self.analytics()['daily_stats']}
+        yesterday = daily[late_yesterday.date().isoformat()]
+        self.assertEqual((yesterday['clicks'], yesterday['conversions'], yesterday['commission']), (1, 1, 4000))
+        self.assertEqual(daily[today_start.date().isoformat()]['clicks'], 1)
+
+    def test_empty_period(self):
+        data = self.analytics('30d')
+        self.assertEqual(data['overview']['total_conversions'], 0)
+        self.assertEqual(len(data['daily_stats']), 30)
+
+
+class LocalBucketTests(ReferralFixtures, TestCase):
+    """Колонки local_date / local_hour: заполнение при вставке, дозаполнение и счетчики ссылки"""
+
+    def setUp(self):
+        super().setUp()
+        self.link = ReferralLink.objects.create(user=self.make_user('referrer'))
+
+    def test_insert_fills_local_columns(self):
+        visit = self.make_visit(self.link, 'v')
+        visit.refresh_from_db()
+        local = timezone.localtime(visit.visited_at)
+        self.assertEqual((visit.local_date, visit.local_hour), (local.date(), local.hour))
+
+    def test_backfill_uses_project_time_zone(self):
+        # 20:30 UTC - уже следующий день в часовом поясе проекта (Asia/Tashkent, UTC+5)
+        moment = datetime(2026, 1, 10, 20, 30, tzinfo=dt_timezone.utc)
+        visits = [self.make_visit(self.link, f'v{i}', visited_at=moment + timedelta(hours=i)) for i in range(5)]
+        ReferralVisit.objects.filter(pk__in=[v.pk for v in visits[:4]]).update(local_date=None, local_hour=None)
+
+        self.assertEqual(backfill_model(ReferralVisit, 'visited_at', chunk_size=2), 4)
+        for visit in visits:
+            visit.refresh_from_db()
+            local = timezone.localtime(visit.visited_at)
+            self.assertEqual((visit.local_date, visit.local_hour), (local.date(), local.hour))
+        self.assertEqual((visits[0].local_date, visits[0].local_hour), (date(2026, 1, 11), 1))
+        self.assertEqual(backfill_model(ReferralVisit, 'visited_at'), 0)
+
+    def test_link_stats_today_and_week(self):
+        today_start = timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.make_visit(self.link, 'now')
+        self.make_visit(self.link, 'yesterday', visited_at=today_start - timedelta(minutes=1))
+        self.make_visit(self.link, 'old', visited_at=timezone.now() - timedelta(days=8))
+        product = self.make_product(self.make_user('vendor', role='vendor'), 'phone')
+        customer = self.make_user('customer')
+        self.make_reward(self.link, self.make_order(customer, Decimal('1000')), product, Decimal('50'))
+        old = self.make_reward(self.link, self.make_order(customer, Decimal('1000')), product, Decimal('50'))
+        self.move(ReferralReward, old.pk, 'created_at', today_start - timedelta(days=3))
+
+        stats = ReferralLinkStatsSerializer(self.link).data
+        self.assertEqual((stats['clicks_today'], stats['clicks_this_week'], stats['clicks_this_month']), (1, 2, 3))
+        self.assertEqual((stats['conversions_today'], stats['conversions_this_week']), (1, 2))
+
+
+class ClientIpTests(TestCase):
+    """IP клиента для ограничения частоты: X-Forwarded-For только от доверенных прокси"""
+
+    def request(self, remote_addr, forwarded=None):
+        extra = {'HTTP_X_FORWARDED_FOR': forwarded} if forwarded else {}
+        return RequestFactory().get('/', REMOTE_ADDR=remote_addr, **extra)
+
+    def test_untrusted_peer_ignores_forwarded_header(self):
+        self.assertEqual(client_ip(self.request('203.0.113.7', '1.2.3.4')), '203.0.113.7')
+
+    @override_settings(TRUSTED_PROXIES=['10.0.0.1', '10.0.0.2'])
+    def test_chain_is_read_right_to_left(self):
+        # Левое значение подставил клиент - берется первый адрес перед доверенными прокси
+        request = self.request('10.0.0.1', 'spoofed, 198.51.100.4, 10.0.0.2')
+        self.assertEqual(client_ip(request), '198.51.100.4')
+        self.assertEqual(client_ip(self.request('10.0.0.1')), '10.0.0.1')
+
+    @override_settings(TRUSTED_PROXIES=['10.0.0.1'], API_BASE_URL='http://api')
+    def test_middleware_forwards_resolved_address(self):
+        request = self.request('10.0.0.1', 'spoofed, 198.51.100.4')
+        with mock.patch('market.middleware.requests.post') as post:
+            post.return_value.status_code = 201
+            ReferralTrackingMiddleware(lambda request: None)._track_referral_visit({'referral_code': 'CODE'}, request)
+        self.assertEqual(post.call_args.kwargs['headers']['X-Forwarded-For'], '198.51.100.4')
+
+
+class SettlementTests(ReferralFixtures, TestCase):
+    """Пакетная выплата: покрытие выплат вознаграждениями и списание балансов"""
+
+    def setUp(self):
+        super().setUp()
+        self.referrer = self.make_user('referrer')
+        vendor = self.make_user('vendor', role='vendor')
+        customer = self.make_user('customer')
+        self.product = self.make_product(vendor, 'phone')
+        self.link = ReferralLink.objects.create(user=self.referrer, product=self.product)
+        approved_at = timezone.now() - timedelta(days=3)
+        self.rewards = []
+        for i, amount in enumerate([Decimal('100'), Decimal('150')]):
+            self.rewards.append(self.make_reward(
+                self.link, self.make_order(customer, amount * 20), self.product, amount,
+                available_amount=amount, approved_at=approved_at + timedelta(hours=i),
+            ))
+        # Баланс ведет сигнал сохранения вознаграждений
+        self.balance = ReferralBalance.objects.get(user=self.referrer)
+        self.assertEqual(self.balance.available_amount, Decimal('250'))
+
+    def make_payout(self, amount):
+        return ReferralPayout.objects.create(
+            user=self.referrer, amount=amount, payment_method='BANK_TRANSFER', payment_details={},
+        )
+
+    def test_partial_coverage_and_skipped_payout(self):
+        covered = self.make_payout(Decimal('120'))
+        uncovered = self.make_payout(Decimal('200'))
+
+        run = settle_payouts('run-1')
+
+        self.assertEqual((run.payouts_count, run.skipped_count, run.rewards_count), (1, 1, 2))
+        self.assertEqual(run.total_amount, Decimal('120'))
+        first, second = [ReferralReward.objects.get(pk=reward.pk) for reward in self.rewards]
+        self.assertEqual(first.status, 'PAID_OUT')
+        # Вторая покрыта на 20 и остается одобренной с остатком
+        self.assertEqual((second.status, second.available_amount), ('APPROVED', Decimal('130')))
+        covered.refresh_from_db()
+        self.assertEqual((covered.status, covered.settlement_run_id), ('COMPLETED', run.pk))
+        self.assertCountEqual(covered.rewards.values_list('pk', flat=True), [first.pk, second.pk])
+        uncovered.refresh_from_db()
+        self.assertEqual((uncovered.status, uncovered.rewards.count()), ('PENDING', 0))
+
+        self.balance.refresh_from_db()
+        self.assertEqual(self.balance.available_amount, Decimal('130'))
+        self.assertEqual(self.balance.total_paid_out, Decimal('120'))
+        self.assertEqual(ReferralEvent.objects.filter(kind=ReferralEvent.PAYOUT, status='COMPLETED').count(), 1)
+        self.assertTrue(
+            ReferralEvent.objects.filter(kind=ReferralEvent.REWARD_STATE, object_id=first.pk, status='PAID_OUT').exists()
+        )
+
+    def test_repeated_run_id_is_noop(self):
+        self.make_payout(Decimal('100'))
+        run = settle_payouts('run-1')
+        later = self.make_payout(Decimal('50'))
+
+        self.assertEqual(settle_payouts('run-1').pk, run.pk)
+        later.refresh_from_db()
+        self.assertEqual(later.status, 'PENDING')
+        self.balance.refresh_from_db()
+        self.assertEqual(self.balance.available_amount, Decimal('150'))
+        self.assertEqual(self.balance.total_paid_out, Decimal('100'))
+        self.assertEqual(PayoutSettlementRun.objects.count(), 1)
+
+    def test_settle_endpoint(self):
+        self.make_payout(Decimal('250'))
+        self.client.force_login(self.make_user('admin', role='superadmin'))
+
+        response = self.client.post('/api/referral-payouts/settle/', {'run_id': 'daily'})
+
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['payouts_count'], 1)
+        self.assertFalse(ReferralReward.objects.filter(status='APPROVED').exists())
+
+    def test_request_payout(self):
+        self.client.force_login(self.referrer)
+
+        response = self.client.post('/api/referral-payouts/request/', {
+            'amount': '200', 'payment_method': 'BANK_TRANSFER', 'payment_details': {'card': '8600'},
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 201, response.content)
+        payout = ReferralPayout.objects.get(pk=response.json()['payout_id'])
+        self.assertEqual((payout.status, payout.amount, payout.payment_details), ('PENDING', Decimal('200'), {'card': '8600'}))
+
+        response = self.client.post('/api/referral-payouts/request/', {'amount': '300'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/referral-payouts/request/', {'amount': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+
+class CatalogImportTests(ReferralFixtures, TestCase):
+    """Импорт каталога продавца из CSV/JSONL"""
+
+    def setUp(self):
+        super().setUp()
+        self.vendor = self.make_user('vendor', role='vendor')
+
+    def run_import(self, text, input_format='csv', vendor=None):
+        return import_catalog(vendor or self.vendor, BytesIO(text.encode()), input_format)
+
+    def test_new_row_creates_product(self):
+        report = self.run_import('sku,title,price_uzs,stock\nA-1,Phone,150000,3\n')
+
+        self.assertEqual((report['created'], report['updated'], report['error_count']), (1, 0, 0), report)
+        product = Product.objects.get(vendor=self.vendor, sku='A-1')
+        self.assertEqual((product.title, product.price_uzs, product.stock), ('Phone', Decimal('150000'), 3))
+        self.assertTrue(product.slug)
+
+    def test_new_row_requires_title_and_price(self):
+        report = self.run_import('{"sku": "A-1", "stock": 3}\n', 'jsonl')
+
+        self.assertEqual((report['created'], report['error_count']), (0, 1))
+        self.assertEqual(set(report['errors'][0]['errors']), {'title', 'price_uzs'})
+        self.assertFalse(Product.objects.filter(sku='A-1').exists())
+
+    def test_stock_only_row_updates_existing_sku(self):
+        self.run_import('sku,title,price_uzs,stock\nA-1,Phone,150000,3\n')
+
+        report = self.run_import('sku,stock\nA-1,10\n')
+
+        self.assertEqual((report['created'], report['updated'], report['error_count']), (0, 1, 0), report)
+        product = Product.objects.get(vendor=self.vendor, sku='A-1')
+        self.assertEqual((product.title, product.price_uzs, product.stock), ('Phone', Decimal('150000'), 10))
+
+    def test_slug_of_other_vendor_is_row_error(self):
+        other = self.make_user('other', role='vendor')
+        self.make_product(other, 'phone')
+
+        report = self.run_import('slug,title,price_uzs\nphone,Mine,1000\ncase,Case,500\n')
+
+        self.assertEqual((report['created'], report['error_count']), (1, 1), report)
+        self.assertEqual(report['errors'][0]['errors'], {'slug': ['slug занят товаром другого продавца']})
+        product = Product.objects.get(slug='phone')
+        self.assertEqual((product.vendor_id, product.title), (other.pk, 'phone'))
+        self.assertEqual(Product.objects.get(slug='case').vendor_id, self.vendor.pk)
+
+
+class FakeRedis:
+    """Список Redis в памяти: ровно те команды, которыми пользуется очередь атрибуций"""
+
+    def __init__(self):
+        self.lists = {}
+
+    def rpush(self, key, *values):
+        self.lists.setdefault(key, []).extend(values)
+        return len(self.lists[key])
+
+    def lpush(self, key, *values):
+        for value in values:
+            self.lists.setdefault(key, []).insert(0, value)
+        return len(self.lists[key])
+
+    def lrange(self, key, start, end):
+        items = self.lists.get(key, [])
+        return items[start:] if end == -1 else items[start:end + 1]
+
+    def ltrim(self, key, start, end):
+        self.lists[key] = self.lrange(key, start, end)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.commands.append((name, args))
+
+    def execute(self):
+        return [getattr(self.client, name)(*args) for name, args in self.commands]
+
+
+class AttributionTests(ReferralFixtures, TestCase):
+    """Атрибуция последнего клика: кэш, очередь Redis и журнал в БД"""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        ReferralProgram.objects.create(attribution_window_days=30)
+        self.referrer = self.make_user('referrer')
+        self.other = self.make_user('other')
+        vendor = self.make_user('vendor', role='vendor')
+        self.product = self.make_product(vendor, 'phone')
+        self.first_link = ReferralLink.objects.create(user=self.referrer, product=self.product)
+        self.second_link = ReferralLink.objects.create(user=self.other, product=self.product)
+
+    def click(self, link, anonymous_id='visitor', user_id=None):
+        visit = self.make_visit(link, anonymous_id)
+        return record_attributions([(visit, self.product.pk, user_id)])
+
+    def test_last_click_wins_in_cache_and_database(self):
+        self.click(self.first_link)
+        last = self.click(self.second_link)[0]
+
+        found = find_attribution('visitor', None, self.product.pk)
+        self.assertEqual((found.referral_link_id, found.last_visit_id), (self.second_link.pk, last.last_visit_id))
+        stored = ReferralAttribution.objects.get(anonymous_id='visitor', product=self.product)
+        self.assertEqual(stored.referral_link_id, self.second_link.pk)
+
+    def test_persist_keeps_latest_record_per_key_and_known_user(self):
+        customer = self.make_user('customer')
+        first = self.make_visit(self.first_link, 'visitor')
+        second = self.make_visit(self.second_link, 'visitor')
+        expires_at = timezone.now() + timedelta(days=1)
+
+        saved = persist([
+            AttributionRecord('visitor', self.product.pk, customer.pk, self.first_link.pk, first.pk, expires_at),
+            AttributionRecord('visitor', self.product.pk, None, self.second_link.pk, second.pk, expires_at),
+        ])
+
+        self.assertEqual(saved, 1)
+        stored = ReferralAttribution.objects.get(anonymous_id='visitor', product=self.product)
+        self.assertEqual((stored.referral_link_id, stored.last_visit_id), (self.second_link.pk, second.pk))
+        # Запись без пользователя не стирает уже известного
+        persist([AttributionRecord('visitor', self.product.pk, customer.pk, self.first_link.pk, first.pk, expires_at)])
+        persist([AttributionRecord('visitor', self.product.pk, None, self.second_link.pk, second.pk, expires_at)])
+        self.assertEqual(ReferralAttribution.objects.get(pk=stored.pk).user_id, customer.pk)
+
+    def test_queue_is_flushed_to_database(self):
+        client = FakeRedis()
+        with mock.patch('market.attribution.get_client', return_value=client):
+            self.click(self.first_link)
+            self.click(self.second_link)
+            self.assertFalse(ReferralAttribution.objects.exists())
+            self.assertEqual(len(client.lists[PENDING_QUEUE_KEY]), 2)
+
+            self.assertEqual(flush_pending(), 2)
+
+        self.assertEqual(client.lists[PENDING_QUEUE_KEY], [])
+        stored = ReferralAttribution.objects.get(anonymous_id='visitor', product=self.product)
+        self.assertEqual(stored.referral_link_id, self.second_link.pk)
+
+    def test_failed_flush_is_requeued(self):
+        client = FakeRedis()
+        with mock.patch('market.attribution.get_client', return_value=client):
+            self.click(self.first_link, 'a')
+            self.click(self.second_link, 'b')
+            queued = list(client.lists[PENDING_QUEUE_KEY])
+
+            with mock.patch('market.attribution.persist', side_effect=DatabaseError('down')):
+                with self.assertRaises(DatabaseError):
+                    flush_pending(batch_size=1)
+            # Неудачная пачка возвращена в начало очереди в прежнем порядке
+            self.assertEqual(client.lists[PENDING_QUEUE_KEY], queued)
+
+            self.assertEqual(flush_pending(), 2)
+        self.assertEqual(ReferralAttribution.objects.count(), 2)
+
+    def test_cache_miss_falls_back_to_database_with_redis(self):
+        self.click(self.first_link)
+        cache.clear()
+
+        with mock.patch('market.attribution.get_client', return_value=FakeRedis()):
+            found = find_attribution('visitor', None, self.product.pk)
+            self.assertEqual(found.referral_link_id, self.first_link.pk)
+            # Найденная в БД атрибуция прогревает кэш
+            with self.assertNumQueries(0):
+                self.assertEqual(find_attribution('visitor', None, self.product.pk).referral_link_id, self.first_link.pk)
+
+
+class IdentityStitchTests(ReferralFixtures, TestCase):
+    """Склейка анонимного посетителя с пользователем при входе"""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        ReferralProgram.objects.create(attribution_window_days=30)
+        self.customer = self.make_user('customer')
+        referrer = self.make_user('referrer')
+        vendor = self.make_user('vendor', role='vendor')
+        self.product = self.make_product(vendor, 'phone')
+        self.link = ReferralLink.objects.create(user=referrer, product=self.product)
+
+    def make_attribution(self, anonymous_id, expires_in, user=None):
+        return ReferralAttribution.objects.create(
+            anonymous_id=anonymous_id, user=user, referral_link=self.link, product=self.product,
+            last_visit=self.make_visit(self.link, anonymous_id), expires_at=timezone.now() + expires_in,
+        )
+
+    def test_latest_attribution_of_product_is_kept(self):
+        # Переходы с двух устройств: у ноутбука срок позже, телефон теряет пользователя
+        phone = self.make_attribution('phone', timedelta(days=5), user=self.customer)
+        laptop = self.make_attribution('laptop', timedelta(days=20))
+
+        result = stitch_identity('laptop', self.customer.pk)
+
+        self.assertEqual((result['attributions'], result['superseded']), (1, 1))
+        phone.refresh_from_db()
+        laptop.refresh_from_db()
+        self.assertEqual((phone.user_id, phone.anonymous_id), (None, 'phone'))
+        self.assertEqual(laptop.user_id, self.customer.pk)
+        found = find_attribution(None, self.customer.pk, self.product.pk)
+        self.assertEqual(found.anonymous_id, 'laptop')
+
+    def test_older_stitched_attribution_is_unassigned(self):
+        phone = self.make_attribution('phone', timedelta(days=20), user=self.customer)
+        laptop = self.make_attribution('laptop', timedelta(days=5))
+
+        stitch_identity('laptop', self.customer.pk)
+
+        self.assertEqual(ReferralAttribution.objects.get(pk=phone.pk).user_id, self.customer.pk)
+        self.assertIsNone(ReferralAttribution.objects.get(pk=laptop.pk).user_id)
+
+    def test_visits_are_reassigned_in_batches(self):
+        for _ in range(5):
+            self.make_visit(self.link, 'visitor')
+        stranger = self.make_visit(self.link, 'stranger')
+
+        with CaptureQueriesContext(connection) as queries:
+            result = stitch_identity('visitor', self.customer.pk, batch_size=2)
+
+        self.assertEqual(result['visits'], 5)
+        self.assertEqual(ReferralVisit.objects.filter(anonymous_id='visitor', user=self.customer).count(), 5)
+        self.assertIsNone(ReferralVisit.objects.get(pk=stranger.pk).user_id)
+        updates = [query for query in queries if query['sql'].startswith('UPDATE "market_referralvisit"')]
+        self.assertEqual(len(updates), 3)
+
+    def test_long_history_is_stitched_in_background(self):
+        for _ in range(3):
+            self.make_visit(self.link, 'visitor')
+
+        with mock.patch('market.identity.INLINE_VISIT_LIMIT', 2), \
+                mock.patch('market.identity.threading.Thread') as thread:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertIsNone(schedule_identity_stitch('visitor', self.customer.pk))
+            # До запуска потока история не тронута
+            self.assertFalse(ReferralVisit.objects.filter(user=self.customer).exists())
+
+        thread.return_value.start.assert_called_once_with()
+        kwargs = thread.call_args.kwargs
+        self.assertEqual(kwargs['args'], ('visitor', self.customer.pk))
+        # Поток закрывает свое соединение; в тесте цель выполняется в текущем потоке
+        with mock.patch('market.identity.connection'):
+            kwargs['target'](*kwargs['args'])
+        self.assertEqual(ReferralVisit.objects.filter(user=self.customer).count(), 3)
+
+    def login(self, **cookies):
+        self.client.cookies.load(cookies)
+        return self.client.post('/api/auth/login/', {'username': 'customer', 'password': 'x'})
+
+    def test_login_stitches_signed_cookie_visitor(self):
+        self.make_attribution('visitor', timedelta(days=10))
+        response = HttpResponse()
+        set_anonymous_id_cookie(response, 'visitor')
+
+        self.assertEqual(self.login(anonymous_id=response.cookies['anonymous_id'].value).status_code, 200)
+
+        self.assertEqual(ReferralVisit.objects.get(anonymous_id='visitor').user_id, self.customer.pk)
+        self.assertEqual(ReferralAttribution.objects.get(anonymous_id='visitor').user_id, self.customer.pk)
+
+    def test_login_ignores_unsigned_cookie(self):
+        self.make_attribution('visitor', timedelta(days=10))
+
+        self.assertEqual(self.login(anonymous_id='visitor').status_code, 200)
+
+        self.assertIsNone(ReferralAttribution.objects.get(anonymous_id='visitor').user_id)
+
+
+class EventReplayTests(ReferralFixtures, TestCase):
+    """Дозапись истории в журнал и пересчет счетчиков по нему"""
+
+    def setUp(self):
+        super().setUp()
+        self.referrer = self.make_user('referrer')
+        vendor = self.make_user('vendor', role='vendor')
+        self.customer = self.make_user('customer')
+        self.product = self.make_product(vendor, 'phone')
+        self.link = ReferralLink.objects.create(user=self.referrer, product=self.product)
+
+    def build_history(self):
+        # Переходы до выкладки журнала и один живой
+        self.make_visit(self.link, 'old-1')
+        self.make_visit(self.link, 'old-2')
+        log_click(self.make_visit(self.link, 'live'), self.referrer.pk)
+
+        now = timezone.now()
+        pending = self.make_reward(
+            self.link, self.make_order(self.customer, Decimal('2000')), self.product, Decimal('100'),
+            status='PENDING', locked_amount=Decimal('100'),
+        )
+        self.make_reward(
+            self.link, self.make_order(self.customer, Decimal('3000')), self.product, Decimal('150'),
+            available_amount=Decimal('150'), approved_at=now - timedelta(days=1),
+        )
+        self.make_reward(
+            self.link, self.make_order(self.customer, Decimal('1000')), self.product, Decimal('50'), status='REVERSED',
+        )
+        # Смена состояния пишется в журнал при сохранении
+        pending.status, pending.locked_amount, pending.available_amount = 'APPROVED', 0, Decimal('100')
+        pending.approved_at = now
+        pending.save()
+
+        ReferralPayout.objects.create(
+            user=self.referrer, amount=Decimal('120'), payment_method='BANK_TRANSFER', payment_details={},
+        )
+        self.assertEqual(settle_payouts('replay').payouts_count, 1)
+
+    def test_replay_refuses_before_backfill(self):
+        self.build_history()
+
+        with self.assertRaises(ValueError):
+            replay_events()
+
+    def test_replay_restores_corrupted_counters(self):
+        self.build_history()
+        idle = ReferralLink.objects.create(user=self.make_user('idle'), total_clicks=5, total_rewards=Decimal('10'))
+        backfill_events()
+
+        ReferralLink.objects.update(total_clicks=99, total_conversions=0, total_rewards=0)
+        ReferralBalance.objects.update(total_earned=0, locked_amount=Decimal('7'), available_amount=0, total_paid_out=0)
+        stats = replay_events()
+
+        link = ReferralLink.objects.get(pk=self.link.pk)
+        self.assertEqual((link.total_clicks, link.total_conversions, link.total_rewards), (3, 2, Decimal('250')))
+        # У реферера без событий счетчики обнулены
+        idle.refresh_from_db()
+        self.assertEqual((idle.total_clicks, idle.total_rewards), (0, Decimal('0')))
+        balance = ReferralBalance.objects.get(user=self.referrer)
+        restored = (balance.total_earned, balance.locked_amount, balance.available_amount, balance.total_paid_out)
+        # Сумма оставшихся одобренных: 100 + (150 - 120)
+        self.assertEqual(restored, (Decimal('300'), Decimal('0'), Decimal('130'), Decimal('120')))
+        balance.update_balance()
+        self.assertEqual(
+            (balance.total_earned, balance.locked_amount, balance.available_amount, balance.total_paid_out), restored,
+        )
+        self.assertEqual(stats['orphans'], 0)
+
+        # Повторный пересчет ничего не меняет
+        stats = replay_events()
+        self.assertEqual((stats['links'], stats['balances']), (0, 0))
+
+
+class ReviewAggregateTests(ReferralFixtures, TestCase):
+    """Денормализованные агрегаты отзывов товара"""
+
+    def setUp(self):
+        super().setUp()
+        self.product = self.make_product(self.make_user('vendor', role='vendor'), 'phone')
+
+    def review(self, username, rating, verified=False):
+        return Review.objects.create(
+            product=self.product, user=self.make_user(username), rating=rating, comment='ok', verified=verified,
+        )
+
+    def assertAggregates(self, count, total, by_rating, verified):
+        product = Product.objects.get(pk=self.product.pk)
+        self.assertEqual((product.rating_count, product.rating_sum, product.verified_review_count), (count, total, verified))
+        self.assertEqual([getattr(product, f'rating_{rating}_count') for rating in range(1, 6)], by_rating)
+        self.assertAlmostEqual(product.rating_average, total / count if count else 0.0)
+
+    def test_create_and_rating_change(self):
+        self.review('a', 5, verified=True)
+        second = self.review('b', 3)
+        self.assertAggregates(2, 8, [0, 0, 1, 0, 1], 1)
+
+        second.rating = 4
+        second.verified = True
+        second.save()
+        self.assertAggregates(2, 9, [0, 0, 0, 1, 1], 2)
+
+        # Повторное сохранение без изменений не сдвигает агрегаты
+        Review.objects.get(pk=second.pk).save()
+        self.assertAggregates(2, 9, [0, 0, 0, 1, 1], 2)
+
+    def test_delete(self):
+        first = self.review('a', 5, verified=True)
+        self.review('b', 2)
+
+        first.delete()
+        self.assertAggregates(1, 2, [0, 1, 0, 0, 0], 0)
+        Review.objects.all().delete()
+        self.assertAggregates(0, 0, [0] * 5, 0)
+
+    def test_deferred_fields(self):
+        review = self.review('a', 4, verified=True)
+        self.review('b', 2)
+
+        # Снимка вклада нет - прежние значения читаются из БД
+        deferred = Review.objects.only('id', 'comment').get(pk=review.pk)
+        deferred.rating = 1
+        deferred.save()
+        self.assertAggregates(2, 3, [1, 1, 0, 0, 0], 1)
+
+        Review.objects.defer('rating', 'verified').get(pk=review.pk).delete()
+        self.assertAggregates(1, 2, [0, 1, 0, 0, 0], 0)
+
+
+class SalesRankingTests(ReferralFixtures, TestCase):
+    """Счетчики продаж, трендовый рейтинг и бестселлеры"""
+
+    def setUp(self):
+        super().setUp()
+        vendor = self.make_user('vendor', role='vendor')
+        self.customer = self.make_user('customer')
+        self.old_hit = self.make_product(vendor, 'old-hit')
+        self.new_hit = self.make_product(vendor, 'new-hit')
+        self.link = ReferralLink.objects.create(user=self.make_user('referrer'), product=self.old_hit)
+
+    def sell(self, product, quantity, status='delivered', days_ago=0):
+        order = self.make_order(self.customer, product.price_uzs * quantity)
+        OrderItem.objects.create(order=order, product=product, quantity=quantity, price=product.price_uzs)
+        Order.objects.filter(pk=order.pk).update(status=status)
+        if days_ago:
+            self.move(Order, order.pk, 'created_at', timezone.now() - timedelta(days=days_ago))
+        return order
+
+    def test_sales_counters_count_confirmed_orders(self):
+        referred = self.sell(self.old_hit, 2)
+        self.make_reward(self.link, referred, self.old_hit, Decimal('100'))
+        self.sell(self.old_hit, 3, status='shipped')
+        self.sell(self.new_hit, 5, status='processing')
+        self.sell(self.new_hit, 7, status='pending')
+        self.sell(self.new_hit, 7, status='cancelled')
+
+        self.assertEqual(update_sales_counters(), 2)
+
+        old_hit = Product.objects.get(pk=self.old_hit.pk)
+        self.assertEqual(
+            (old_hit.total_sales, old_hit.total_referral_sales, old_hit.sales_percentage), (5, 2, Decimal('50.00')),
+        )
+        new_hit = Product.objects.get(pk=self.new_hit.pk)
+        self.assertEqual((new_hit.total_sales, new_hit.total_referral_sales), (5, 0))
+        self.assertEqual(update_sales_counters(), 0)
+
+    def test_trending_decays_old_sales(self):
+        self.sell(self.old_hit, 6, days_ago=20)
+        self.sell(self.new_hit, 4)
+
+        self.assertEqual(rebuild_sales_rankings(), 2)
+
+        old_rank = ProductSalesRank.objects.get(product=self.old_hit)
+        new_rank = ProductSalesRank.objects.get(product=self.new_hit)
+        self.assertEqual((old_rank.bestseller_rank, new_rank.bestseller_rank), (1, 2))
+        self.assertEqual((old_rank.trending_rank, new_rank.trending_rank), (2, 1))
+        # Вклад продаж 20-дневной давности: 6 * 2^(-20/7)
+        self.assertAlmostEqual(old_rank.trending_score, 6 * 2 ** (-20 / 7), places=6)
+        self.assertEqual(list(trending_products()), [self.new_hit, self.old_hit])
+        self.assertEqual(list(bestseller_products()), [self.old_hit, self.new_hit])
+
+        Product.objects.filter(pk=self.old_hit.pk).update(is_active=False)
+        self.assertEqual(list(bestseller_products()), [self.new_hit])
+
+    def bestsellers(self, limit):
+        return self.client.get('/api/products/bestsellers/', {'limit': limit})
+
+    def test_bestseller_limit_is_clamped(self):
+        self.sell(self.old_hit, 6)
+        self.sell(self.new_hit, 4)
+        rebuild_sales_rankings()
+
+        self.assertEqual([row['id'] for row in self.bestsellers(0).json()], [self.old_hit.pk])
+        self.assertEqual(len(self.bestsellers(-5).json()), 1)
+        self.assertEqual(len(self.bestsellers(1000).json()), 2)
+        with mock.patch('market.views.bestseller_products', wraps=bestseller_products) as ranked:
+            self.bestsellers(1000)
+        ranked.assert_called_once_with(limit=100)
+        response = self.bestsellers('ten')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', response.json())
+
+
+def per_row_fraud_scores(rewards):
+    """Эталон: признаки fraud.py, посчитанные перебором по каждому вознаграждению"""
+    visits = list(ReferralVisit.objects.values_list('referral_link_id', 'ip_address', 'visited_at'))
+    scored = list(ReferralReward.objects.values_list('user_agent', 'attributed_user_id', 'created_at'))
+    start = min(r['created_at'] for r in rewards) - fraud.SHARED_UA_WINDOW
+    end = max(r['created_at'] for r in rewards)
+    results = {}
+    for r in rewards:
+        created = r['created_at']
+        ip_clicks = sum(
+            1 for _, ip, moment in visits if ip == r['ip_address'] and created - fraud.IP_CLICK_WINDOW <= moment <= created
+        )
+        previous = [
+            moment for link_id, ip, moment in visits
+            if link_id == r['referral_link_id'] and ip == r['ip_address']
+            and created - fraud.CONVERSION_LOOKBACK <= moment <= created
+        ]
+        referrers = {
+            user_id for agent, user_id, moment in scored
+            if r['user_agent'] and agent == r['user_agent'] and start <= moment <= end
+        }
+        features = {
+            'ip_clicks': float(fraud._ramp(ip_clicks, fraud.IP_CLICK_THRESHOLD, fraud.IP_CLICK_THRESHOLD * 5)),
+            'conversion_time': 0.5 if not previous else 1.0 - float(fraud._ramp(
+                (created - max(previous)).total_seconds(), fraud.FAST_CONVERSION_SECONDS, fraud.SLOW_CONVERSION_SECONDS,
+            )),
+            'shared_user_agent': float(fraud._ramp(
+                len(referrers), fraud.SHARED_UA_THRESHOLD, fraud.SHARED_UA_THRESHOLD * 4,
+            )),
+            'self_referral': 1.0 if fraud._is_self_referral(r) else 0.0,
+        }
+        legit = 1.0
+        for name, value in features.items():
+            legit *= 1.0 - fraud.WEIGHTS[name] * value
+        results[r['id']] = (1.0 - legit, features)
+    return results
+
+
+class FraudScoreTests(ReferralFixtures, TestCase):
+    """Векторные признаки fraud.py совпадают с построчным расчетом"""
+
+    def setUp(self):
+        super().setUp()
+        vendor = self.make_user('vendor', role='vendor')
+        self.product = self.make_product(vendor, 'phone')
+        self.referrers = [self.make_user(f'referrer{i}', phone=f'+99890000000{i}') for i in range(5)]
+        self.links = [ReferralLink.objects.create(user=user, product=self.product) for user in self.referrers]
+        self.buyer = self.make_user('buyer')
+        self.now = timezone.now().replace(microsecond=0)
+
+    def visit(self, link, ip, moment):
+        visit = self.make_visit(link, f'v-{ip}', visited_at=moment)
+        ReferralVisit.objects.filter(pk=visit.pk).update(ip_address=ip)
+
+    def reward(self, link, ip, moment, user_agent='ua', customer=None, phone='+998911111111'):
+        order = self.make_order(customer or self.buyer, Decimal('1000'))
+        Order.objects.filter(pk=order.pk).update(customer_phone=phone)
+        reward = self.make_reward(link, order, self.product, Decimal('50'))
+        ReferralReward.objects.filter(pk=reward.pk).update(ip_address=ip, user_agent=user_agent)
+        self.move(ReferralReward, reward.pk, 'created_at', moment)
+        return reward
+
+    def batch(self):
+        return list(ReferralReward.objects.order_by('pk').values(*fraud.REWARD_FIELDS))
+
+    def assertMatchesPerRow(self, batch):
+        expected = per_row_fraud_scores(batch)
+        actual = fraud.score_rewards(batch)
+        self.assertEqual(set(actual), set(expected))
+        for reward_id, (score, features) in expected.items():
+            # Итог округляется до 4 знаков
+            self.assertAlmostEqual(actual[reward_id][0], score, delta=0.5e-4 + 1e-12, msg=reward_id)
+            for name, value in features.items():
+                self.assertAlmostEqual(actual[reward_id][1][name], value, places=9, msg=(reward_id, name))
+
+    def test_window_edges(self):
+        link = self.links[0]
+        created = self.now - timedelta(hours=2)
+        # Переходы ровно на границах окна учитываются, за ними - нет
+        self.visit(link, '10.0.0.1', created)
+        self.visit(link, '10.0.0.1', created - fraud.IP_CLICK_WINDOW)
+        self.visit(link, '10.0.0.1', created - fraud.IP_CLICK_WINDOW - timedelta(microseconds=1))
+        self.visit(link, '10.0.0.1', created + timedelta(microseconds=1))
+        first = self.reward(link, '10.0.0.1', created)
+        # Переход с того же IP по другой ссылке не считается переходом к конверсии
+        self.visit(self.links[1], '10.0.0.2', created - timedelta(seconds=30))
+        second = self.reward(link, '10.0.0.2', created)
+        self.visit(link, '10.0.0.3', created - timedelta(seconds=65))
+        third = self.reward(link, '10.0.0.3', created)
+
+        scores = fraud.score_rewards(self.batch())
+
+        self.assertEqual(fraud._ip_click_feature(self.batch()).tolist(), [2, 1, 1])
+        self.assertEqual(scores[first.pk][1]['conversion_time'], 1.0)
+        self.assertEqual(scores[second.pk][1]['conversion_time'], 0.5)
+        self.assertAlmostEqual(scores[third.pk][1]['conversion_time'], 0.5)
+        self.assertMatchesPerRow(self.batch())
+
+    def test_random_batch_matches_per_row(self):
+        rng = random.Random(30)
+        ips = [f'10.0.1.{i}' for i in range(6)]
+        for _ in range(120):
+            self.visit(rng.choice(self.links), rng.choice(ips[:4]), self.now - timedelta(seconds=rng.randrange(3 * 3600)))
+        # Много переходов с одного IP - признак ip_clicks между порогами
+        for i in range(30):
+            self.visit(self.links[0], ips[0], self.now - timedelta(minutes=40, seconds=i))
+        agents = ['ua-a', 'ua-b', 'ua-c', '']
+        for _ in range(25):
+            link = rng.choice(self.links)
+            self.reward(
+                link, rng.choice(ips), self.now - timedelta(seconds=rng.randrange(3 * 3600)),
+                user_agent=rng.choice(agents), phone=rng.choice(['+998911111111', link.user.phone]),
+            )
+        self.reward(self.links[2], ips[1], self.now, customer=self.referrers[2])
+
+        batch = self.batch()
+        self.assertMatchesPerRow(batch)
+        self.assertTrue(any(0 < value < 1 for value in fraud._ramp(fraud._ip_click_feature(batch), 20, 100)))
+        # Пачки по частям считаются так же, как целиком
+        self.assertMatchesPerRow(batch[:7])
+
+
+class AnalyticsQueryTests(ReferralFixtures, TestCase):
+    """Проверка запроса ad-hoc аналитики"""
+
+    def setUp(self):
+        super().setUp()
+        clear_extracts()
+        self.addCleanup(clear_extracts)
+
+    def test_unknown_names_are_rejected_before_reading(self):
+        invalid = [
+            ({'dimensions': ['country']}, 'Unknown dimensions: country'),
+            ({'filters': {'country': 'UZ'}}, 'Unknown dimensions: country'),
+            ({'measures': ['visits', 'clicks', 'profit']}, 'Unknown measures: clicks, profit'),
+            ({'measures': []}, 'At least one measure is required'),
+            ({'grain': 'year'}, 'grain must be one of'),
+        ]
+        for query, message in invalid:
+            with self.subTest(query=query), self.assertNumQueries(0):
+                with self.assertRaisesMessage(ValueError, message):
+                    run_query(**query)
+
+    def test_endpoint_returns_400(self):
+        self.client.force_login(self.make_user('admin', role='superadmin'))
+
+        response = self.client.post(
+            '/api/admin/analytics/query/', {'dimensions': ['product'], 'measures': ['profit']},
+            content_type='application/json',
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'Unknown measures: profit'})
+
+    def test_known_query_groups_by_dimension(self):
+        referrer = self.make_user('referrer')
+        product = self.make_product(self.make_user('vendor', role='vendor'), 'phone')
+        link = ReferralLink.objects.create(user=referrer, product=product)
+        for anonymous_id in ['a', 'a', 'b', 'c']:
+            self.make_visit(link, anonymous_id)
+        self.make_reward(link, self.make_order(referrer, Decimal('1000')), product, Decimal('50'))
+
+        rows = run_query(['referral_link'], ['visits', 'visitors', 'conversions', 'conversion_rate'])
+
+        self.assertEqual(rows, [{
+            'referral_link': link.pk, 'visits': 4, 'visitors': 3, 'conversions': 1, 'conversion_rate': 25.0,
+        }])
+
+
+class CampaignReportTests(ReferralFixtures, EstimateAssertions, TestCase):
+    """Отчет по UTM-кампаниям из дневных агрегатов"""
+
+    def setUp(self):
+        super().setUp()
+        self.referrer = self.make_user('referrer')
+        self.customer = self.make_user('customer')
+        self.product = self.make_product(self.make_user('vendor', role='vendor'), 'phone')
+        self.link = ReferralLink.objects.create(user=self.referrer, product=self.product)
+        self.today = timezone.localdate()
+
+    def click(self, anonymous_id, campaign, source='tg'):
+        visit = self.make_visit(self.link, anonymous_id, utm_source=source, utm_campaign=campaign)
+        record_campaign_click(visit)
+        return visit
+
+    def convert(self, visit, amount):
+        return self.make_reward(
+            self.link, self.make_order(self.customer, amount * 20), self.product, amount, attributed_visit=visit,
+        )
+
+    def report(self, dimensions=('utm_campaign',), **kwargs):
+        return {row['utm_campaign']: row for row in campaign_report(list(dimensions), self.today, self.today, **kwargs)}
+
+    def build(self):
+        spring = [self.click(f'v{i % 6}', 'spring') for i in range(10)]
+        self.click('w1', 'winter')
+        self.click('w2', 'winter', source='ig')
+        rewards = [self.convert(spring[0], Decimal('100')), self.convert(spring[1], Decimal('40'))]
+        self.convert(None, Decimal('10'))
+        return rewards
+
+    def test_clicks_visitors_and_conversions(self):
+        self.build()
+
+        rows = self.report()
+
+        spring = rows['spring']
+        self.assertEqual((spring['clicks'], spring['conversions'], spring['conversion_rate']), (10, 2, 20.0))
+        self.assertEqual((spring['revenue'], spring['commission']), (2800.0, 140.0))
+        self.assertEstimateClose(spring['unique_visitors'], 6)
+        self.assertEqual((rows['winter']['clicks'], rows['winter']['conversions']), (2, 0))
+        # Вознаграждение без посещения - в строке без меток
+        self.assertEqual((rows['']['clicks'], rows['']['conversions'], rows['']['commission']), (0, 1, 10.0))
+        filtered = self.report(dimensions=('utm_source', 'utm_campaign'), filters={'utm_source': 'ig'})
+        self.assertEqual(list(filtered), ['winter'])
+        self.assertEqual(filtered['winter']['clicks'], 1)
+
+    def test_reversed_reward_is_subtracted(self):
+        reward, _ = self.build()
+
+        reward.status = 'REVERSED'
+        reward.save()
+        spring = self.report()['spring']
+        self.assertEqual((spring['conversions'], spring['revenue'], spring['commission']), (1, 800.0, 40.0))
+
+        # Восстановление возвращает конверсию
+        reward.status = 'APPROVED'
+        reward.save()
+        self.assertEqual(self.report()['spring']['conversions'], 2)
+
+    def test_rebuild_day_matches_live_counters(self):
+        reward, _ = self.build()
+        reward.status = 'REVERSED'
+        reward.save()
+        live = self.report()
+
+        rebuild_campaign_day(self.today)
+
+        self.assertEqual(self.report(), live)
+        self.assertEqual(CampaignDailyStat.objects.filter(day=self.today).exclude(shard=0).count(), 0)
+
+    def test_endpoint(self):
+        self.build()
+        self.client.force_login(self.make_user('ops', role='ops'))
+
+        response = self.client.get('/api/admin/analytics/campaigns/', {'dimensions': 'utm_campaign', 'grain': 'week'})
+
+        self.assertEqual(response.status_code, 200, response.content)
+        rows = {row['utm_campaign']: row for row in response.json()['rows']}
+        self.assertEqual(rows['spring']['period'], (self.today - timedelta(days=self.today.weekday())).isoformat())
+        self.assertEqual(rows['spring']['conversions'], 2)
+        response = self.client.get('/api/admin/analytics/campaigns/', {'dimensions': 'utm_country'})
+        self.assertEqual(response.status_code, 400)
+
+
+class UserAgentTests(TestCase):
+    """Классификация и справочник User-Agent"""
+
+    def setUp(self):
+        clear_user_agent_cache()
+        self.addCleanup(clear_user_agent_cache)
+
+    def test_classify(self):
+        cases = [
+            ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+             'Chrome/120.0 Safari/537.36 Edg/120.0', ('desktop', 'Windows', 'Edge', False)),
+            ('Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+             'Version/17.0 Mobile/15E148 Safari/604.1', ('mobile', 'iOS', 'Safari', False)),
+            ('Mozilla/5.0 (Linux; Android 13; SM-X200) AppleWebKit/537.36 (KHTML, like Gecko) '
+             'Chrome/120.0 Safari/537.36', ('tablet', 'Android', 'Chrome', False)),
+            ('Mozilla/5.0 (Linux; Android 13; Pixel 7) AppleWebKit/537.36 (KHTML, like Gecko) '
+             'Chrome/120.0 Mobile Safari/537.36 OPR/79.0', ('mobile', 'Android', 'Opera', False)),
+            ('Mozilla/5.0 (Macintosh; Intel Mac OS X 14_0; rv:121.0) Gecko/20100101 Firefox/121.0',
+             ('desktop', 'macOS', 'Firefox', False)),
+            ('Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)', ('bot', 'Other', 'Other', True)),
+            ('python-requests/2.31', ('bot', 'Other', 'Other', True)),
+            ('', ('other', 'Other', 'Other', False)),
+            (None, ('other', 'Other', 'Other', False)),
+        ]
+        for user_agent, expected in cases:
+            with self.subTest(user_agent=user_agent):
+                self.assertEqual(tuple(classify(user_agent)), expected)
+
+    def test_intern_creates_once_and_caches_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            agent_id = intern('Mozilla/5.0 (X11; Linux x86_64) Firefox/121.0')
+        agent = UserAgent.objects.get(pk=agent_id)
+        self.assertEqual((agent.device_type, agent.os, agent.browser), ('desktop', 'Linux', 'Firefox'))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(intern('Mozilla/5.0 (X11; Linux x86_64) Firefox/121.0'), agent_id)
+        self.assertEqual(intern(None), intern(''))
+        self.assertEqual(UserAgent.objects.count(), 2)
+
+    def test_created_row_is_not_cached_before_commit(self):
+        # Без коммита (откат) id не попадает в кэш - следующий вызов снова идет в БД
+        with self.captureOnCommitCallbacks(execute=False):
+            agent_id = intern('curl/8.0')
+        with self.assertNumQueries(1):
+            self.assertEqual(intern('curl/8.0'), agent_id)
+
+    def test_concurrent_insert_reuses_existing_row(self):
+        existing = UserAgent.objects.create(
+            user_agent_hash=user_agent_hash('okhttp/4.9'), user_agent='okhttp/4.9', **classify('okhttp/4.9')._asdict(),
+        )
+
+        # Параллельный запрос вставил строку между проверкой и созданием
+        with mock.patch('django.db.models.query.QuerySet.first', return_value=None):
+            self.assertEqual(intern('okhttp/4.9'), existing.pk)
+
+        self.assertEqual(UserAgent.objects.filter(user_agent='okhttp/4.9').count(), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(intern('okhttp/4.9'), existing.pk)
+
+
+class SyntheticDatasetTests(TestCase):
+    """Синтетический набор заполняет журнал, справочник User-Agent и статистику кампаний"""
+
+    SIZES = {
+        **SIZES['small'], 'users': 20, 'vendors': 2, 'categories': 2, 'products': 10, 'photos_per_product': 0,
+        'orders': 20, 'links': 10, 'visits': 300, 'reviews': 10, 'conversion_rate': 0.2, 'payout_rate': 1.0,
+        'days': 7,
+    }
+
+    def setUp(self):
+        clear_user_agent_cache()
+        self.addCleanup(clear_user_agent_cache)
+
+    def test_seed_dataset_fills_derived_tables(self):
+        counts = seed_dataset(self.SIZES, seed=7)['counts']
+
+        self.assertEqual(counts['user_agents'], len(USER_AGENTS))
+        self.assertEqual(UserAgent.objects.count(), len(USER_AGENTS))
+        self.assertEqual(set(ReferralVisit.objects.values_list('agent__device_type', flat=True)), {'desktop', 'mobile'})
+        self.assertFalse(ReferralReward.objects.filter(attributed_visit__isnull=True).exists())
+
+        events = ReferralEvent.objects
+        self.assertEqual(events.count(), counts['referral_events'])
+        self.assertEqual(events.filter(kind=ReferralEvent.CLICK).count(), counts['referral_visits'])
+        self.assertEqual(events.filter(kind=ReferralEvent.CONVERSION).count(), counts['referral_rewards'])
+        self.assertEqual(events.filter(kind=ReferralEvent.PAYOUT).count(), counts['referral_payouts'])
+
+        stats = CampaignDailyStat.objects.aggregate(clicks=Sum('clicks'), conversions=Sum('conversions'))
+        self.assertEqual(counts['campaign_daily_stats'], CampaignDailyStat.objects.count())
+        self.assertEqual(stats['clicks'], counts['referral_visits'])
+        self.assertEqual(stats['conversions'], ReferralReward.objects.exclude(status='REVERSED').count())
+
+        # Журнал согласован со счетчиками генератора: пересчет ничего не исправляет
+        RetentionCheckpoint.objects.create(job=BACKFILL_JOB, finished_at=timezone.now())
+        totals = replay_events()
+        self.assertEqual((totals['links'], totals['balances'], totals['orphans']), (0, 0, 0))
@@ -0,0 +1,236 @@
+"""
+Защита публичных реферальных эндпоинтов от ботов и повторов.
+
+KnownBotPermission отклоняет запросы с User-Agent известных ботов и HTTP-клиентов
+до любых обращений к ORM. ReferralThrottle - token bucket по трем ключам сразу:
+IP, anonymous_id и реферальный код; запрос проходит, только если токен есть во
+всех корзинах. Скорости задаются в REST_FRAMEWORK['DEFAULT_THROTTLE_RATES']
+(referral_ip, referral_anonymous, referral_code; None - без ограничения).
+
+Корзины хранятся в Redis (REDIS_URL) и списываются одним Lua-скриптом
+атомарно для всех воркеров; без Redis или при его недоступности - в памяти
+процесса. Отклоненные запросы считаются по причинам и отдаются в admin/metrics/.
+
+IP клиента определяет client_ip(): X-Forwarded-For учитывается, только если
+запрос пришел от прокси из settings.TRUSTED_PROXIES, иначе ключ - REMOTE_ADDR.
+"""
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.permissions import BasePermission
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+from .profiling import METRIC_PREFIX
+from .redis_client import RedisError, get_client
+
+logger = logging.getLogger(__name__)
+
+BOT_USER_AGENT_RE = re.compile(
+    r'bot\b|bot/|crawl|spider|slurp|scrapy|curl/|wget/|python-requests|python-urllib|aiohttp|httpx|'
+    r'go-http-client|okhttp|java/|libwww|headlesschrome|phantomjs|facebookexternalhit',
+    re.IGNORECASE,
+)
+LOCAL_MAX_KEYS = 100000
+REDIS_RETRY_SECONDS = 30  # Пауза перед повторной попыткой после ошибки Redis
+
+# KEYS - корзины, ARGV[1] - текущее время, далее пары (емкость, токенов в секунду).
+# Возвращает 0, если токен списан во всех корзинах, иначе номер первой пустой корзины.
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local tokens = {}
+for i = 1, #KEYS do
+    local capacity = tonumber(ARGV[2 * i])
+    local rate = tonumber(ARGV[2 * i + 1])
+    local state = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+    local available = tonumber(state[1]) or capacity
+    local updated = tonumber(state[2]) or now
+    available = math.min(capacity, available + math.max(0, now - updated) * rate)
+    if available < 1 then
+        return i
+    end
+    tokens[i] = available
+end
+for i = 1, #KEYS do
+    local capacity = tonumber(ARGV[2 * i])
+    local rate = tonumber(ARGV[2 * i + 1])
+    redis.call('HSET', KEYS[i], 'tokens', tokens[i] - 1, 'ts', now)
+    redis.call('EXPIRE', KEYS[i], math.ceil(capacity / rate) + 1)
+end
+return 0
+"""
+
+_rejections = Counter()
+_rejections_lock = threading.Lock()
+
+
+def count_rejection(reason):
+    with _rejections_lock:
+        _rejections[reason] += 1
+
+
+def render():
+    """Счетчики отклоненных запросов в формате Prometheus"""
+    metric = f'{METRIC_PREFIX}_referral_rejected_total'
+    lines = [
+        f'# HELP {metric} Rejected requests to public referral endpoints',
+        f'# TYPE {metric} counter',
+    ]
+    with _rejections_lock:
+        for reason, count in sorted(_rejections.items()):
+            lines.append(f'{metric}{{reason="{reason}"}} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+def parse_rate(rate):
+    """'120/min' -> (емкость 120, токенов в секунду 2.0); None - без ограничения"""
+    if rate is None:
+        return None
+    count, period = rate.split('/')
+    seconds = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[period[0]]
+    return int(count), int(count) / seconds
+
+
+class LocalBuckets:
+    """Корзины в памяти процесса (LRU по ключам)"""
+
+    def __init__(self, max_keys=LOCAL_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, limits, now):
+        with self._lock:
+            tokens = []
+            for index, (key, capacity, rate) in enumerate(limits, start=1):
+                available, updated = self._buckets.get(key, (capacity, now))
+                available = min(capacity, available + max(0.0, now - updated) * rate)
+                if available < 1:
+                    return index
+                tokens.append(available)
+            for (key, _, _), available in zip(limits, tokens):
+                self._buckets[key] = (available - 1, now)
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return 0
+
+
+class RedisBuckets:
+    """Корзины в Redis; при ошибке Redis временно переключается на LocalBuckets"""
+
+    def __init__(self, client, fallback):
+        self.client = client
+        self.script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+        self.fallback = fallback
+        self.retry_at = 0.0
+
+    def consume(self, limits, now):
+        if now >= self.retry_at:
+            args = [now]
+            for _, capacity, rate in limits:
+                args.extend([capacity, rate])
+            try:
+                return int(self.script(keys=[key for key, _, _ in limits], args=args))
+            except RedisError as e:
+                logger.warning(f'Redis throttling unavailable, using in-process buckets: {e}')
+                self.retry_at = now + REDIS_RETRY_SECONDS
+        return self.fallback.consume(limits, now)
+
+
+_buckets = None
+_buckets_lock = threading.Lock()
+
+
+def get_buckets():
+    global _buckets
+    with _buckets_lock:
+        if _buckets is None:
+            local = LocalBuckets()
+            client = get_client()
+            _buckets = RedisBuckets(client, local) if client is not None else local
+        return _buckets
+
+
+def _digest(value):
+    # Значения приходят от клиента - в ключ попадает только хэш ограниченной длины
+    return hashlib.sha1(str(value).encode()).hexdigest()
+
+
+def _request_value(request, name):
+    data = getattr(request, 'data', None)
+    value = data.get(name) if hasattr(data, 'get') else None
+    return value if isinstance(value, str) else None
+
+
+def client_ip(request):
+    """
+    IP клиента: цепочка X-Forwarded-For разбирается справа налево, пока адреса
+    принадлежат доверенным прокси; без доверенного прокси - REMOTE_ADDR
+    """
+    remote_addr = request.META.get('REMOTE_ADDR', '')
+    trusted = set(settings.TRUSTED_PROXIES)
+    if remote_addr not in trusted:
+        return remote_addr
+    forwarded = [addr.strip() for addr in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')]
+    for addr in reversed(forwarded):
+        if addr and addr not in trusted:
+            return addr
+    return remote_addr
+
+
+class KnownBotPermission(BasePermission):
+    """Отклоняет известных ботов и HTTP-клиенты по User-Agent (заголовок и поле user_agent)"""
+    message = 'Automated traffic is not accepted'
+
+    def has_permission(self, request, view):
+        for user_agent in (request.META.get('HTTP_USER_AGENT', ''), _request_value(request, 'user_agent')):
+            if user_agent and BOT_USER_AGENT_RE.search(user_agent):
+                count_rejection('bot')
+                # 403 вместо 401 от DRF для анонимных запросов: авторизация боту не поможет
+                raise PermissionDenied(self.message)
+        return True
+
+
+class ReferralThrottle(BaseThrottle):
+    """Token bucket по IP, anonymous_id и реферальному коду"""
+
+    def __init__(self):
+        self.wait_seconds = None
+
+    def identities(self, request):
+        anonymous_id = _request_value(request, 'anonymous_id') or request.COOKIES.get('anonymous_id')
+        return {
+            'ip': client_ip(request),
+            'anonymous': anonymous_id,
+            'code': _request_value(request, 'referral_code'),
+        }
+
+    def allow_request(self, request, view):
+        rates = api_settings.DEFAULT_THROTTLE_RATES
+        limits = []
+        scopes = []
+        for scope, ident in self.identities(request).items():
+            rate = parse_rate(rates.get(f'referral_{scope}'))
+            if rate is None or not ident:
+                continue
+            limits.append((f'throttle:referral:{scope}:{_digest(ident)}', *rate))
+            scopes.append(scope)
+        if not limits:
+            return True
+        rejected = get_buckets().consume(limits, time.time())
+        if not rejected:
+            return True
+        _, _, rate = limits[rejected - 1]
+        self.wait_seconds = 1 / rate
+        count_rejection(f'throttled_{scopes[rejected - 1]}')
+        return False
+
+    def wait(self):
+        return self.wait_seconds
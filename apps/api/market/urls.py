@@ -1,5 +1,5 @@
 from django.urls import path, include
-from . import views
+from . import views, export_views, product_views, analytics_views
 
 urlpatterns = [
     # Реферальная программа
@@ -24,6 +24,7 @@ urlpatterns = [
     path('referral-payouts/', views.ReferralPayoutListCreateView.as_view(), name='referral-payout-list-create'),
     path('referral-payouts/<int:pk>/', views.ReferralPayoutDetailView.as_view(), name='referral-payout-detail'),
     path('referral-payouts/request/', views.request_payout, name='request-payout'),
+    path('referral-payouts/settle/', views.settle_referral_payouts, name='settle-referral-payouts'),
     path('referral-payouts/<int:pk>/approve/', views.approve_payout, name='approve-payout'),
     path('referral-payouts/<int:pk>/reject/', views.reject_payout, name='reject-payout'),
     
@@ -50,11 +51,18 @@ urlpatterns = [
     path('admin/withdrawals/', views.AdminWithdrawalListView.as_view(), name='admin-withdrawal-list'),
     path('admin/withdrawals/<int:pk>/', views.AdminWithdrawalDetailView.as_view(), name='admin-withdrawal-detail'),
     path('admin/dashboard/', views.admin_dashboard, name='admin-dashboard'),
+    path('admin/metrics/', views.admin_metrics, name='admin-metrics'),
+    path('admin/exports/<slug:dataset>/', export_views.admin_export, name='admin-export'),
+    path('admin/analytics/query/', analytics_views.admin_analytics_query, name='admin-analytics-query'),
+    path('admin/analytics/campaigns/', analytics_views.campaign_performance, name='admin-campaign-performance'),
     
     # Product Management - только для админов
     path('products/', views.ProductListCreateView.as_view(), name='product-list'),
     path('products/<int:pk>/', views.ProductDetailView.as_view(), name='product-detail'),
     path('products/featured/', views.FeaturedProductsView.as_view(), name='featured-products'),
+    path('products/bestsellers/', views.BestsellerProductsView.as_view(), name='bestseller-products'),
+    path('vendor/catalog/import/', product_views.vendor_catalog_import, name='vendor-catalog-import'),
+    path('vendor/catalog/export/', product_views.vendor_catalog_export, name='vendor-catalog-export'),
     
     # Product Images - только для админов
     path('product-images/', views.ProductImageListCreateView.as_view(), name='product-image-list-create'),
@@ -0,0 +1,121 @@
+"""
+Справочник User-Agent: строка хранится один раз в UserAgent, посещения ссылаются на id.
+
+classify() разбирает строку регулярными выражениями в (тип устройства, ОС,
+браузер, бот) и мемоизирован LRU-кэшем - разбор выполняется один раз на
+различный User-Agent. intern() возвращает id строки справочника: сначала из
+кэша процесса (по хэшу строки), затем из БД, при отсутствии - создает строку
+с классификацией. Строки справочника не удаляются, поэтому id в кэше не устаревают;
+созданная строка попадает в кэш только после коммита транзакции.
+"""
+import hashlib
+import re
+import threading
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+
+from django.db import IntegrityError, transaction
+
+from .models import UserAgent
+from .throttling import BOT_USER_AGENT_RE
+
+CLASSIFY_CACHE_SIZE = 4096
+INTERN_CACHE_SIZE = 10000
+
+Classification = namedtuple('Classification', 'device_type os browser is_bot')
+
+TABLET_RE = re.compile(r'ipad|tablet|kindle|silk/|playbook|android(?!.*mobile)', re.IGNORECASE)
+MOBILE_RE = re.compile(r'mobi|iphone|ipod|android|windows phone|blackberry|opera mini', re.IGNORECASE)
+# Порядок важен: Edge и Opera содержат "Chrome", Chrome содержит "Safari"
+OS_PATTERNS = [
+    ('Windows', re.compile(r'windows', re.IGNORECASE)),
+    ('iOS', re.compile(r'iphone|ipad|ipod', re.IGNORECASE)),
+    ('Android', re.compile(r'android', re.IGNORECASE)),
+    ('macOS', re.compile(r'mac os x|macintosh', re.IGNORECASE)),
+    ('ChromeOS', re.compile(r'cros', re.IGNORECASE)),
+    ('Linux', re.compile(r'linux', re.IGNORECASE)),
+]
+BROWSER_PATTERNS = [
+    ('Edge', re.compile(r'edg(e|a|ios)?/', re.IGNORECASE)),
+    ('Opera', re.compile(r'opr/|opera', re.IGNORECASE)),
+    ('Yandex', re.compile(r'yabrowser', re.IGNORECASE)),
+    ('Samsung Internet', re.compile(r'samsungbrowser', re.IGNORECASE)),
+    ('Firefox', re.compile(r'firefox|fxios', re.IGNORECASE)),
+    ('Chrome', re.compile(r'chrome|crios', re.IGNORECASE)),
+    ('Safari', re.compile(r'safari', re.IGNORECASE)),
+]
+
+
+def _match(patterns, user_agent):
+    for name, pattern in patterns:
+        if pattern.search(user_agent):
+            return name
+    return 'Other'
+
+
+@lru_cache(maxsize=CLASSIFY_CACHE_SIZE)
+def classify(user_agent):
+    """User-Agent -> Classification; результат кэшируется по строке"""
+    user_agent = user_agent or ''
+    is_bot = bool(BOT_USER_AGENT_RE.search(user_agent))
+    if is_bot:
+        device_type = UserAgent.BOT
+    elif TABLET_RE.search(user_agent):
+        device_type = UserAgent.TABLET
+    elif MOBILE_RE.search(user_agent):
+        device_type = UserAgent.MOBILE
+    elif user_agent:
+        device_type = UserAgent.DESKTOP
+    else:
+        device_type = UserAgent.OTHER
+    return Classification(device_type, _match(OS_PATTERNS, user_agent), _match(BROWSER_PATTERNS, user_agent), is_bot)
+
+
+def user_agent_hash(user_agent):
+    return hashlib.sha256(user_agent.encode()).hexdigest()
+
+
+_interned = OrderedDict()  # хэш строки -> id UserAgent
+_lock = threading.Lock()
+
+
+def intern(user_agent):
+    """id строки справочника для User-Agent (создается при первом появлении)"""
+    user_agent = user_agent or ''
+    key = user_agent_hash(user_agent)
+    with _lock:
+        agent_id = _interned.get(key)
+        if agent_id is not None:
+            _interned.move_to_end(key)
+            return agent_id
+
+    agent_id = UserAgent.objects.filter(user_agent_hash=key).values_list('pk', flat=True).first()
+    if agent_id is not None:
+        _remember(key, agent_id)
+        return agent_id
+    try:
+        with transaction.atomic():
+            agent_id = UserAgent.objects.create(
+                user_agent_hash=key, user_agent=user_agent, **classify(user_agent)._asdict()
+            ).pk
+    except IntegrityError:
+        # Строку успел создать параллельный запрос
+        agent_id = UserAgent.objects.values_list('pk', flat=True).get(user_agent_hash=key)
+        _remember(key, agent_id)
+        return agent_id
+    # При откате транзакции строки не будет - в кэш только после коммита
+    transaction.on_commit(lambda: _remember(key, agent_id))
+    return agent_id
+
+
+def _remember(key, agent_id):
+    with _lock:
+        _interned[key] = agent_id
+        if len(_interned) > INTERN_CACHE_SIZE:
+            _interned.popitem(last=False)
+
+
+def clear_cache():
+    with _lock:
+        _interned.clear()
+    classify.cache_clear()
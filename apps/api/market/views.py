@@ -1,17 +1,20 @@
 from rest_framework import generics, status, permissions
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, throttle_classes
 from rest_framework.response import Response
+from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
-from django.db.models import Sum
+from django.db.models import Count, F, Sum
+from collections import defaultdict
 from datetime import timedelta
+from decimal import Decimal, InvalidOperation
 import logging
 import time
 
 from .models import (
     ReferralProgram, ReferralLink, ReferralVisit, ReferralAttribution,
     ReferralReward, ReferralPayout, ReferralBalance, User, Product,
-    Category, Order, WithdrawalRequest, ProductImage, Review
+    Category, Order, WithdrawalRequest, ProductImage, Review, PayoutSettlementRun
 )
 from .serializers import (
     ReferralProgramSerializer, ReferralLinkSerializer, ReferralLinkCreateSerializer,
@@ -20,7 +23,21 @@ from .serializers import (
     ProductSerializer, ProductCreateSerializer, CategorySerializer, OrderSerializer, OrderCreateSerializer,
     WithdrawalRequestSerializer, UserSerializer, ProductImageSerializer, ProductImageCreateSerializer, ReviewSerializer, ReviewCreateSerializer
 )
-from .referral_utils import generate_referral_code
+from .ranking import trending_products, bestseller_products
+from . import profiling
+from .settlement import settle_payouts
+from .visitor_sketches import record_visit, unique_visitors
+from .link_resolver import resolve_referral_code
+from .throttling import KnownBotPermission, ReferralThrottle, client_ip
+from . import throttling
+from .click_dedup import is_repeat_click
+from .attribution import record_attributions
+from .identity import schedule_identity_stitch
+from .referral_utils import read_anonymous_id
+from .referral_events import log_click
+from .campaigns import record_click as record_campaign_click
+from .user_agents import intern as intern_user_agent
+from . import click_dedup
 
 logger = logging.getLogger(__name__)
 
@@ -77,58 +94,9 @@ class ReferralLinkStatsView(generics.RetrieveAPIView):
         return ReferralLink.objects.filter(user=self.request.user)
 
 
-# Visit Tracking (public endpoint)
 @api_view(['POST'])
-@permission_classes([permissions.AllowAny])
-def track_referral_visit(request):
-    """Отслеживание перехода по реферальной ссылке"""
-    try:
-        referral_code = request.data.get('referral_code')
-        anonymous_id = request.data.get('anonymous_id')
-        ip_address = request.META.get('REMOTE_ADDR')
-        user_agent = request.META.get('HTTP_USER_AGENT', '')
-
-        if not referral_code or not anonymous_id:
-            return Response(
-                {'error': 'referral_code и anonymous_id обязательны'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-
-        try:
-            referral_link = ReferralLink.objects.get(code=referral_code, is_active=True)
-        except ReferralLink.DoesNotExist:
-            return Response(
-                {'error': 'Реферальная ссылка не найдена'},
-                status=status.HTTP_404_NOT_FOUND
-            )
-
-        # Создаем запись о переходе
-        visit = ReferralVisit.objects.create(
-            referral_link=referral_link,
-            anonymous_id=anonymous_id,
-            ip_address=ip_address,
-            user_agent=user_agent
-        )
-
-        referral_link.total_clicks += 1
-        referral_link.save()
-
-        return Response({
-            'success': True,
-            'message': 'Переход успешно отслежен',
-            'visit_id': visit.id
-        }, status=status.HTTP_201_CREATED)
-
-    except Exception as e:
-        logger.error(f'Error tracking visit: {str(e)}')
-        return Response(
-            {'error': 'Ошибка при отслеживании перехода'},
-            status=status.HTTP_500_INTERNAL_SERVER_ERROR
-        )
-
-
-@api_view(['POST'])
-@permission_classes([permissions.AllowAny])
+@permission_classes([permissions.AllowAny, KnownBotPermission])
+@throttle_classes([ReferralThrottle])
 def track_referral_conversion(request):
     """Отслеживание конверсии по реферальной ссылке"""
     try:
@@ -144,9 +112,12 @@ def track_referral_conversion(request):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        try:
-            referral_link = ReferralLink.objects.get(code=referral_code, is_active=True)
-        except ReferralLink.DoesNotExist:
+        # Неизвестные и неактивные коды отсекаются кэшем без запроса к БД
+        resolved = resolve_referral_code(referral_code)
+        referral_link = None
+        if resolved is not None and resolved.is_active:
+            referral_link = ReferralLink.objects.filter(pk=resolved.link_id).first()
+        if referral_link is None:
             return Response(
                 {'error': 'Реферальная ссылка не найдена'},
                 status=status.HTTP_404_NOT_FOUND
@@ -218,7 +189,8 @@ class ReferralRewardUpdateView(generics.UpdateAPIView):
 
 
 @api_view(['POST'])
-@permission_classes([permissions.AllowAny])
+@permission_classes([permissions.AllowAny, KnownBotPermission])
+@throttle_classes([ReferralThrottle])
 def process_referral_purchase(request):
     """Обработка покупки по реферальной ссылке"""
     try:
@@ -234,9 +206,12 @@ def process_referral_purchase(request):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        try:
-            referral_link = ReferralLink.objects.get(code=referral_code, is_active=True)
-        except ReferralLink.DoesNotExist:
+        # Неизвестные и неактивные коды отсекаются кэшем без запроса к БД
+        resolved = resolve_referral_code(referral_code)
+        referral_link = None
+        if resolved is not None and resolved.is_active:
+            referral_link = ReferralLink.objects.filter(pk=resolved.link_id).first()
+        if referral_link is None:
             return Response(
                 {'error': 'Реферальная ссылка не найдена'},
                 status=status.HTTP_404_NOT_FOUND
@@ -341,11 +316,17 @@ class ReferralPayoutDetailView(generics.RetrieveUpdateDestroyAPIView):
 def request_payout(request):
     """Запрос на выплату реферальных вознаграждений"""
     try:
-        amount = request.data.get('amount')
-        payment_method = request.data.get('payment_method', 'bank_transfer')
-        account_details = request.data.get('account_details', '')
+        payment_method = request.data.get('payment_method', 'BANK_TRANSFER')
+        # payment_details - JSON с реквизитами; старый клиент присылает строку account_details
+        payment_details = request.data.get('payment_details')
+        if payment_details is None:
+            payment_details = {'details': request.data.get('account_details', '')}
 
-        if not amount or float(amount) <= 0:
+        try:
+            amount = Decimal(str(request.data.get('amount')))
+        except InvalidOperation:
+            amount = None
+        if amount is None or not amount.is_finite() or amount <= 0:
             return Response(
                 {'error': 'Сумма должна быть больше 0'},
                 status=status.HTTP_400_BAD_REQUEST
@@ -353,7 +334,7 @@ def request_payout(request):
 
         try:
             balance = ReferralBalance.objects.get(user=request.user)
-            if balance.available_balance < float(amount):
+            if balance.available_amount < amount:
                 return Response(
                     {'error': 'Недостаточно средств на балансе'},
                     status=status.HTTP_400_BAD_REQUEST
@@ -368,8 +349,8 @@ def request_payout(request):
             user=request.user,
             amount=amount,
             payment_method=payment_method,
-            account_details=account_details,
-            status='pending'
+            payment_details=payment_details,
+            status='PENDING'
         )
 
         return Response({
@@ -399,21 +380,18 @@ def approve_payout(request, pk):
 
         payout = get_object_or_404(ReferralPayout, pk=pk)
 
-        if payout.status != 'pending':
+        if payout.status != 'PENDING':
             return Response(
                 {'error': 'Выплата уже обработана'},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        payout.status = 'approved'
-        payout.processed_by = request.user
-        payout.processed_at = timezone.now()
-        payout.save()
-
-        balance = ReferralBalance.objects.get(user=payout.user)
-        balance.available_balance -= payout.amount
-        balance.paid_balance += payout.amount
-        balance.save()
+        run = settle_payouts(f'payout-{payout.pk}-{int(time.time())}', processed_by=request.user, payout_ids=[payout.pk])
+        if not run.payouts_count:
+            return Response(
+                {'error': 'Недостаточно одобренных вознаграждений для выплаты'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
         return Response({
             'success': True,
@@ -428,6 +406,52 @@ def approve_payout(request, pk):
         )
 
 
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def settle_referral_payouts(request):
+    """Пакетная выплата всех ожидающих выплат (только для админов)"""
+    try:
+        if request.user.role != 'superadmin':
+            return Response(
+                {'error': 'Недостаточно прав'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        run_id = request.data.get('run_id')
+        if not run_id:
+            return Response(
+                {'error': 'run_id обязателен'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        run_id = str(run_id)
+        max_length = PayoutSettlementRun._meta.get_field('run_id').max_length
+        if len(run_id) > max_length:
+            return Response(
+                {'error': f'run_id должен быть не длиннее {max_length} символов'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        run = settle_payouts(run_id, processed_by=request.user)
+
+        return Response({
+            'success': True,
+            'run_id': run.run_id,
+            'payouts_count': run.payouts_count,
+            'skipped_count': run.skipped_count,
+            'rewards_count': run.rewards_count,
+            'total_amount': float(run.total_amount),
+            'completed_at': run.completed_at
+        }, status=status.HTTP_200_OK)
+
+    except Exception as e:
+        logger.error(f'Error settling payouts: {str(e)}')
+        return Response(
+            {'error': 'Ошибка при пакетной выплате'},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
 def reject_payout(request, pk):
@@ -500,6 +524,8 @@ def referral_stats(request):
         total_links = ReferralLink.objects.count()
         active_links = ReferralLink.objects.filter(is_active=True).count()
         total_clicks = ReferralVisit.objects.count()
+        # Повторные клики, не записанные как посещения (сэкономленные вставки)
+        repeat_clicks = ReferralLink.objects.aggregate(total=Sum('repeat_clicks'))['total'] or 0
         total_conversions = ReferralAttribution.objects.filter(converted=True).count()
         total_rewards = ReferralReward.objects.aggregate(
             total=Sum('amount')
@@ -511,6 +537,7 @@ def referral_stats(request):
             'total_links': total_links,
             'active_links': active_links,
             'total_clicks': total_clicks,
+            'repeat_clicks': repeat_clicks,
             'total_conversions': total_conversions,
             'total_rewards': float(total_rewards),
             'conversion_rate': conversion_rate
@@ -535,6 +562,7 @@ def user_referral_stats(request):
         total_links = 0
         active_links = 0
         total_clicks = 0
+        repeat_clicks = 0
         total_conversions = 0
         total_rewards = 0.0
         conversion_rate = 0.0
@@ -549,6 +577,7 @@ def user_referral_stats(request):
             referral_links = ReferralLink.objects.filter(user=user)
             total_links = referral_links.count()
             active_links = referral_links.filter(is_active=True).count()
+            repeat_clicks = referral_links.aggregate(total=Sum('repeat_clicks'))['total'] or 0
         except Exception:
             pass
 
@@ -583,6 +612,7 @@ def user_referral_stats(request):
             'total_links': total_links,
             'active_links': active_links,
             'total_clicks': total_clicks,
+            'repeat_clicks': repeat_clicks,
             'total_conversions': total_conversions,
             'total_rewards': total_rewards,
             'conversion_rate': conversion_rate,
@@ -622,99 +652,82 @@ def referral_analytics(request):
         start_date = timezone.now() - timedelta(days=days)
 
         visits = ReferralVisit.objects.filter(visited_at__gte=start_date)
-        attributions = ReferralAttribution.objects.filter(created_at__gte=start_date, converted=True)
-        rewards = ReferralReward.objects.filter(created_at__gte=start_date)
+        # Конверсия - вознаграждение за покупку; отмененные (REVERSED) не учитываются
+        rewards = ReferralReward.objects.filter(created_at__gte=start_date).exclude(status='REVERSED')
 
         total_clicks = visits.count()
-        total_conversions = attributions.count()
+        totals = rewards.aggregate(conversions=Count('id'), revenue=Sum('order_amount'), commission=Sum('reward_amount'))
+        total_conversions = totals['conversions']
         conversion_rate = (total_conversions / total_clicks * 100) if total_clicks > 0 else 0
-        total_revenue = sum([float(attr.conversion_amount or 0) for attr in attributions])
-        total_commission = sum([float(reward.amount) for reward in rewards])
+        total_revenue = float(totals['revenue'] or 0)
+        total_commission = float(totals['commission'] or 0)
         avg_order_value = total_revenue / total_conversions if total_conversions > 0 else 0
 
+        # По локальной дате (колонка local_date): один запрос на таблицу вместо трех на каждый день.
+        # Последние days локальных дней, включая сегодняшний
+        first_day = timezone.localdate() - timedelta(days=days - 1)
+        clicks_by_day = dict(
+            visits.values('local_date').annotate(clicks=Count('id')).values_list('local_date', 'clicks')
+        )
+        rewards_by_day = {
+            row['local_date']: row
+            for row in rewards.values('local_date').annotate(
+                conversions=Count('id'), revenue=Sum('order_amount'), commission=Sum('reward_amount'),
+            )
+        }
+
         daily_stats = []
         for i in range(days):
-            date = start_date + timedelta(days=i)
-            day_visits = visits.filter(visited_at__date=date.date())
-            day_attributions = attributions.filter(created_at__date=date.date())
-            day_rewards = rewards.filter(created_at__date=date.date())
-
+            day = first_day + timedelta(days=i)
+            day_rewards = rewards_by_day.get(day, {})
             daily_stats.append({
-                'date': date.date().isoformat(),
-                'clicks': day_visits.count(),
-                'conversions': day_attributions.count(),
-                'revenue': sum([float(attr.conversion_amount or 0) for attr in day_attributions]),
-                'commission': sum([float(reward.amount) for reward in day_rewards])
+                'date': day.isoformat(),
+                'clicks': clicks_by_day.get(day, 0),
+                'conversions': day_rewards.get('conversions', 0),
+                'revenue': float(day_rewards.get('revenue') or 0),
+                'commission': float(day_rewards.get('commission') or 0)
             })
 
-        product_stats = {}
-        for attr in attributions:
-            if attr.product:
-                if attr.product.id not in product_stats:
-                    product_stats[attr.product.id] = {
-                        'id': attr.product.id,
-                        'title': attr.product.title,
-                        'clicks': 0,
-                        'conversions': 0,
-                        'revenue': 0,
-                        'commission': 0
-                    }
-                product_stats[attr.product.id]['conversions'] += 1
-                product_stats[attr.product.id]['revenue'] += float(attr.conversion_amount or 0)
-
-        for visit in visits:
-            if visit.referral_link.product:
-                product_id = visit.referral_link.product.id
-                if product_id in product_stats:
-                    product_stats[product_id]['clicks'] += 1
-
-        for reward in rewards:
-            if reward.product and reward.product.id in product_stats:
-                product_stats[reward.product.id]['commission'] += float(reward.amount)
-
-        top_products = sorted(
-            product_stats.values(),
-            key=lambda x: x['conversions'],
-            reverse=True
-        )[:10]
-
+        # Товары и рефереры: агрегаты вознаграждений плюс клики по ссылкам товара / реферера
+        product_clicks = dict(
+            visits.filter(referral_link__product__isnull=False).values('referral_link__product')
+            .annotate(clicks=Count('id')).values_list('referral_link__product', 'clicks')
+        )
+        top_products = [
+            {
+                'id': row['product'],
+                'title': row['product__title'],
+                'clicks': product_clicks.get(row['product'], 0),
+                'conversions': row['conversions'],
+                'revenue': float(row['revenue'] or 0),
+                'commission': float(row['commission'] or 0),
+            }
+            for row in rewards.values('product', 'product__title').annotate(
+                conversions=Count('id'), revenue=Sum('order_amount'), commission=Sum('reward_amount'),
+            ).order_by('-conversions', 'product')[:10]
+        ]
         for product in top_products:
             product['conversion_rate'] = (product['conversions'] / product['clicks'] * 100) if product['clicks'] > 0 else 0
 
-        referrer_stats = {}
-        for attr in attributions:
-            if attr.referral_link.user:
-                user_id = attr.referral_link.user.id
-                if user_id not in referrer_stats:
-                    referrer_stats[user_id] = {
-                        'id': user_id,
-                        'username': attr.referral_link.user.username,
-                        'clicks': 0,
-                        'conversions': 0,
-                        'revenue': 0,
-                        'commission': 0
-                    }
-                referrer_stats[user_id]['conversions'] += 1
-                referrer_stats[user_id]['revenue'] += float(attr.conversion_amount or 0)
-
-        for visit in visits:
-            if visit.referral_link.user:
-                user_id = visit.referral_link.user.id
-                if user_id in referrer_stats:
-                    referrer_stats[user_id]['clicks'] += 1
-
-        for reward in rewards:
-            if reward.user and reward.user.id in referrer_stats:
-                referrer_stats[reward.user.id]['commission'] += float(reward.amount)
-
-        top_referrers = sorted(
-            referrer_stats.values(),
-            key=lambda x: x['conversions'],
-            reverse=True
-        )[:10]
+        referrer_clicks = dict(
+            visits.values('referral_link__user').annotate(clicks=Count('id')).values_list('referral_link__user', 'clicks')
+        )
+        top_referrers = [
+            {
+                'id': row['attributed_user'],
+                'username': row['attributed_user__username'],
+                'clicks': referrer_clicks.get(row['attributed_user'], 0),
+                'conversions': row['conversions'],
+                'revenue': float(row['revenue'] or 0),
+                'commission': float(row['commission'] or 0),
+            }
+            for row in rewards.values('attributed_user', 'attributed_user__username').annotate(
+                conversions=Count('id'), revenue=Sum('order_amount'), commission=Sum('reward_amount'),
+            ).order_by('-conversions', 'attributed_user')[:10]
+        ]
 
         conversion_funnel = {
-            'visitors': visits.values('anonymous_id').distinct().count(),
+            'visitors': unique_visitors(timezone.localdate(start_date), timezone.localdate()),
             'clicks': total_clicks,
             'conversions': total_conversions,
             'revenue': total_revenue
@@ -809,6 +822,16 @@ def admin_dashboard(request):
         )
 
 
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def admin_metrics(request):
+    """Гистограммы профилирования и счетчики отклоненного трафика текущего воркера в формате Prometheus (только для админов)"""
+    if request.user.role != 'superadmin':
+        return Response({'error': 'Недостаточно прав'}, status=status.HTTP_403_FORBIDDEN)
+    body = profiling.registry.render() + throttling.render() + click_dedup.render()
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 # Admin User Management
 class AdminUserListView(generics.ListAPIView):
     serializer_class = UserSerializer
@@ -995,12 +1018,26 @@ class AdminReferralPayoutUpdateView(generics.UpdateAPIView):
 
 
 # Product Management
+# Допустимые значения ?ordering= для каталога
+PRODUCT_LIST_ORDERING = {
+    'rating': ['-rating_average', '-rating_count'],
+    'reviews': ['-rating_count'],
+    'price': ['price_uzs'],
+    '-price': ['-price_uzs'],
+    'newest': ['-created_at'],
+}
+
+
 class ProductListCreateView(generics.ListCreateAPIView):
     serializer_class = ProductSerializer
     permission_classes = [permissions.AllowAny]  # Public access for reading
 
     def get_queryset(self):
-        return Product.objects.filter(is_active=True)
+        queryset = Product.objects.filter(is_active=True)
+        ordering = PRODUCT_LIST_ORDERING.get(self.request.query_params.get('ordering'))
+        if ordering:
+            queryset = queryset.order_by(*ordering)
+        return queryset
 
     def get_serializer_class(self):
         if self.request.method == 'POST':
@@ -1038,7 +1075,7 @@ class FeaturedProductsView(generics.ListAPIView):
     permission_classes = [permissions.AllowAny]
 
     def get_queryset(self):
-        return Product.objects.filter(is_active=True).order_by('-total_sales')[:8]
+        return trending_products(limit=8)
     
     def get_serializer_context(self):
         context = super().get_serializer_context()
@@ -1046,6 +1083,21 @@ class FeaturedProductsView(generics.ListAPIView):
         return context
 
 
+class BestsellerProductsView(generics.ListAPIView):
+    serializer_class = ProductSerializer
+    permission_classes = [permissions.AllowAny]
+
+    def list(self, request, *args, **kwargs):
+        try:
+            self.limit = max(1, min(int(request.query_params.get('limit', 20)), 100))
+        except ValueError:
+            return Response({'error': 'limit должен быть целым числом'}, status=status.HTTP_400_BAD_REQUEST)
+        return super().list(request, *args, **kwargs)
+
+    def get_queryset(self):
+        return bestseller_products(limit=self.limit)
+
+
 # API endpoint для добавления дефолтных фотографий
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
@@ -1142,6 +1194,8 @@ def login_view(request):
             status=status.HTTP_401_UNAUTHORIZED
         )
 
+    _stitch_visitor(request, user)
+
     refresh = RefreshToken.for_user(user)
     access_token = str(refresh.access_token)
 
@@ -1154,6 +1208,17 @@ def login_view(request):
     }, status=status.HTTP_200_OK)
 
 
+def _stitch_visitor(request, user):
+    """Переносит историю анонимного посетителя на пользователя"""
+    # Только anonymous_id из подписанной cookie: значение из тела запроса подставляется клиентом
+    anonymous_id = read_anonymous_id(request)
+    try:
+        schedule_identity_stitch(anonymous_id, user.id)
+    except Exception as e:
+        # Склейка не должна мешать входу
+        logger.error(f'Error stitching visitor {anonymous_id} to user {user.id}: {str(e)}')
+
+
 @api_view(['POST'])
 @permission_classes([permissions.AllowAny])
 def register_view(request):
@@ -1210,6 +1275,8 @@ def register_view(request):
         if referral_code:
             pass  # TODO: Add referral code processing logic
 
+        _stitch_visitor(request, user)
+
         refresh = RefreshToken.for_user(user)
         access_token = str(refresh.access_token)
 
@@ -1555,7 +1622,6 @@ def create_referral_link(request):
         referral_link, created = ReferralLink.objects.get_or_create(
             user=request.user,
             product=product,
-            defaults={'code': generate_referral_code()}
         )
         
         if not created:
@@ -1580,7 +1646,8 @@ def create_referral_link(request):
 
 
 @api_view(['POST'])
-@permission_classes([permissions.AllowAny])
+@permission_classes([permissions.AllowAny, KnownBotPermission])
+@throttle_classes([ReferralThrottle])
 def track_referral_visit(request):
     """Track a referral visit"""
     try:
@@ -1604,24 +1671,42 @@ def track_referral_visit(request):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Получаем IP адрес
-        ip_address = request.META.get('HTTP_X_FORWARDED_FOR', request.META.get('REMOTE_ADDR', ''))
+        # anonymous_id от клиента попадает в ключи и записи - проверяем до любых записей
+        client_anonymous_id = request.data.get('anonymous_id')
+        max_length = ReferralVisit._meta.get_field('anonymous_id').max_length
+        if client_anonymous_id is not None and (
+            not isinstance(client_anonymous_id, str) or len(client_anonymous_id) > max_length
+        ):
+            return Response(
+                {'error': f'anonymous_id must be a string of at most {max_length} characters'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
-        # Ищем реферальную ссылку
-        try:
-            referral_link = ReferralLink.objects.get(code=referral_code)
-        except ReferralLink.DoesNotExist:
+        # IP адрес клиента (X-Forwarded-For - только от доверенного прокси)
+        ip_address = client_ip(request)
+
+        # Ищем реферальную ссылку (кэш кодов, без запроса к БД)
+        referral_link = resolve_referral_code(referral_code)
+        if referral_link is None:
             return Response(
                 {'error': 'Referral link not found'},
                 status=status.HTTP_404_NOT_FOUND
             )
 
+        # ID посетителя от клиента (тело запроса или cookie); без него - по IP, чтобы повторы распознавались
+        anonymous_id = client_anonymous_id or read_anonymous_id(request) or f"anon_{ip_address}"
+
+        # Повторный клик того же посетителя в текущем окне - только счетчик, без новой записи
+        if is_repeat_click(anonymous_id, referral_link.link_id):
+            ReferralLink.objects.filter(pk=referral_link.link_id).update(repeat_clicks=F('repeat_clicks') + 1)
+            return Response({'success': True, 'duplicate': True}, status=status.HTTP_200_OK)
+
         # Создаем запись о посещении с UTM метками
         visit = ReferralVisit.objects.create(
-            referral_link=referral_link,
-            anonymous_id=f"anon_{ip_address}_{int(time.time())}",  # Временный ID для анонимного пользователя
+            referral_link_id=referral_link.link_id,
+            anonymous_id=anonymous_id,
             ip_address=ip_address,
-            user_agent=user_agent,
+            agent_id=intern_user_agent(user_agent),
             page_url=page_url,
             product_id=product_id,
             utm_source=utm_source,
@@ -1630,10 +1715,18 @@ def track_referral_visit(request):
             utm_term=utm_term,
             utm_content=utm_content
         )
+        record_visit(visit)
+        record_campaign_click(visit)
+
+        # Атрибуция последнего клика для покупки товара ссылки (или товара со страницы)
+        attributions = record_attributions([(
+            visit, referral_link.product_id or visit.product_id,
+            request.user.id if request.user.is_authenticated else None,
+        )])
+        log_click(visit, referral_link.user_id, attributions)
 
         # Обновляем статистику реферальной ссылки
-        referral_link.total_clicks += 1
-        referral_link.save(update_fields=['total_clicks'])
+        ReferralLink.objects.filter(pk=referral_link.link_id).update(total_clicks=F('total_clicks') + 1)
 
         logger.info(f'Referral visit tracked: {referral_code} -> {product_id} (UTM: {utm_source}/{utm_medium}/{utm_campaign})')
 
@@ -0,0 +1,105 @@
+"""
+Уникальные посетители реферальных ссылок по HyperLogLog-скетчам.
+
+При каждом посещении обновляется скетч ссылки за локальный день. Общего
+скетча по всем ссылкам нет: его строка блокировалась бы каждым кликом.
+Количество уникальных посетителей за любой диапазон дней, по набору ссылок,
+по рефереру или по всем ссылкам считается слиянием скетчей ссылок при чтении,
+без прохода по ReferralVisit.
+"""
+from datetime import datetime, time as dt_time, timedelta
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import hll
+from .models import ReferralVisit, ReferralVisitSketch
+
+
+def _add_to_sketch(day, link_id, index, rank):
+    """Поднимает регистр index до rank в скетче (day, link_id), создавая скетч при необходимости"""
+    with transaction.atomic():
+        sketch = (
+            ReferralVisitSketch.objects.select_for_update()
+            .filter(day=day, referral_link_id=link_id)
+            .first()
+        )
+        if sketch is None:
+            registers = hll.empty()
+            registers[index] = rank
+            try:
+                with transaction.atomic():
+                    ReferralVisitSketch.objects.create(
+                        day=day, referral_link_id=link_id, registers=hll.dumps(registers)
+                    )
+                return
+            except IntegrityError:
+                # Скетч успел создать параллельный запрос
+                sketch = ReferralVisitSketch.objects.select_for_update().get(day=day, referral_link_id=link_id)
+
+        registers = hll.loads(sketch.registers)
+        if registers[index] >= rank:
+            # Повторный посетитель (или коллизия с большим рангом) - запись не нужна
+            return
+        registers[index] = rank
+        ReferralVisitSketch.objects.filter(pk=sketch.pk).update(
+            registers=hll.dumps(registers), updated_at=timezone.now()
+        )
+
+
+def record_visit(visit):
+    """Учитывает посещение в скетче ссылки за день"""
+    day = timezone.localdate(visit.visited_at)
+    index, rank = hll.position(visit.anonymous_id)
+    _add_to_sketch(day, visit.referral_link_id, index, rank)
+
+
+def merged_sketch(start_day, end_day, link_ids=None, referrer=None):
+    """
+    Объединенный скетч за дни [start_day, end_day].
+    Без link_ids и referrer сливаются скетчи всех ссылок.
+    """
+    sketches = ReferralVisitSketch.objects.filter(day__gte=start_day, day__lte=end_day)
+    if link_ids is not None:
+        sketches = sketches.filter(referral_link_id__in=link_ids)
+    if referrer is not None:
+        sketches = sketches.filter(referral_link__user=referrer)
+    return hll.merge(*(hll.loads(data) for data in sketches.values_list('registers', flat=True)))
+
+
+def unique_visitors(start_day, end_day, link_ids=None, referrer=None):
+    """Оценка количества уникальных посетителей за дни [start_day, end_day]"""
+    return hll.estimate(merged_sketch(start_day, end_day, link_ids=link_ids, referrer=referrer))
+
+
+def _day_bounds(day):
+    start = timezone.make_aware(datetime.combine(day, dt_time.min))
+    return start, timezone.make_aware(datetime.combine(day + timedelta(days=1), dt_time.min))
+
+
+def rebuild_day(day):
+    """Пересчитывает скетчи дня по сохраненным посещениям. Возвращает количество посещений."""
+    start, end = _day_bounds(day)
+    per_link = {}
+    visits = (
+        ReferralVisit.objects.filter(visited_at__gte=start, visited_at__lt=end)
+        .values_list('referral_link_id', 'anonymous_id')
+    )
+    count = 0
+    for link_id, anonymous_id in visits.iterator(chunk_size=5000):
+        index, rank = hll.position(anonymous_id)
+        registers = per_link.get(link_id)
+        if registers is None:
+            registers = per_link[link_id] = hll.empty()
+        if registers[index] < rank:
+            registers[index] = rank
+        count += 1
+
+    with transaction.atomic():
+        ReferralVisitSketch.objects.filter(day=day).delete()
+        sketches = [
+            ReferralVisitSketch(referral_link_id=link_id, day=day, registers=hll.dumps(registers))
+            for link_id, registers in per_link.items()
+        ]
+        ReferralVisitSketch.objects.bulk_create(sketches, batch_size=500)
+    return count